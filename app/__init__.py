@@ -11,6 +11,25 @@ def create_app(config_obj: type[Config]=Config) -> Flask:
     # --- Logging
     app.logger.setLevel(app.config.get("LOG_LEVEL", "INFO"))
 
+    # --- Services
+    from .services import stack_cache, compositing, strokes, selections
+    stack_cache.init_app(app)
+    stack_cache.stacks.on_edit(strokes.end_open)
+    stack_cache.stacks.on_evict(selections.clear)
+    compositing.configure(app.config.get("COMPOSITE_WORKERS"))
+    from .models import history
+    history.configure(app.config.get("HISTORY_MAX_BYTES"))
+    from .services import imaging
+    imaging.configure_image_cache(app.config.get("IMAGE_CACHE_MAX_BYTES"))
+    from .services import edges
+    edges.configure(app.config.get("EDGE_CACHE_MAX_BYTES"))
+    from .services import livewire
+    livewire.configure(app.config.get("LIVEWIRE_CACHE_MAX_BYTES"))
+    from .services import fill
+    fill.configure(app.config.get("FILL_CACHE_MAX_BYTES"))
+    from .services import pyramid
+    pyramid.configure(app.config.get("PYRAMID_CACHE_MAX_BYTES"))
+
     # --- Blueprints
     from .routes.files import bp as files_bp
     from .routes.layers import bp as layers_bp
@@ -8,7 +8,27 @@ class Config:
     MAX_CONTENT_LENGTH = 50 * 1024 * 1024
     JSON_SORT_KEYS = False
     LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+    # Live LayerStacks kept in memory, and how often dirty ones are written back to disk
+    STACK_CACHE_MAX_BYTES = int(os.getenv("STACK_CACHE_MAX_BYTES", 1024 ** 3))
+    STACK_CACHE_FLUSH_SECONDS = float(os.getenv("STACK_CACHE_FLUSH_SECONDS", 5))
+    # Keep layer pixels in memory-mapped files in the project folder instead of in RAM
+    STACK_CACHE_MMAP = os.getenv("STACK_CACHE_MMAP", "0") == "1"
+    # Undo/redo history kept per project, oldest changes are dropped past this
+    HISTORY_MAX_BYTES = int(os.getenv("HISTORY_MAX_BYTES", 64 * 1024 ** 2))
+    # Decoded images kept for the selection tools, least recently used are dropped past this
+    IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", 256 * 1024 ** 2))
+    # Edge data and live-wire cost maps kept for the edge snapping selections
+    EDGE_CACHE_MAX_BYTES = int(os.getenv("EDGE_CACHE_MAX_BYTES", 256 * 1024 ** 2))
+    # Live-wire shortest path trees kept while the cursor moves around an anchor
+    LIVEWIRE_CACHE_MAX_BYTES = int(os.getenv("LIVEWIRE_CACHE_MAX_BYTES", 256 * 1024 ** 2))
+    # Label maps kept for bucket fills, over all projects
+    FILL_CACHE_MAX_BYTES = int(os.getenv("FILL_CACHE_MAX_BYTES", 256 * 1024 ** 2))
+    # Downscaled layer and composite images kept for zoomed out views
+    PYRAMID_CACHE_MAX_BYTES = int(os.getenv("PYRAMID_CACHE_MAX_BYTES", 256 * 1024 ** 2))
+    # Threads used to composite layers, 1 composites on the request thread only
+    COMPOSITE_WORKERS = int(os.getenv("COMPOSITE_WORKERS", os.cpu_count() or 1))
 
 class TestConfig(Config):
     STORAGE_ROOT = os.getenv("TEST_STORAGE_ROOT", "/tmp/uia_lens_test")
     LOG_LEVEL = "WARNING"
+    STACK_CACHE_FLUSH_SECONDS = 0
@@ -0,0 +1,164 @@
+import uuid
+
+import cv2
+import numpy as np
+
+# Kinds of adjustment and their parameters, with defaults and allowed ranges
+KINDS = {
+    "levels": {"in_black": (0, 0, 255), "in_white": (255, 0, 255), "gamma": (1.0, 0.1, 10.0),
+               "out_black": (0, 0, 255), "out_white": (255, 0, 255)},
+    "hue_saturation": {"hue": (0, -180, 180), "saturation": (0, -100, 100), "lightness": (0, -100, 100)},
+    "blur": {"radius": (4, 1, 64)},
+}
+
+_IDENTITY = np.arange(256, dtype=np.float64)
+
+
+class AdjustmentLayer:
+
+    # An adjustment of everything below it in the stack, which has no pixels of its own.
+    # LayerStack evaluates it tile by tile while compositing, and keeps every tile it
+    # computed together with the key of its inputs, see tile()
+    def __init__(self, name, kind, params=None):
+        if kind not in KINDS:
+            raise ValueError(f"Unknown adjustment: {kind}")
+        self._id = uuid.uuid4().hex[:8]
+        self._name = name
+        self._kind = kind
+        self._params = {key: default for key, (default, _, _) in KINDS[kind].items()}
+        self._visible = True
+        # Goes up every time the parameters change
+        self._revision = 0
+        self._tiles = {}  # (ty, tx) -> (input key, BGRA tile)
+        self._lut = None
+        if params:
+            self.set_params(params)
+
+    # Computed tiles are not saved
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_tiles"] = {}
+        state["_lut"] = None
+        return state
+
+    def id(self):
+        return self._id
+
+    def kind(self):
+        return self._kind
+
+    def params(self):
+        return dict(self._params)
+
+    # Change some of the parameters. ValueError for unknown or out of range ones
+    def set_params(self, params):
+        spec = KINDS[self._kind]
+        new = dict(self._params)
+        for key, value in params.items():
+            if key not in spec:
+                raise ValueError(f"Unknown parameter for {self._kind}: {key}")
+            default, low, high = spec[key]
+            value = type(default)(value)
+            if not low <= value <= high:
+                raise ValueError(f"{key} must be in {low}..{high}")
+            new[key] = value
+        if new != self._params:
+            self._params = new
+            self._revision += 1
+            self._lut = None
+
+    # Kind and parameters, for the undo history
+    def settings(self):
+        return self._kind, tuple(sorted(self._params.items()))
+
+    def restore_settings(self, settings):
+        self.set_params(dict(settings[1]))
+
+    def revision(self):
+        return self._revision
+
+    def resume_revisions(self, revision):
+        self._revision = max(self._revision, int(revision))
+
+    # Pixels around a tile the adjustment reads
+    def halo(self):
+        return self._params["radius"] if self._kind == "blur" else 0
+
+    def copy(self, memmap_folder=None):
+        duplicate = AdjustmentLayer(self._name, self._kind, self._params)
+        duplicate._visible = self._visible
+        return duplicate
+
+    # Tile of the adjusted image whose inputs have the given key. compute() gives the
+    # tile when it is not kept from before, or its inputs changed
+    def tile(self, tile, key, compute):
+        kept = self._tiles.get(tile)
+        if kept is not None and kept[0] == key:
+            return kept[1]
+        image = compute()
+        self._tiles[tile] = (key, image)
+        return image
+
+    # Bytes of the kept tiles
+    def nbytes(self):
+        return sum(image.nbytes for _, image in self._tiles.values())
+
+    # Adjusted copy of src, a BGRA image of what is below. With a halo, src has halo
+    # extra pixels on every side that are not in the result (fewer at the image border,
+    # given by inset (top, left, bottom, right))
+    def apply(self, src, inset=(0, 0, 0, 0)):
+        if self._kind == "blur":
+            size = 2 * self._params["radius"] + 1
+            out = cv2.GaussianBlur(src, (size, size), 0, borderType=cv2.BORDER_REFLECT_101)
+            top, left, bottom, right = inset
+            return out[top:out.shape[0] - bottom, left:out.shape[1] - right]
+        if self._kind == "levels":
+            if self._lut is None:
+                self._lut = self._levels_lut()
+            return cv2.LUT(src, self._lut)
+        return self._hue_saturation(src)
+
+    # Levels as a BGRA lookup table, alpha unchanged
+    def _levels_lut(self):
+        p = self._params
+        span = max(p["in_white"] - p["in_black"], 1)
+        values = np.clip((_IDENTITY - p["in_black"]) / span, 0, 1) ** (1 / p["gamma"])
+        values = p["out_black"] + values * (p["out_white"] - p["out_black"])
+        table = np.clip(np.floor(values + 0.5), 0, 255).astype(np.uint8)
+        return np.stack([table, table, table, _IDENTITY.astype(np.uint8)], axis=1).reshape(1, 256, 4)
+
+    def _hue_saturation(self, src):
+        p = self._params
+        hsv = cv2.cvtColor(src[:, :, :3], cv2.COLOR_BGR2HSV_FULL)
+        # Hue goes round 0-255, saturation is scaled
+        shift = int(round(p["hue"] * 256 / 360)) % 256
+        hsv[:, :, 0] += np.uint8(shift)
+        saturation = np.clip(_IDENTITY * (1 + p["saturation"] / 100), 0, 255).astype(np.uint8)
+        hsv[:, :, 1] = cv2.LUT(hsv[:, :, 1], saturation)
+        out = src.copy()
+        out[:, :, :3] = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR_FULL)
+        # Lightness blends towards black or white
+        lightness = p["lightness"] / 100
+        if lightness:
+            target = 255 if lightness > 0 else 0
+            color = out[:, :, :3].astype(np.float32)
+            out[:, :, :3] = np.clip(color + (target - color) * abs(lightness) + 0.5, 0, 255).astype(np.uint8)
+        return out
+
+    def rename(self, name):
+        self._name = name
+
+    def name(self):
+        return self._name
+
+    def hide(self):
+        self._visible = False
+
+    def show(self):
+        self._visible = True
+
+    def toggle_visible(self):
+        self._visible = not self._visible
+
+    def is_hidden(self):
+        return not self._visible
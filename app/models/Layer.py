@@ -1,18 +1,244 @@
+import os
+import uuid
+
 import numpy as np
 
+# Layers are split into square tiles for change tracking
+TILE_SIZE = 256
+
+# Tile rows/cols covered by rect (x, y, w, h), clipped to a grid of rows x cols tiles
+def tile_span(rect, rows, cols):
+    x, y, w, h = rect
+    x0, y0 = max(x, 0) // TILE_SIZE, max(y, 0) // TILE_SIZE
+    x1, y1 = -(-(x + w) // TILE_SIZE), -(-(y + h) // TILE_SIZE)
+    return slice(y0, min(y1, rows)), slice(x0, min(x1, cols))
+
+# Pixel buffer shared by a layer and its duplicates, with the number of layers using it
+class _SharedPixels:
+
+    def __init__(self):
+        self.owners = 1
+
 class Layer:
 
-    def __init__(self, name, height, width):
+    # With a memmap_folder the pixels live in a memory-mapped .npy file in that folder
+    # instead of RAM. A new file is sparse, so an empty transparent layer costs no memory
+    def __init__(self, name, height, width, memmap_folder=None):
+        self._id = uuid.uuid4().hex[:8]
         self._name = name
-        self._image = np.full((height, width, 4), (0, 0, 0, 0), dtype=np.uint8)
+        self._backing = None
+        # Folder for memory-mapped pixels, also used when a shared buffer is detached
+        self._memmap_folder = memmap_folder
+        # Set while the pixels are shared with duplicates, see copy()
+        self._shared = None
+        if memmap_folder is None:
+            self._image = np.full((height, width, 4), (0, 0, 0, 0), dtype=np.uint8)
+        else:
+            self._backing = os.path.join(memmap_folder, self.filename())
+            self._image = np.lib.format.open_memmap(self._backing, mode="w+", dtype=np.uint8, shape=(height, width, 4))
         self._visible = True
+        # Pixels changed since the layer was last saved to a project folder
+        self._dirty = True
+        # Revision counter, and the revision each tile was last changed in
+        self._revision = 0
+        self._reset_tiles()
 
-    def update(self, image):
-        self._image = image
+    # Memory-mapped and shared pixels are pickled (and deep-copied) as a normal in-memory array
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self._backing is not None or self._shared is not None:
+            state["_image"] = np.array(self._image)
+            state["_backing"] = None
+        state["_shared"] = None
+        state["_memmap_folder"] = None
+        return state
+
+    # Layers pickled before ids and dirty flags existed
+    def __setstate__(self, state):
+        state.setdefault("_id", uuid.uuid4().hex[:8])
+        state.setdefault("_dirty", True)
+        state.setdefault("_backing", None)
+        state.setdefault("_revision", 0)
+        state.setdefault("_memmap_folder", None)
+        state.setdefault("_shared", None)
+        self.__dict__.update(state)
+        if "_tile_revisions" not in state:
+            self._reset_tiles()
+
+    # Replace the pixels. With rect (x, y, w, h) only that part is copied from image.
+    # Memory-mapped layers copy the new pixels into their file
+    def update(self, image, rect=None):
+        if rect is not None and image.shape == self._image.shape:
+            if image is not self._image:
+                x, y, w, h = rect
+                self.get_image()[y:y + h, x:x + w] = image[y:y + h, x:x + w]
+        elif image.shape == self._image.shape and (self._backing is not None or
+                                                   self._shared is not None and self._memmap_folder is not None):
+            if image is not self._image:
+                self.get_image()[...] = image
+            rect = None
+        else:
+            resized = image.shape[:2] != self._image.shape[:2]
+            self._release()
+            self._image = image
+            self._backing = None
+            if resized:
+                self._reset_tiles()
+            rect = None
+        self.mark_dirty(rect)
 
+    # Pixels for writing. A buffer shared with duplicates is copied first, so the
+    # other layers keep their pixels
     def get_image(self):
+        if self._shared is not None:
+            if self._shared.owners > 1:
+                self._detach()
+            else:
+                self._shared = None
         return self._image
 
+    # Pixels for reading, without copying a shared buffer. Read-only while shared
+    def pixels(self):
+        if not self.is_shared():
+            return self._image
+        image = self._image.view(np.ndarray)
+        image.flags.writeable = False
+        return image
+
+    # True while the pixels are shared with a duplicate of this layer
+    def is_shared(self):
+        return self._shared is not None and self._shared.owners > 1
+
+    # True if the pixels are in a memory-mapped file rather than RAM
+    def is_memory_mapped(self):
+        return isinstance(self._image, np.memmap)
+
+    # Id of the pixel buffer, the same for layers sharing one
+    def buffer_id(self):
+        return id(self._image)
+
+    # Give this layer its own copy of a shared buffer, in RAM or in a file in the
+    # memmap folder. A layer mapped from the shared file moves to a new file, swapped in
+    # under its own name; the duplicates keep the old mapping
+    def _detach(self):
+        shared = self._image
+        self._release()
+        if self._memmap_folder is None:
+            self._image = np.array(shared)
+            self._backing = None
+            return
+        path = os.path.join(self._memmap_folder, self.filename())
+        image = np.lib.format.open_memmap(f"{path}.tmp", mode="w+", dtype=np.uint8, shape=shared.shape)
+        image[...] = shared
+        image.flush()
+        os.replace(f"{path}.tmp", path)
+        self._image = image
+        self._backing = path
+
+    # Stop using a shared buffer. The last layer left with it becomes its only owner
+    def _release(self):
+        if self._shared is not None:
+            self._shared.owners -= 1
+            self._shared = None
+
+    def __del__(self):
+        shared = getattr(self, "_shared", None)
+        if shared is not None:
+            shared.owners -= 1
+
+    # Stable id, used for the layer's file name in a project folder
+    def id(self):
+        return self._id
+
+    # Name of the layer's pixel file in a project folder
+    def filename(self):
+        return f"{self._id}.npy"
+
+    # Path of the memory-mapped file holding the pixels, or None if they are in RAM
+    def backing(self):
+        return self._backing
+
+    # Move the pixels into a memory-mapped .npy file in folder
+    def attach_backing(self, folder):
+        path = os.path.join(folder, self.filename())
+        self._memmap_folder = folder
+        if self._backing == path:
+            return
+        image = np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8, shape=self._image.shape)
+        image[...] = self._image
+        self._release()
+        self._image = image
+        self._backing = path
+
+    # Use an existing .npy file as the layer's pixels, without reading it
+    def open_backing(self, path):
+        self._release()
+        self._image = np.load(path, mmap_mode="r+", allow_pickle=False)
+        self._backing = path
+        self._memmap_folder = os.path.dirname(path)
+        self._reset_tiles()
+
+    # Write changed pages of a memory-mapped layer to its file
+    def flush(self):
+        if self._backing is not None:
+            self._image.flush()
+
+    # Copy of the layer with a new id. The copy shares this layer's pixels until either
+    # of them is written through get_image() or update(), so duplicating is O(1).
+    # A shared copy made with memmap_folder gets its own file there when it is first written
+    def copy(self, memmap_folder=None):
+        duplicate = Layer(self._name, 0, 0)
+        if self._shared is None:
+            self._shared = _SharedPixels()
+        self._shared.owners += 1
+        duplicate._shared = self._shared
+        duplicate._image = self._image
+        duplicate._memmap_folder = memmap_folder
+        duplicate._visible = self._visible
+        duplicate._reset_tiles()
+        duplicate.mark_dirty()
+        return duplicate
+
+    # Call after changing the array from get_image() in place.
+    # rect (x, y, w, h) limits the change to the tiles it touches
+    def mark_dirty(self, rect=None):
+        self._dirty = True
+        self._revision += 1
+        if rect is None:
+            self._tile_revisions[...] = self._revision
+        else:
+            rows, cols = self._tile_revisions.shape
+            self._tile_revisions[tile_span(rect, rows, cols)] = self._revision
+
+    # Goes up every time the pixels change
+    def revision(self):
+        return self._revision
+
+    # Count revisions on from revision, for a layer loaded from a project
+    def resume_revisions(self, revision):
+        self._revision = max(self._revision, int(revision))
+        self._reset_tiles()
+
+    # Boolean (rows, cols) array of tiles changed after the given revision
+    def changed_tiles(self, since):
+        return self._tile_revisions > since
+
+    # Revision each tile was last changed in, as a (rows, cols) array. Read-only
+    def tile_revisions(self):
+        revisions = self._tile_revisions.view()
+        revisions.flags.writeable = False
+        return revisions
+
+    def mark_clean(self):
+        self._dirty = False
+
+    def is_dirty(self):
+        return self._dirty
+
+    def _reset_tiles(self):
+        h, w = self._image.shape[:2]
+        self._tile_revisions = np.full((-(-h // TILE_SIZE), -(-w // TILE_SIZE)), self._revision, dtype=np.int64)
+
     def rename(self, name):
         self._name = name
 
@@ -29,4 +255,4 @@ class Layer:
         return not self._visible
 
     def toggle_visible(self):
-        self._visible = not self._visible
\ No newline at end of file
+        self._visible = not self._visible
@@ -1,137 +1,538 @@
-import copy
+import functools
+import hashlib
+import json
+import os
+from contextlib import contextmanager
 import cv2
-from app.models import Layer
+from app.models import AdjustmentLayer, Layer, history
+from app.services import compositing
 import numpy as np
 import pickle
 
+PROJECT_FORMAT = 1
+
+def _is_adjustment(layer):
+    return isinstance(layer, AdjustmentLayer.AdjustmentLayer)
+
+# Keyed with the nonce of the stack: revisions resume from the saved project after a
+# restart, also one that lost edits in a crash, so a version alone may come back for
+# other pixels
+def _tag(nonce, version):
+    return hashlib.blake2b(repr(version).encode(), digest_size=8, key=nonce).hexdigest()
+
+# Records a layer operation (the layer list, names, visibility, selection) in the undo
+# history. Operations called from inside another one are part of the outer entry
+def _records_layers(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self._recording:
+            return method(self, *args, **kwargs)
+        entry = history.LayerChange(self)
+        self._recording = True
+        try:
+            result = method(self, *args, **kwargs)
+        finally:
+            self._recording = False
+        if entry.finish(self):
+            self.history().push(entry)
+        return result
+    return wrapper
+
 class LayerStack:
 
     # Creates and selects a white background layer
     def __init__(self, height, width):
-        self._layer_array = np.array([])
+        # Plain list of layers, bottom first. Insert, delete and reorder only move references
+        self._layer_array = []
         self._height = height
         self._width = width
         self._selected_layer = 0
+        # Project folder the layer files were last saved to or loaded from
+        self._project_folder = None
+        # Folder of memory-mapped layer files, None keeps layer pixels in RAM
+        self._memmap_folder = None
+        # Composites of the layers below and above the selected layer and of the whole
+        # stack, so redrawing while the selected layer is painted on only needs one or
+        # two blends, and only in the tiles that changed
+        self._composite_cache = None
+        # PNG path -> layer_version of the PNG written there, see mark_exported
+        self._exported = {}
+        # Random per loaded copy of the stack, goes into every tag (see _tag)
+        self._nonce = os.urandom(8)
+        # Undo/redo history, created on first use and not saved with the project
+        self._history = None
+        self._recording = False
+
+    # Cached composites are rebuilt after loading instead of being pickled
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_composite_cache"] = None
+        state["_exported"] = {}
+        state["_history"] = None
+        state["_recording"] = False
+        return state
+
+    def __setstate__(self, state):
+        state.pop("_below", None)
+        state.pop("_above", None)
+        state.pop("_composite_valid", None)
+        state["_composite_cache"] = None
+        state["_exported"] = {}
+        state["_nonce"] = os.urandom(8)
+        state["_history"] = None
+        state["_recording"] = False
+        self.__dict__.update(state)
 
     # adds background and layer 1
     def add_base_layers(self):
         white_image = np.full((self._height, self._width, 4), (255, 255, 255, 255), dtype=np.uint8)
-        background_layer = Layer.Layer("Background", self._height, self._width)
+        background_layer = Layer.Layer("Background", self._height, self._width, self._memmap_folder)
         background_layer.update(white_image)
-        self._layer_array = np.array([background_layer])
+        self._layer_array = [background_layer]
+        self._invalidate_composite()
         self.create_layer()
+        self.history().clear()
 
     # Creates and selects a transparent background layer
     # Currently can produce duplicate layer names if layers have been deleted
+    @_records_layers
     def create_layer(self):
-        new_layer_number = np.size(self._layer_array)
-        new_layer = Layer.Layer(f"Layer {new_layer_number}", self._height, self._width)
-        self._layer_array = np.append(self._layer_array, new_layer)
+        new_layer_number = len(self._layer_array)
+        new_layer = Layer.Layer(f"Layer {new_layer_number}", self._height, self._width, self._memmap_folder)
+        self._layer_array.append(new_layer)
         self._selected_layer = new_layer_number
+        self._invalidate_composite()
+
+    # Creates and selects an adjustment layer of kind (see AdjustmentLayer.KINDS) on top.
+    # ValueError for an unknown kind or bad parameters
+    @_records_layers
+    def create_adjustment_layer(self, kind, params=None):
+        layer = AdjustmentLayer.AdjustmentLayer(kind.replace("_", " ").capitalize(), kind, params)
+        self._layer_array.append(layer)
+        self._selected_layer = len(self._layer_array) - 1
+        self._invalidate_composite()
+
+    # Change parameters of the selected adjustment layer. False if it is a pixel layer
+    @_records_layers
+    def set_adjustment_params(self, params):
+        layer = self.get_current_layer()
+        if not _is_adjustment(layer):
+            return False
+        layer.set_params(params)
+        return True
 
     # Get number of layers
     def size(self):
-        return np.size(self._layer_array)
+        return len(self._layer_array)
+
+    # Keep layer pixels in memory-mapped files in folder (normally the project folder),
+    # so the OS only pages in the parts of a large canvas that are being used
+    def use_memmap(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        self._memmap_folder = os.path.abspath(folder)
+        for x in self._layer_array:
+            if not _is_adjustment(x):
+                x.attach_backing(self._memmap_folder)
+
+    # Bytes of layer pixels held in RAM. Used by the stack cache memory budget.
+    # Memory-mapped layers are paged in and out by the OS and are not counted, and
+    # pixels shared by duplicated layers are counted once. Adjustment layers count the
+    # tiles they keep
+    def nbytes(self):
+        cache = self._composite_cache or {}
+        cached = sum(cache[k].nbytes for k in ("below", "above", "image") if cache.get(k) is not None)
+        buffers = {}
+        for x in self._layer_array:
+            if _is_adjustment(x):
+                cached += x.nbytes()
+            elif not x.is_memory_mapped():
+                buffers[x.buffer_id()] = x.pixels().nbytes
+        undo = self._history.nbytes() if self._history is not None else 0
+        return cached + sum(buffers.values()) + undo
+
+    # (height, width) of the layers
+    def shape(self):
+        return self._height, self._width
 
     # Get layer_array[i]
     def at(self, i):
-        if i >= np.size(self._layer_array):
+        if i >= len(self._layer_array):
             return 0
         return self._layer_array[i]
 
+    @_records_layers
     def toggle_visible_at(self, i):
-        if i >= np.size(self._layer_array):
+        if i >= len(self._layer_array):
             return False
         self._layer_array[i].toggle_visible()
+        # The selected layer is blended separately, so the cached composites still hold
+        if i != self._selected_layer:
+            self._invalidate_composite()
         return True
 
     # Get currently selected layer
     def get_current_layer(self):
-        if (self._selected_layer >= np.size(self._layer_array)) or (self._selected_layer < 0):
+        if (self._selected_layer >= len(self._layer_array)) or (self._selected_layer < 0):
             return 0
         return self._layer_array[self._selected_layer]
 
     # Replace the currently selected layer
+    @_records_layers
     def replace_current_layer(self, updated_layer):
         if self._selected_layer < 0:
             return
         self._layer_array[self._selected_layer] = updated_layer
+        self._invalidate_composite()
 
     # Choose a layer to be "selected"
     def select_layer(self, i):
-        if i >= np.size(self._layer_array):
+        if i >= len(self._layer_array):
             return
+        if i != self._selected_layer:
+            self._invalidate_composite()
         self._selected_layer = i
 
     # Swap two layers
+    @_records_layers
     def swap_layers(self, i, j):
-        if (i or j) >= np.size(self._layer_array):
+        if (i or j) >= len(self._layer_array):
             return
         self._layer_array[i], self._layer_array[j] = self._layer_array[j], self._layer_array[i]
+        self._invalidate_composite()
+
+    # Move layer at index i to index j, shifting the layers in between.
+    # The same layer stays selected
+    @_records_layers
+    def move_layer(self, i, j):
+        n = len(self._layer_array)
+        if not (0 <= i < n and 0 <= j < n) or i == j:
+            return
+        selected = self._layer_array[self._selected_layer]
+        self._layer_array.insert(j, self._layer_array.pop(i))
+        self._selected_layer = self._layer_array.index(selected)
+        self._invalidate_composite()
 
     # Delete layer at index
+    @_records_layers
     def delete_layer(self, i):
-        if i >= np.size(self._layer_array):
+        if i >= len(self._layer_array):
             return
         if i >= self._selected_layer:
             i = i-1
-        self._layer_array = np.delete(self._layer_array, i)
+        del self._layer_array[i]
+        self._invalidate_composite()
 
     # Delete currently selected layer
+    @_records_layers
     def delete_selected_layer(self):
-        self._layer_array = np.delete(self._layer_array, self._selected_layer)
-        self._selected_layer = np.size(self._layer_array) -1
+        del self._layer_array[self._selected_layer]
+        self._selected_layer = len(self._layer_array) -1
+        self._invalidate_composite()
 
     # Duplicate currently selected layer
+    @_records_layers
     def duplicate_selected_layer(self):
-        duplicate = copy.deepcopy(self._layer_array[self._selected_layer])
+        duplicate = self._layer_array[self._selected_layer].copy(self._memmap_folder)
         duplicate.rename(f"{duplicate.name()} - copy")
         self._selected_layer = self._selected_layer + 1
-        self._layer_array = np.insert(self._layer_array, self._selected_layer, duplicate)
-
-    # Takes images from all layers and combine them, in order, to a single image
+        self._layer_array.insert(self._selected_layer, duplicate)
+        self._invalidate_composite()
+
+    # Rename currently selected layer
+    @_records_layers
+    def rename_current_layer(self, name):
+        self._layer_array[self._selected_layer].rename(name)
+
+    def history(self):
+        if self._history is None:
+            self._history = history.History()
+        return self._history
+
+    # Undo/redo the last change. False if there is nothing to undo/redo
+    def undo(self):
+        return self.history().undo(self)
+
+    def redo(self):
+        return self.history().redo(self)
+
+    # Records a pixel edit of layer (the selected one by default) in the undo history.
+    # Only rect (x, y, w, h) is kept, None means the whole layer. The edit is made
+    # inside the with block and not recorded if it raises
+    @contextmanager
+    def record_pixels(self, rect=None, layer=None):
+        layer = layer or self.get_current_layer()
+        h, w = layer.pixels().shape[:2]
+        if rect is None:
+            rect = (0, 0, w, h)
+        x, y, rw, rh = rect
+        x0, y0 = max(int(x), 0), max(int(y), 0)
+        x1, y1 = min(int(x + rw), w), min(int(y + rh), h)
+        if x1 <= x0 or y1 <= y0:
+            yield
+            return
+        entry = history.PixelChange(layer, (x0, y0, x1 - x0, y1 - y0))
+        yield
+        self.history().push(entry)
+
+    # Layers with their names, visibility and adjustment settings, and the selected index,
+    # for the undo history
+    def _layer_state(self):
+        layers = tuple((x, x.name(), x.is_hidden(), x.settings() if _is_adjustment(x) else None)
+                       for x in self._layer_array)
+        return layers, self._selected_layer
+
+    def _restore_layer_state(self, state):
+        layers, selected = state
+        self._layer_array = [x for x, _, _, _ in layers]
+        for x, name, hidden, settings in layers:
+            x.rename(name)
+            if hidden:
+                x.hide()
+            else:
+                x.show()
+            if settings is not None:
+                x.restore_settings(settings)
+        self._selected_layer = selected
+        self._invalidate_composite()
+
+    # Takes images from all layers and combine them, in order, to a single image.
+    # The bottom layer is always included, hidden layers above it are skipped.
+    # The result is kept between calls and only the tiles that changed are composited
+    # again. It is returned read-only: copy it before changing it
     def get_collapsed_stack_as_image(self):
-
-        bottom_layer = self._layer_array[0]
-
-        dst = bottom_layer.get_image().copy()
-
+        if self._has_adjustments():
+            image = self._adjusted_composite()["image"].view()
+            image.flags.writeable = False
+            return image
+        cache = self._composite_cache
+        if cache is None or cache["key"] != self._composite_key():
+            cache = self._composite_cache = self._build_composite_cache()
+        else:
+            self._update_composite_cache(cache)
+        image = cache["image"].view()
+        image.flags.writeable = False
+        return image
+
+    # Layer pixel changes are picked up through layer revisions,
+    # this only forces the next composite to start from scratch
+    def invalidate_composite(self):
+        self._invalidate_composite()
+
+    def _invalidate_composite(self):
+        self._composite_cache = None
+
+    # Changes whenever the collapsed image might: layer order, visibility or pixels
+    def composite_version(self):
+        return tuple((x.id(), x.is_hidden(), x.revision()) for x in self._layer_array)
+
+    # Boolean (rows, cols) array of the tiles where the collapsed image may have changed
+    # since composite_version() was since. All tiles when layers were added, removed,
+    # moved, shown or hidden, or since is None
+    def composite_changes(self, since):
+        grid = (-(-self._height // Layer.TILE_SIZE), -(-self._width // Layer.TILE_SIZE))
+        now = self.composite_version()
+        if since is None or [x[:2] for x in since] != [x[:2] for x in now]:
+            return np.ones(grid, dtype=bool)
+        changed = np.zeros(grid, dtype=bool)
+        for x, (_, hidden, revision) in zip(self._layer_array, since):
+            if x.revision() == revision:
+                continue
+            if not _is_adjustment(x):
+                changed |= x.changed_tiles(revision)
+            elif not hidden:
+                changed[...] = True
+        # Blurs spread a change into the tiles around it
+        reach = -(-self._reach(len(self._layer_array)) // Layer.TILE_SIZE)
+        if reach and changed.any():
+            kernel = np.ones((2 * reach + 1, 2 * reach + 1), np.uint8)
+            changed = cv2.dilate(changed.astype(np.uint8), kernel) > 0
+        return changed
+
+    # Layer order, visibility and selection the cached composites were built for
+    def _composite_key(self):
+        layers = tuple((x.id(), x.is_hidden() and i != self._selected_layer) for i, x in enumerate(self._layer_array))
+        return self._selected_layer, layers
+
+    def _composite_layers(self):
+        selected = self._selected_layer
+        below = [x.pixels() for i, x in enumerate(self._layer_array[:selected]) if i == 0 or not x.is_hidden()]
+        above = [x.pixels() for x in self._layer_array[selected + 1:] if not x.is_hidden()]
+        return below, above
+
+    def _build_composite_cache(self):
+        below, above = self._composite_layers()
+        cache = {
+            "key": self._composite_key(),
+            "revisions": [x.revision() for x in self._layer_array],
+            "selected_hidden": self._layer_array[self._selected_layer].is_hidden(),
+            "below": compositing.composite(below) if below else None,
+            "above": None,
+            "image": np.empty((self._height, self._width, 4), dtype=np.uint8)
+        }
+        if above:
+            # Premultiplied float, see _compose_region
+            cache["above"] = compositing.composite_premultiplied(above)
+        self._compose_region(cache, (slice(None), slice(None)))
+        return cache
+
+    # Bring the cached composites up to date, tile by tile, with layers whose pixels changed
+    def _update_composite_cache(self, cache):
+        selected = self._selected_layer
+        revisions = cache["revisions"]
+        grid = self._layer_array[0].changed_tiles(revisions[0]).shape
+        changed = {"below": np.zeros(grid, dtype=bool), "above": np.zeros(grid, dtype=bool)}
+        image_changed = np.zeros(grid, dtype=bool)
         for i, x in enumerate(self._layer_array):
-
-            if i+1 == np.size(self._layer_array):
-                break
-
-            next_layer = self._layer_array[i+1]
-
-            # Only add image not hidden
-            if next_layer.is_hidden():
+            if x.revision() == revisions[i]:
                 continue
-
-            background = dst
-            foreground = next_layer.get_image().copy()
-
-            # Separate color from alpha.
-            # Results in one bgr image/array, and one alpha image/array
-            cb = background[:, :, :3]           # [b, g, r]
-            ab = background[:, :, 3] / 255.0    # normalized alpha
-
-            ct = foreground[:, :, :3]           # [b, g, r]
-            at = foreground[:, :, 3] / 255.0    # normalized alpha
-
-            # Calculate alpha array for new image
-            ao = at + ab * (1 - at)
-
-            # Calculate color array for new image and adjust alpha based on "ao"
-            # [:, :, None] turns alpha array shape from [height,width] to [height,width,1], allowing slicing
-            # with the color array with shape [height,width,3]
-            co = (ct * at[:, :, None] + cb * ab[:, :, None] * (1 - at[:, :, None])) / (ao[:, :, None] + 0.000001)
-
-            # Apply color and alpha array to destination image
-            dst[:, :, :3] = co
-            # Turns alpha array from 0-1 to 0-255. Ensures correct type and a lower and upper limit
-            dst[:, :, 3] = np.clip(ao * 255, 0, 255).astype(np.uint8)
-
-        return dst
+            tiles = x.changed_tiles(revisions[i])
+            if i < selected:
+                changed["below"] |= tiles
+            elif i > selected:
+                changed["above"] |= tiles
+            image_changed |= tiles
+            revisions[i] = x.revision()
+
+        hidden = self._layer_array[selected].is_hidden()
+        if hidden != cache["selected_hidden"]:
+            cache["selected_hidden"] = hidden
+            image_changed[...] = True
+
+        below, above = self._composite_layers()
+
+        # Tiles are independent, so they are redone in parallel
+        def update_tile(tile):
+            region = self._tile_region(*tile)
+            if cache["below"] is not None and changed["below"][tile]:
+                dst = cache["below"][region]
+                np.copyto(dst, below[0][region])
+                for image in below[1:]:
+                    compositing.blend(dst, image[region])
+            if cache["above"] is not None and changed["above"][tile]:
+                compositing.composite_premultiplied([image[region] for image in above], out=cache["above"][region])
+            self._compose_region(cache, region)
+
+        compositing.parallel_map(update_tile, zip(*np.nonzero(image_changed)))
+
+    # Hidden adjustment layers too, the other composites need pixels from every layer
+    def _has_adjustments(self):
+        return any(_is_adjustment(x) for x in self._layer_array)
+
+    # Composite with adjustment layers. An adjustment depends on everything below it, so
+    # instead of the below/above composites one image is kept and its changed tiles are
+    # composited from all the layers again. Adjustment layers keep the tiles they compute
+    # and only recompute those whose inputs or parameters changed
+    def _adjusted_composite(self):
+        key = ("adjusted", tuple((x.id(), x.is_hidden()) for x in self._layer_array))
+        cache = self._composite_cache
+        if cache is None or cache["key"] != key:
+            cache = self._composite_cache = {
+                "key": key,
+                "version": None,
+                "image": np.empty((self._height, self._width, 4), dtype=np.uint8)
+            }
+        changed = self.composite_changes(cache["version"])
+        cache["version"] = self.composite_version()
+
+        count = len(self._layer_array)
+
+        def update_tile(tile):
+            region = self._tile_region(*tile)
+            np.copyto(cache["image"][region], self._composite_rect(count, self._region_rect(region)))
+
+        compositing.parallel_map(update_tile, zip(*np.nonzero(changed)))
+        return cache
+
+    # Composite of the first count layers inside rect (x, y, w, h)
+    def _composite_rect(self, count, rect):
+        x, y, w, h = rect
+        region = (slice(y, y + h), slice(x, x + w))
+        out = np.zeros((h, w, 4), dtype=np.uint8)
+        for i, layer in enumerate(self._layer_array[:count]):
+            if _is_adjustment(layer):
+                if not layer.is_hidden():
+                    out = self._adjust_rect(i, rect, out)
+            elif i == 0:
+                np.copyto(out, layer.pixels()[region])
+            elif not layer.is_hidden():
+                compositing.blend(out, layer.pixels()[region])
+        return out
+
+    # Adjustment layer i applied to below, the composite of the layers under it in rect.
+    # Whole tiles come from the layer's kept tiles
+    def _adjust_rect(self, i, rect, below):
+        layer = self._layer_array[i]
+        size = Layer.TILE_SIZE
+        x, y, w, h = rect
+        out = np.empty_like(below)
+        for ty in range(y // size, -(-(y + h) // size)):
+            for tx in range(x // size, -(-(x + w) // size)):
+                tile = self._region_rect(self._tile_region(ty, tx))
+                px0, py0 = max(x, tile[0]), max(y, tile[1])
+                px1, py1 = min(x + w, tile[0] + tile[2]), min(y + h, tile[1] + tile[3])
+                part = (px0, py0, px1 - px0, py1 - py0)
+                src = below[py0 - y:py1 - y, px0 - x:px1 - x]
+                if part == tile:
+                    adjusted = layer.tile((ty, tx), self._adjustment_key(i, ty, tx),
+                                          lambda: self._adjust_part(i, part, src))
+                else:
+                    adjusted = self._adjust_part(i, part, src)
+                out[py0 - y:py1 - y, px0 - x:px1 - x] = adjusted
+        return out
+
+    def _adjust_part(self, i, part, below):
+        layer = self._layer_array[i]
+        halo = layer.halo()
+        if not halo:
+            return layer.apply(below)
+        # The composite under the layer is needed around the part too
+        x, y, w, h = part
+        x0, y0 = max(x - halo, 0), max(y - halo, 0)
+        x1, y1 = min(x + w + halo, self._width), min(y + h + halo, self._height)
+        src = self._composite_rect(i, (x0, y0, x1 - x0, y1 - y0))
+        return layer.apply(src, (y - y0, x - x0, y1 - y - h, x1 - x - w))
+
+    # Inputs of adjustment layer i at tile (ty, tx): its parameters, and the layers under
+    # it in the tiles it reads, through the blurs under it as well
+    def _adjustment_key(self, i, ty, tx):
+        reach = -(-self._reach(i + 1) // Layer.TILE_SIZE)
+        rows, cols = slice(max(ty - reach, 0), ty + reach + 1), slice(max(tx - reach, 0), tx + reach + 1)
+        below = tuple((x.id(), x.is_hidden(), x.revision() if _is_adjustment(x) else x.tile_revisions()[rows, cols].tobytes())
+                      for x in self._layer_array[:i])
+        return self._layer_array[i].revision(), below
+
+    # Pixels the visible adjustments among the first count layers read around a pixel
+    def _reach(self, count):
+        return sum(x.halo() for x in self._layer_array[:count] if _is_adjustment(x) and not x.is_hidden())
+
+    # (x, y, w, h) of a (rows, cols) region, clipped to the stack
+    def _region_rect(self, region):
+        rows, cols = region
+        y0, y1 = rows.start, min(rows.stop, self._height)
+        x0, x1 = cols.start, min(cols.stop, self._width)
+        return x0, y0, x1 - x0, y1 - y0
+
+    # Final composite for one region: below, then the selected layer, then above
+    def _compose_region(self, cache, region):
+        current = self._layer_array[self._selected_layer]
+        dst = cache["image"][region]
+        if cache["below"] is None:
+            # Selected layer is the bottom layer
+            np.copyto(dst, current.pixels()[region])
+        else:
+            np.copyto(dst, cache["below"][region])
+            if not current.is_hidden():
+                compositing.blend(dst, current.pixels()[region])
+        # The layers above are kept unrounded, so putting them on top rounds only once
+        # and the result stays within one level of blending the layers one by one
+        if cache["above"] is not None:
+            compositing.blend_premultiplied(dst, cache["above"][region])
+
+    # (rows, cols) slices of tile (ty, tx)
+    @staticmethod
+    def _tile_region(ty, tx):
+        size = Layer.TILE_SIZE
+        return slice(ty * size, (ty + 1) * size), slice(tx * size, (tx + 1) * size)
 
     # Unsure if filetype should be required in path.
     # Add/remove depending on what makes sense with load/save implementation
@@ -162,25 +563,208 @@ class LayerStack:
 
             # All layers must have same height/width
             for i, x in enumerate(db._layer_array):
+                if _is_adjustment(x):
+                    continue
                 h, w, d = x.get_image().shape
                 if (h != db._height) or (w != db._width):
                     print("height or width mismatch")
                     return False
 
-            self._layer_array = db._layer_array
+            # Older pickles hold the layers in a NumPy object array
+            self._layer_array = list(db._layer_array)
+            self._history = None
+            self._nonce = os.urandom(8)
+            self._invalidate_composite()
             self._height = db._height
             self._width = db._width
             # Ensures selected layer is in bounds of array
-            if db._selected_layer >= np.size(db._layer_array):
-                self._selected_layer = np.size(db._layer_array) - 1
+            if db._selected_layer >= len(self._layer_array):
+                self._selected_layer = len(self._layer_array) - 1
             else:
                 self._selected_layer = db._selected_layer
             return True
 
-    # Turns all image arrays into png to display on webpage
+    # Saves the stack as a project folder: a small manifest.json with names, visibility,
+    # selection and dimensions, plus one .npy file per layer named by layer id.
+    # Only layers changed since the last save to this folder are rewritten
+    def save_project(self, folder):
+        try:
+            os.makedirs(folder, exist_ok=True)
+            same_folder = self._project_folder == os.path.abspath(folder)
+            manifest = {
+                "format": PROJECT_FORMAT,
+                "height": self._height,
+                "width": self._width,
+                "selected_layer": self._selected_layer,
+                "layers": []
+            }
+            for x in self._layer_array:
+                if _is_adjustment(x):
+                    # Adjustments are only their settings
+                    manifest["layers"].append({
+                        "id": x.id(),
+                        "name": x.name(),
+                        "visible": int(not x.is_hidden()),
+                        "adjustment": x.kind(),
+                        "params": x.params(),
+                        "revision": x.revision()
+                    })
+                    continue
+                filename = x.filename()
+                path = os.path.join(folder, filename)
+                if x.backing() == os.path.abspath(path):
+                    # Memory-mapped from this file already
+                    if x.is_dirty():
+                        x.flush()
+                elif x.is_dirty() or not same_folder or not os.path.exists(path):
+                    # Write next to the old file and swap, so a crash never leaves half a layer
+                    with open(f"{path}.tmp", "wb") as f:
+                        np.save(f, np.ascontiguousarray(x.pixels()), allow_pickle=False)
+                    os.replace(f"{path}.tmp", path)
+                manifest["layers"].append({
+                    "id": x.id(),
+                    "name": x.name(),
+                    "visible": int(not x.is_hidden()),
+                    "file": filename,
+                    "revision": x.revision()
+                })
+
+            with open(os.path.join(folder, "manifest.json.tmp"), "w") as f:
+                json.dump(manifest, f)
+            os.replace(os.path.join(folder, "manifest.json.tmp"), os.path.join(folder, "manifest.json"))
+
+            for x in self._layer_array:
+                if not _is_adjustment(x):
+                    x.mark_clean()
+            self._project_folder = os.path.abspath(folder)
+
+            # Remove files of deleted layers
+            used = {layer["file"] for layer in manifest["layers"] if "file" in layer}
+            for filename in os.listdir(folder):
+                if filename.endswith(".npy") and filename not in used:
+                    os.remove(os.path.join(folder, filename))
+            return True
+        except Exception as e:
+            print("error saving project:", e)
+            return False
+
+    # Loads a project folder written by save_project. Never unpickles anything.
+    # With mmap=True layer pixels stay memory-mapped from the .npy files, so only the
+    # parts that are used get read from disk, and edits are written straight back to them
+    def load_project(self, folder, mmap=False):
+        try:
+            with open(os.path.join(folder, "manifest.json")) as f:
+                manifest = json.load(f)
+        except Exception as e:
+            print("error reading manifest:", e)
+            return False
+
+        if manifest.get("format") != PROJECT_FORMAT:
+            print("unsupported project format:", manifest.get("format"))
+            return False
+
+        height, width = int(manifest["height"]), int(manifest["width"])
+        layers = []
+        for info in manifest["layers"]:
+            if "adjustment" in info:
+                try:
+                    layer = AdjustmentLayer.AdjustmentLayer(info["name"], info["adjustment"], info.get("params"))
+                except ValueError as e:
+                    print("error loading adjustment layer:", e)
+                    return False
+                layer._id = info["id"]
+                layer.resume_revisions(info.get("revision", 0))
+                if not info["visible"]:
+                    layer.hide()
+                layers.append(layer)
+                continue
+            path = os.path.abspath(os.path.join(folder, os.path.basename(info["file"])))
+            layer = Layer.Layer(info["name"], 0, 0)
+            try:
+                if mmap:
+                    layer.open_backing(path)
+                else:
+                    layer.update(np.load(path, allow_pickle=False))
+            except Exception as e:
+                print("error loading layer:", e)
+                return False
+
+            # All layers must have same height/width
+            image = layer.get_image()
+            if image.shape != (height, width, 4) or image.dtype != np.uint8:
+                print("height or width mismatch")
+                return False
+
+            layer._id = info["id"]
+            # Revisions go on from where they were saved, so versions given out before
+            # are never used again for other pixels
+            layer.resume_revisions(info.get("revision", 0))
+            if not info["visible"]:
+                layer.hide()
+            layer.mark_clean()
+            layers.append(layer)
+
+        self._layer_array = layers
+        self._history = None
+        self._nonce = os.urandom(8)
+        self._invalidate_composite()
+        self._height = height
+        self._width = width
+        # Ensures selected layer is in bounds of array
+        self._selected_layer = min(int(manifest["selected_layer"]), len(layers) - 1)
+        self._project_folder = os.path.abspath(folder)
+        self._memmap_folder = self._project_folder if mmap else None
+        return True
+
+    # Turns all image arrays into png to display on webpage.
+    # Layers whose pixels have not changed since they were last written are skipped
     def create_images_from_layers_at(self, folder):
-        for i, x in enumerate(self._layer_array):
-            cv2.imwrite(f"{folder}/Layer{i}.png", x.get_image())
+        for path, image, version in self.stale_layer_images(folder, copy=False):
+            if cv2.imwrite(path, image):
+                self.mark_exported(path, version)
+
+    # (PNG path, pixels, layer version) of the layers whose PNG in folder is out of
+    # date, leaving out those queued(path, version) says are being written already.
+    # With copy the pixels are copied, so they can be written on another thread while
+    # the layers keep changing
+    def stale_layer_images(self, folder, copy=True, queued=None):
+        stale = []
+        for i in range(len(self._layer_array)):
+            path = f"{folder}/Layer{i}.png"
+            version = self.layer_version(i)
+            if self._exported.get(path) == version or (queued is not None and queued(path, version)):
+                continue
+            stale.append((path, self.layer_image(i, copy), version))
+        return stale
+
+    # The PNG at path (as given by stale_layer_images) now shows layer version. Only
+    # called once the file is written, so a failed write is tried again. Safe to call
+    # from the export thread
+    def mark_exported(self, path, version):
+        self._exported[path] = version
+
+    # Pixels of layer i. For an adjustment layer that is the adjusted composite of the
+    # layers up to it, which the editor stacks like any other layer image
+    def layer_image(self, i, copy=False):
+        x = self._layer_array[i]
+        if _is_adjustment(x):
+            return self._composite_rect(i + 1, (0, 0, self._width, self._height))
+        return np.array(x.pixels()) if copy else x.pixels()
+
+    # Short strings that change whenever layer_image(i) or the collapsed image might,
+    # for versioned file names and ETags
+    def layer_tag(self, i):
+        return _tag(self._nonce, self.layer_version(i))
+
+    def composite_tag(self):
+        return _tag(self._nonce, self.composite_version())
+
+    # Changes whenever layer_image(i) might
+    def layer_version(self, i):
+        x = self._layer_array[i]
+        if _is_adjustment(x):
+            return x.id(), x.revision(), self.composite_version()[:i]
+        return x.id(), x.revision()
 
     # Get object in form of json.
     # Will only return filename, and not images,
@@ -191,6 +775,7 @@ class LayerStack:
             "selected_layer": self._selected_layer,
             "height": self._height,
             "width": self._width,
+            "composite": f"composite.{self.composite_tag()}.png",
             "layers": []
         }
 
@@ -198,7 +783,10 @@ class LayerStack:
             layer_info = {
                 "name": x.name(),
                 "visible": int(not x.is_hidden()),
-                "filename": f"Layer{i}.png"
+                "filename": f"Layer{i}.{self.layer_tag(i)}.png"
             }
+            if _is_adjustment(x):
+                layer_info["adjustment"] = x.kind()
+                layer_info["params"] = x.params()
             data["layers"].append(layer_info)
         return data
\ No newline at end of file
@@ -0,0 +1,148 @@
+# Undo/redo history of a LayerStack.
+# Pixel edits store only the rectangle the edit changed, zlib-compressed. Layer
+# operations (create, delete, swap, duplicate, rename, visibility) store the layer
+# list itself: layers are shared by reference, so this costs a few pointers plus the
+# pixels of deleted layers, which stay alive while the history needs them.
+# Every entry holds the state on the other side of the change. Undoing or redoing it
+# swaps that state with the stack's current one, so one entry serves both directions.
+
+import zlib
+from collections import deque
+
+import numpy as np
+
+from app.models.AdjustmentLayer import AdjustmentLayer
+
+# Per-project budget for the history, oldest entries are dropped first
+DEFAULT_MAX_BYTES = 64 * 1024 ** 2
+
+# Fast compression, stroke regions are mostly flat color or transparency
+COMPRESS_LEVEL = 1
+
+_max_bytes = DEFAULT_MAX_BYTES
+
+
+# Set the byte budget used by new histories
+def configure(max_bytes=None):
+    global _max_bytes
+    if max_bytes is not None:
+        _max_bytes = int(max_bytes)
+
+
+# Pixels of one layer inside rect (x, y, w, h), compressed. before holds the old
+# pixels of rect when the edit has already been made
+class PixelChange:
+
+    def __init__(self, layer, rect, before=None):
+        self.layer = layer
+        self.rect = rect
+        self._data = self._grab(before)
+
+    def _grab(self, region=None):
+        if region is None:
+            x, y, w, h = self.rect
+            region = self.layer.pixels()[y:y + h, x:x + w]
+        return zlib.compress(np.ascontiguousarray(region).tobytes(), COMPRESS_LEVEL)
+
+    def nbytes(self):
+        return len(self._data)
+
+    def swap(self, stack):
+        x, y, w, h = self.rect
+        current = self._grab()
+        region = np.frombuffer(zlib.decompress(self._data), np.uint8).reshape(h, w, 4)
+        self.layer.get_image()[y:y + h, x:x + w] = region
+        self.layer.mark_dirty(self.rect)
+        self._data = current
+
+
+# Layer list, names, visibility, adjustment settings and selection of a stack
+class LayerChange:
+
+    def __init__(self, stack):
+        self._state = stack._layer_state()
+        self._nbytes = 0
+
+    # Call once the operation is done. False if it turned out to change nothing
+    def finish(self, stack):
+        if self._state == stack._layer_state():
+            return False
+        self._count(stack)
+        return True
+
+    # Pixels kept alive only by this entry: buffers of layers it holds that no layer
+    # in the stack uses
+    def _count(self, stack):
+        layers = [x for x, _, _, settings in self._state[0] if settings is None]
+        live = {x.buffer_id() for x in stack._layer_array if not isinstance(x, AdjustmentLayer)}
+        buffers = {x.buffer_id(): x.pixels().nbytes for x in layers
+                   if x.buffer_id() not in live and not x.is_memory_mapped()}
+        self._nbytes = sum(buffers.values())
+
+    def nbytes(self):
+        return self._nbytes
+
+    def swap(self, stack):
+        current = stack._layer_state()
+        stack._restore_layer_state(self._state)
+        self._state = current
+        self._count(stack)
+
+
+class History:
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = _max_bytes if max_bytes is None else max_bytes
+        self._undo = deque()
+        self._redo = []
+        self._nbytes = 0
+
+    # Add an entry for a change that has just been made. Clears the redo list
+    def push(self, entry):
+        for old in self._redo:
+            self._nbytes -= old.nbytes()
+        self._redo.clear()
+        self._undo.append(entry)
+        self._nbytes += entry.nbytes()
+        self._enforce_budget()
+
+    def undo(self, stack):
+        return self._move(self._undo, self._redo, stack)
+
+    def redo(self, stack):
+        return self._move(self._redo, self._undo, stack)
+
+    def _move(self, source, target, stack):
+        if not source:
+            return False
+        entry = source.pop()
+        self._nbytes -= entry.nbytes()
+        entry.swap(stack)
+        self._nbytes += entry.nbytes()
+        target.append(entry)
+        self._enforce_budget()
+        return True
+
+    # Drop the oldest undo entries, then the redo entries furthest away
+    def _enforce_budget(self):
+        while self._nbytes > self.max_bytes and self._undo:
+            self._nbytes -= self._undo.popleft().nbytes()
+        while self._nbytes > self.max_bytes and self._redo:
+            self._nbytes -= self._redo.pop(0).nbytes()
+
+    def clear(self):
+        self._undo.clear()
+        self._redo.clear()
+        self._nbytes = 0
+
+    def nbytes(self):
+        return self._nbytes
+
+    def can_undo(self):
+        return bool(self._undo)
+
+    def can_redo(self):
+        return bool(self._redo)
+
+    def as_json(self):
+        return {"undo": len(self._undo), "redo": len(self._redo), "bytes": self._nbytes}
@@ -1,17 +1,211 @@
-import numpy as np
-import cv2
+# Selection masks stored as the bounding box of the selection and the mask inside it,
+# so drawing and sending a selection costs in proportion to its size and not the canvas.
+# Wire formats:
+#   png    - base64 PNG of the whole canvas, 0 or 255 per pixel (the original format)
+#   rle    - JSON {"size": [w, h], "bbox": [x, y, w, h], "runs": [...]}, run lengths of
+#            the bbox rows in order, alternating unselected and selected, starting unselected
+#   packed - binary, a header of six little-endian uint32 (canvas width, height, bbox x,
+#            y, w, h) then the bbox rows, 1 bit per pixel, most significant bit first,
+#            each row padded to whole bytes
+# Feathered selections have values between 0 and 255. rle and packed send them
+# thresholded at 128, png sends them as they are.
+# The boolean operations work on the bounding boxes of the masks involved, never on
+# the whole canvas (except invert, which selects everything outside the selection).
+
 import base64
+import struct
+
+import cv2
+import numpy as np
+
+FORMATS = ("png", "rle", "packed")
+# How a new selection is combined with the active one
+MODES = ("replace", "add", "subtract", "intersect")
+
+_HEADER = struct.Struct("<6I")
+
 
 class SelectionMask:
-    def __init__(self, mask_array: np.ndarray):
-        self.mask = mask_array
 
-    def apply_to_image(self, img: np.ndarray) -> np.ndarray:
-        return cv2.bitwise_and(img, img, mask=self.mask) # Applies mask to image keeps selected area
+    # mask is the uint8 (0 or 255) mask of the bbox with top left corner (x, y)
+    def __init__(self, width, height, x=0, y=0, mask=None):
+        self.width, self.height = int(width), int(height)
+        self.x, self.y = int(x), int(y)
+        self.mask = np.zeros((0, 0), np.uint8) if mask is None else mask
+
+    # Filled polygon of (x, y) points, drawn only inside its clipped bounding box
+    @classmethod
+    def polygon(cls, width, height, points):
+        points = np.asarray(points, np.int32).reshape(-1, 2)
+        if len(points) < 3:
+            return cls(width, height)
+        selection = cls._bbox_of(width, height, points)
+        if selection.mask.size:
+            cv2.fillPoly(selection.mask, [points - (selection.x, selection.y)], 255)
+        return selection
+
+    # Filled rectangle between two corners (x1, y1, x2, y2), both included
+    @classmethod
+    def rectangle(cls, width, height, coords):
+        x1, y1, x2, y2 = (int(c) for c in coords)
+        selection = cls._bbox_of(width, height, [[x1, y1], [x2, y2]])
+        selection.mask[...] = 255
+        return selection
+
+    # Empty mask covering the bounding box of points, clipped to the canvas
+    @classmethod
+    def _bbox_of(cls, width, height, points):
+        points = np.asarray(points)
+        x0, y0 = np.maximum(points.min(axis=0), 0)
+        x1, y1 = np.minimum(points.max(axis=0) + 1, (width, height))
+        if x1 <= x0 or y1 <= y0:
+            return cls(width, height)
+        return cls(width, height, x0, y0, np.zeros((y1 - y0, x1 - x0), np.uint8))
+
+    # (x, y, w, h) of the stored part of the mask
+    def bbox(self):
+        h, w = self.mask.shape
+        return self.x, self.y, w, h
+
+    # img (canvas sized) with everything outside the selection blacked out
+    def apply_to_image(self, img):
+        return cv2.bitwise_and(img, img, mask=self.full())
+
+    # The mask as a whole canvas
+    def full(self):
+        mask = np.zeros((self.height, self.width), np.uint8)
+        h, w = self.mask.shape
+        mask[self.y:self.y + h, self.x:self.x + w] = self.mask
+        return mask
+
+    # base64 PNG of the whole canvas
+    def encode(self):
+        _, buffer = cv2.imencode('.png', self.full())
+        return base64.b64encode(buffer).decode('utf-8')
+
+    # Mask of rect (x, y, w, h), zero outside the stored bounding box
+    def crop(self, rect):
+        x, y, w, h = rect
+        out = np.zeros((h, w), np.uint8)
+        ix, iy, iw, ih = _intersect(rect, self.bbox())
+        if iw and ih:
+            out[iy - y:iy - y + ih, ix - x:ix - x + iw] = self.mask[iy - self.y:iy - self.y + ih, ix - self.x:ix - self.x + iw]
+        return out
+
+    # The same selection with the bounding box shrunk to the selected pixels
+    def trim(self):
+        x, y, w, h = cv2.boundingRect(self.mask) if self.mask.size else (0, 0, 0, 0)
+        if not w:
+            return SelectionMask(self.width, self.height)
+        return SelectionMask(self.width, self.height, self.x + x, self.y + y, self.mask[y:y + h, x:x + w])
+
+    # True when the stored mask is a uint8 mask of 0 and 255 inside the canvas
+    def validate(self):
+        h, w = self.mask.shape if self.mask.ndim == 2 else (0, 0)
+        return (self.mask.ndim == 2 and self.mask.dtype == np.uint8 and self.is_hard()
+                and 0 <= self.x and self.x + w <= self.width and 0 <= self.y and self.y + h <= self.height)
+
+    def is_empty(self):
+        return not self.mask.any()
+
+    # True when every pixel is fully selected or not, so the mask fits in bits
+    def is_hard(self):
+        return bool(((self.mask == 0) | (self.mask == 255)).all())
+
+    # other combined with this selection, mode is one of MODES
+    def combine(self, other, mode):
+        if mode == "replace":
+            return other
+        if mode == "add":
+            rect = _union(self.bbox(), other.bbox())
+            mask = np.maximum(self.crop(rect), other.crop(rect))
+        elif mode == "intersect":
+            rect = _intersect(self.bbox(), other.bbox())
+            mask = np.minimum(self.crop(rect), other.crop(rect))
+        elif mode == "subtract":
+            rect = self.bbox()
+            mask = np.minimum(self.mask, 255 - other.crop(rect))
+        else:
+            raise ValueError(f"Unknown selection mode: {mode}")
+        return SelectionMask(self.width, self.height, rect[0], rect[1], mask).trim()
+
+    def invert(self):
+        return SelectionMask(self.width, self.height, 0, 0, 255 - self.full()).trim()
+
+    # Grown (radius > 0) or shrunk (radius < 0) by radius pixels, with a round brush.
+    # The canvas border counts as selected when shrinking
+    def grow(self, radius):
+        radius = int(radius)
+        if not radius or self.is_empty():
+            return self
+        rect = self._expanded(abs(radius))
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * abs(radius) + 1, 2 * abs(radius) + 1))
+        morph = cv2.dilate if radius > 0 else cv2.erode
+        return SelectionMask(self.width, self.height, rect[0], rect[1], morph(self.crop(rect), kernel)).trim()
+
+    # Edges blurred over about radius pixels
+    def feather(self, radius):
+        radius = int(radius)
+        if radius <= 0 or self.is_empty():
+            return self
+        rect = self._expanded(radius)
+        mask = cv2.GaussianBlur(self.crop(rect), (2 * radius + 1, 2 * radius + 1), 0, borderType=cv2.BORDER_REPLICATE)
+        return SelectionMask(self.width, self.height, rect[0], rect[1], mask).trim()
+
+    # Part of other that differs from this selection, as a mask of its bounding box
+    def changes_to(self, other):
+        rect = _union(self.bbox(), other.bbox())
+        after = other.crop(rect)
+        x, y, w, h = cv2.boundingRect((self.crop(rect) != after).astype(np.uint8)) if after.size else (0, 0, 0, 0)
+        if not w:
+            return SelectionMask(self.width, self.height)
+        return SelectionMask(self.width, self.height, rect[0] + x, rect[1] + y, after[y:y + h, x:x + w])
+
+    def _expanded(self, radius):
+        x, y, w, h = self.bbox()
+        return _intersect((x - radius, y - radius, w + 2 * radius, h + 2 * radius), (0, 0, self.width, self.height))
+
+    def runs(self):
+        flat = self.mask.ravel() >= 128
+        if not flat.size:
+            return []
+        ends = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+        runs = np.diff(np.concatenate(([0], ends, [flat.size])))
+        if flat[0]:
+            runs = np.concatenate(([0], runs))
+        return runs.tolist()
+
+    def packed(self):
+        x, y, w, h = self.bbox()
+        return _HEADER.pack(self.width, self.height, x, y, w, h) + np.packbits(self.mask >= 128, axis=1).tobytes()
+
+    @classmethod
+    def from_packed(cls, data):
+        width, height, x, y, w, h = _HEADER.unpack_from(data)
+        bits = np.frombuffer(data, np.uint8, offset=_HEADER.size).reshape(h, -1) if h else np.zeros((0, 0), np.uint8)
+        mask = np.unpackbits(bits, axis=1, count=w) * np.uint8(255)
+        return cls(width, height, x, y, mask.reshape(h, w))
+
+    # JSON body in format "png" or "rle"
+    def as_json(self, format="png"):
+        if format == "rle":
+            return {"size": [self.width, self.height], "bbox": list(self.bbox()), "runs": self.runs()}
+        return {"mask": self.encode()}
+
+
+def _union(a, b):
+    if not (a[2] and a[3]):
+        return b
+    if not (b[2] and b[3]):
+        return a
+    x0, y0 = min(a[0], b[0]), min(a[1], b[1])
+    x1, y1 = max(a[0] + a[2], b[0] + b[2]), max(a[1] + a[3], b[1] + b[3])
+    return x0, y0, x1 - x0, y1 - y0
 
-    def encode(self) -> str:
-        _, buffer = cv2.imencode('.png', self.mask)
-        return base64.b64encode(buffer).decode('utf-8') # Encode mask as base64 PNG to send over api
 
-    def validate(self) -> bool:
-        return self.mask.ndim == 2 and self.mask.dtype == np.uint8 and np.all((self.mask == 0) | (self.mask == 255)) # checks if valid mask
\ No newline at end of file
+def _intersect(a, b):
+    x0, y0 = max(a[0], b[0]), max(a[1], b[1])
+    x1, y1 = min(a[0] + a[2], b[0] + b[2]), min(a[1] + a[3], b[1] + b[3])
+    if x1 <= x0 or y1 <= y0:
+        return 0, 0, 0, 0
+    return x0, y0, x1 - x0, y1 - y0
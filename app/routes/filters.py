@@ -1,9 +1,71 @@
 # Endpoints for image filters (blur, sharpen, grayscale, etc.).
+# Filters run on the selected layer, inside the active selection if there is one.
+# /apply takes a chain of filters, the other routes one filter with its parameters
+# in the request body, see services/filters.py
 
-from flask import Blueprint, jsonify
+from flask import Blueprint, jsonify, request, session
+from app.models.AdjustmentLayer import AdjustmentLayer
+from app.services import exporter, filters, selections
+from app.services.stack_cache import stacks
 
-bp = Blueprint("filters", __name__)  # Bytt ut med riktig navn/funksjon
+bp = Blueprint("filters", __name__)
 
-@bp.get("/_stub")
-def _stub():
-    return jsonify({"ok": False, "message": "Not implemented yet"}), 501
+def _run(chain):
+    pid = session.get("pid")
+    if not pid:
+        return jsonify({"error": "Not logged in / missing pid"}), 401
+    try:
+        stages = filters.compile_chain(chain)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    with stacks.edit(pid) as stack:
+        if stack is None:
+            return jsonify({"error": f"Layer stack not found for project: {pid}"}), 404
+        layer = stack.get_current_layer()
+        if layer == 0:
+            return jsonify({"error": "Selected layer invalid"}), 400
+        if isinstance(layer, AdjustmentLayer):
+            return jsonify({"error": "Selected layer is an adjustment layer, it has no pixels to filter"}), 400
+
+        h, w = layer.pixels().shape[:2]
+        selection = selections.active(pid, w, h)
+        rect, mask = (None, None) if selection.is_empty() else (selection.bbox(), selection.mask)
+        with stack.record_pixels(rect):
+            rect = filters.apply_stages(layer.get_image(), stages, rect, mask)
+            layer.mark_dirty(rect)
+        exporter.export_layers(stack, stacks.layers_folder(pid))
+    return jsonify({"status": "ok", "rect": list(rect)}), 200
+
+@bp.post("/apply")
+def apply():
+    data = request.get_json(silent=True) or {}
+    chain = data.get("filters")
+    if not isinstance(chain, list) or not all(isinstance(x, dict) for x in chain):
+        return jsonify({"error": "filters must be a list of {\"name\": ..., parameters}"}), 400
+    return _run(chain)
+
+# One route per filter, the body holds its parameters
+def _single(name):
+    data = request.get_json(silent=True) or {}
+    return _run([{**data, "name": name}])
+
+@bp.post("/grayscale")
+def grayscale():
+    return _single("grayscale")
+
+@bp.post("/invert")
+def invert():
+    return _single("invert")
+
+@bp.post("/brightness-contrast")
+def brightness_contrast():
+    return _single("brightness_contrast")
+
+@bp.post("/gaussian")
+def gaussian():
+    return _single("gaussian")
+
+@bp.post("/sharpen")
+def sharpen():
+    return _single("sharpen")
@@ -1,97 +1,290 @@
 # Endpoints for adding/removing/renaming/compositing image layers.
 
-from flask import Blueprint, jsonify, session, request, redirect, url_for
-from app.models import LayerStack
+from flask import Blueprint, Response, jsonify, session, request
+from app.models.Layer import TILE_SIZE
+from app.services import encoding, exporter, pyramid
+from app.services.stack_cache import stacks
 
 bp = Blueprint("layers", __name__)
 
+def _missing(pid):
+    return jsonify({"error": f"Layer stack not found for project: {pid}"}), 404
+
 # Maybe unused
 @bp.get("/get_layers")
 def get_layers():
-    # load canvas from pickle in new storage folder
-    # save id in session
     pid = session["pid"]
-    stack = LayerStack.LayerStack(0, 0)
-    stack.load_pickle(f"users/{pid}/layers.pickle")
-    data = stack.get_as_json()
+    with stacks.view(pid) as stack:
+        if stack is None:
+            return _missing(pid)
+        data = stack.get_as_json()
     return jsonify(data), 200
 
 # Toggle visibility of layer i
 @bp.post("/update_visibility")
 def update_visibility():
     pid = session["pid"]
-    stack = LayerStack.LayerStack(0, 0)
-    stack.load_pickle(f"users/{pid}/layers.pickle")
-    try:
-        data = request.get_json()
-        index = data.get("index")
-        if index >= stack.size():
-            return jsonify({"error": "Index out of range"}), 500
-        stack.toggle_visible_at(index)
-        stack.save_pickle(f"users/{pid}/layers.pickle")
-        return jsonify({"status": "ok", "index": index}), 200
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    with stacks.edit(pid) as stack:
+        if stack is None:
+            return _missing(pid)
+        try:
+            data = request.get_json()
+            index = data.get("index")
+            if index >= stack.size():
+                return jsonify({"error": "Index out of range"}), 500
+            stack.toggle_visible_at(index)
+            return jsonify({"status": "ok", "index": index}), 200
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
 
 # Change active layer
 @bp.post("/update_active")
 def update_active():
     pid = session["pid"]
-    stack = LayerStack.LayerStack(0, 0)
-    stack.load_pickle(f"users/{pid}/layers.pickle")
+    with stacks.edit(pid) as stack:
+        if stack is None:
+            return _missing(pid)
+        try:
+            data = request.get_json()
+            index = data.get("index")
+            if index >= stack.size():
+                return jsonify({"error": "Index out of range"}), 500
+            stack.select_layer(index)
+            return jsonify({"status": "ok", "index": index}), 200
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+# All layers flattened. GET with optional
+#   x, y, w, h - viewport on the canvas, the whole canvas by default (or tile=row,col)
+#   scale      - 0 < scale <= 1, size of the result against the canvas
+#   format     - png (default), jpeg, webp or raw (see layer_raw)
+#   quality    - 1..100 for jpeg and webp
+#   deflate=1  - compress raw, when the client accepts deflate
+# Only the viewport is cut from the kept composite, or from its pyramid level for the
+# scale. The image is encoded after the stack is let go, and streamed
+@bp.get("/composite")
+def composite():
+    pid = session["pid"]
+    args = request.args
+    fmt = args.get("format", "png")
+    try:
+        scale = float(args.get("scale", 1))
+        quality = int(args.get("quality", 90))
+        if not 0 < scale <= 1:
+            raise ValueError("scale must be in (0, 1]")
+        if fmt not in encoding.FORMATS:
+            raise ValueError(f"format must be one of {', '.join(encoding.FORMATS)}")
+        if not 1 <= quality <= 100:
+            raise ValueError("quality must be in 1..100")
+        viewport = _viewport(args)
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": f"Bad composite request: {e}"}), 400
+    deflate = fmt == "raw" and _deflate(args)
+
+    with stacks.view(pid) as stack:
+        if stack is None:
+            return _missing(pid)
+        rect = _clip(viewport, stack)
+        if rect is None:
+            return jsonify({"error": "Viewport is outside the canvas"}), 400
+        etag = f"{stack.composite_tag()}-{'-'.join(map(str, rect))}-{scale}-{fmt}-{quality}-{int(deflate)}"
+        if request.if_none_match.contains(etag):
+            return _not_modified(etag)
+        image = pyramid.composite_region(pid, stack, rect, scale)
+
+    chunks = encoding.stream(image, fmt, quality, deflate)
+    return _image_response(chunks, fmt, etag, rect, image.shape, deflate)
+
+# Layer i as raw pixels, for drawing with putImageData without decoding a PNG.
+# GET with the optional viewport (or tile) and deflate of composite. The body is RGBA,
+# 4 bytes per pixel, rows top to bottom; X-Width, X-Height and X-Stride (bytes per row)
+# give its layout and X-Rect where it is on the canvas. The pixels are swizzled to RGBA
+# once while the stack is held, and sent from that buffer
+@bp.get("/<int:i>/raw")
+def layer_raw(i):
+    pid = session["pid"]
     try:
-        data = request.get_json()
-        index = data.get("index")
-        if index >= stack.size():
-            return jsonify({"error": "Index out of range"}), 500
-        stack.select_layer(index)
-        stack.save_pickle(f"users/{pid}/layers.pickle")
-        return jsonify({"status": "ok", "index": index}), 200
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        viewport = _viewport(request.args)
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": f"Bad raw request: {e}"}), 400
+    deflate = _deflate(request.args)
+
+    with stacks.view(pid) as stack:
+        if stack is None:
+            return _missing(pid)
+        if not 0 <= i < stack.size():
+            return jsonify({"error": "Index out of range"}), 404
+        rect = _clip(viewport, stack)
+        if rect is None:
+            return jsonify({"error": "Viewport is outside the canvas"}), 400
+        etag = f"{stack.layer_tag(i)}-{'-'.join(map(str, rect))}-{int(deflate)}"
+        if request.if_none_match.contains(etag):
+            return _not_modified(etag)
+        x, y, w, h = rect
+        rgba = encoding.to_rgba(stack.layer_image(i)[y:y + h, x:x + w])
+
+    response = _image_response(encoding.raw_chunks(rgba, deflate), "raw", etag, rect, rgba.shape, deflate)
+    if not deflate:
+        response.content_length = rgba.nbytes
+    return response
+
+# [x, y, w, h] from the query, from tile=row,col, or None for the whole canvas
+def _viewport(args):
+    if "tile" in args:
+        row, col = (int(v) for v in args["tile"].split(","))
+        return [col * TILE_SIZE, row * TILE_SIZE, TILE_SIZE, TILE_SIZE]
+    viewport = [args.get(k) for k in ("x", "y", "w", "h")]
+    return None if viewport == [None] * 4 else [int(v) for v in viewport]
+
+# viewport clipped to the canvas of stack as (x, y, w, h), None if nothing is left
+def _clip(viewport, stack):
+    height, width = stack.shape()
+    x, y, w, h = viewport or (0, 0, width, height)
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + w, width), min(y + h, height)
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return x0, y0, x1 - x0, y1 - y0
+
+def _deflate(args):
+    return args.get("deflate") == "1" and request.accept_encodings["deflate"] > 0
+
+def _image_response(chunks, fmt, etag, rect, shape, deflate):
+    response = Response(chunks, mimetype=encoding.FORMATS[fmt])
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    response.vary.add("Accept-Encoding")
+    if deflate:
+        response.content_encoding = "deflate"
+    # Where the image is on the canvas, and its layout
+    response.headers["X-Rect"] = ",".join(map(str, rect))
+    response.headers["X-Width"], response.headers["X-Height"] = str(shape[1]), str(shape[0])
+    if fmt == "raw":
+        response.headers["X-Stride"] = str(shape[1] * 4)
+    return response
+
+def _not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
 
 # Creates new layer
 @bp.post("/add_layer")
 def add_layer():
     pid = session["pid"]
-    stack = LayerStack.LayerStack(0, 0)
-    stack.load_pickle(f"users/{pid}/layers.pickle")
-    stack.create_layer()
-    stack.save_pickle(f"users/{pid}/layers.pickle")
+    with stacks.edit(pid) as stack:
+        if stack is None:
+            return _missing(pid)
+        stack.create_layer()
+        # The new layer needs a LayerN.png to be shown
+        exporter.export_layers(stack, stacks.layers_folder(pid))
+    return jsonify({"status": "ok"}), 200
+
+# Creates an adjustment layer on top, {"kind": "levels" | "hue_saturation" | "blur",
+# "params": {...}}. It changes the look of every layer below it without changing them
+@bp.post("/adjustment")
+def add_adjustment_layer():
+    pid = session["pid"]
+    data = request.get_json(silent=True) or {}
+    with stacks.edit(pid) as stack:
+        if stack is None:
+            return _missing(pid)
+        try:
+            stack.create_adjustment_layer(str(data.get("kind")), data.get("params"))
+        except (TypeError, ValueError) as e:
+            return jsonify({"error": str(e)}), 400
+        exporter.export_layers(stack, stacks.layers_folder(pid))
+    return jsonify({"status": "ok"}), 200
+
+# Changes parameters of the selected adjustment layer, {"params": {...}}
+@bp.post("/adjustment/params")
+def set_adjustment_params():
+    pid = session["pid"]
+    data = request.get_json(silent=True) or {}
+    params = data.get("params")
+    if not isinstance(params, dict):
+        return jsonify({"error": "params must be an object"}), 400
+    with stacks.edit(pid) as stack:
+        if stack is None:
+            return _missing(pid)
+        try:
+            if not stack.set_adjustment_params(params):
+                return jsonify({"error": "Selected layer is not an adjustment layer"}), 400
+        except (TypeError, ValueError) as e:
+            return jsonify({"error": str(e)}), 400
+        exporter.export_layers(stack, stacks.layers_folder(pid))
     return jsonify({"status": "ok"}), 200
 
 # Deletes layer at i
 @bp.post("/delete_layer")
 def delete_layer():
     pid = session["pid"]
-    stack = LayerStack.LayerStack(0, 0)
-    stack.load_pickle(f"users/{pid}/layers.pickle")
-    stack.delete_selected_layer()
-    stack.save_pickle(f"users/{pid}/layers.pickle")
+    with stacks.edit(pid) as stack:
+        if stack is None:
+            return _missing(pid)
+        stack.delete_selected_layer()
+        # Layers above it moved to other LayerN.png names
+        exporter.export_layers(stack, stacks.layers_folder(pid))
     return jsonify({"status": "ok"}), 200
 
 # Duplicates layer i, and adds new layer at i+1
 @bp.post("/duplicate_layer")
 def duplicate_layer():
     pid = session["pid"]
-    stack = LayerStack.LayerStack(0, 0)
-    stack.load_pickle(f"users/{pid}/layers.pickle")
-    stack.duplicate_selected_layer()
-    stack.save_pickle(f"users/{pid}/layers.pickle")
+    with stacks.edit(pid) as stack:
+        if stack is None:
+            return _missing(pid)
+        stack.duplicate_selected_layer()
+        # Layers above it moved to other LayerN.png names
+        exporter.export_layers(stack, stacks.layers_folder(pid))
     return jsonify({"status": "ok"}), 200
 
 # Rename currently selected layer
 @bp.post("/rename_layer")
 def rename_layer():
     pid = session["pid"]
-    stack = LayerStack.LayerStack(0, 0)
-    stack.load_pickle(f"users/{pid}/layers.pickle")
-    try:
-        data = request.get_json()
-        new_name = data.get("name")
-        layer = stack.get_current_layer()
-        layer.rename(new_name)
-        stack.save_pickle(f"users/{pid}/layers.pickle")
-        return jsonify({"status": "ok", "name": new_name}), 200
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
\ No newline at end of file
+    with stacks.edit(pid) as stack:
+        if stack is None:
+            return _missing(pid)
+        try:
+            data = request.get_json()
+            new_name = data.get("name")
+            stack.rename_current_layer(new_name)
+            return jsonify({"status": "ok", "name": new_name}), 200
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+# Undo the last stroke, fill or layer operation
+@bp.post("/undo")
+def undo():
+    return _step_history(lambda stack: stack.undo(), "Nothing to undo")
+
+# Redo the last undone change
+@bp.post("/redo")
+def redo():
+    return _step_history(lambda stack: stack.redo(), "Nothing to redo")
+
+# Layer PNGs are exported again so the page shows the restored pixels
+def _step_history(step, nothing):
+    pid = session["pid"]
+    with stacks.edit(pid) as stack:
+        if stack is None:
+            return _missing(pid)
+        if not step(stack):
+            return jsonify({"error": nothing, **stack.history().as_json()}), 400
+        exporter.export_layers(stack, stacks.layers_folder(pid))
+        return jsonify({"status": "ok", **stack.history().as_json()}), 200
+
+# Write the project back to disk now instead of waiting for the cache to do it
+@bp.post("/save")
+def save():
+    pid = session["pid"]
+    if not stacks.save(pid):
+        return jsonify({"error": "Failed to save layer stack"}), 500
+    return jsonify({"status": "ok"}), 200
+
+# Hit/miss/eviction counters of the layer stack cache
+@bp.get("/cache_stats")
+def cache_stats():
+    return jsonify(stacks.stats()), 200
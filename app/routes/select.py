@@ -1,20 +1,60 @@
 # Endpoints for selection operations.
 # Example: /api/v1/select/rect, /api/v1/select/freeform, etc.
 
-from flask import Blueprint, jsonify, request
-from ..services.imaging import rectangular_select, freeform_select, polygonal_select, magic_lasso_select # actual functions
+from flask import Blueprint, Response, jsonify, request, session
+from ..services import selections
+from ..models.selection import FORMATS, MODES, SelectionMask
+from ..services.imaging import image_size, rectangular_select, freeform_select, polygonal_select, magic_lasso_select, live_wire_path, live_wire_select # actual functions
 
 bp = Blueprint("select", __name__) # Blueprint for selection routes (dont really understand how this works cuz web app doesnt load when i use these routes)
 
-# 4 routes for 4 selection types
+# Masks are sent as a full-canvas PNG by default. ?format=rle gives the run lengths of
+# the selection's bounding box as JSON, and ?format=packed (or Accept: application/octet-stream)
+# the bounding box as bits, see models/selection.py
+def _mask_format():
+    fmt = request.args.get("format")
+    if fmt is None:
+        best = request.accept_mimetypes.best_match(["application/json", "application/octet-stream"])
+        fmt = "packed" if best == "application/octet-stream" else "png"
+    return fmt
+
+# Format and selection mode of the request, or an error response
+def _options(data):
+    fmt = _mask_format()
+    if fmt not in FORMATS:
+        return None, (jsonify({"error": f"Unknown mask format: {fmt}"}), 400)
+    if data.get("mode", "replace") not in MODES:
+        return None, (jsonify({"error": f"Unknown selection mode: {data['mode']}"}), 400)
+    return fmt, None
+
+def _mask_response(selection, fmt):
+    if fmt == "packed":
+        return Response(selection.packed(), mimetype="application/octet-stream"), 200
+    return jsonify(selection.as_json(fmt)), 200
+
+# Every selection becomes the project's active selection, combined with the one before
+# by data["mode"] (replace, add, subtract or intersect). With a mode only the changed
+# region is sent back, without one the whole new selection is, as before
+def _store(selection, data, fmt):
+    mode = data.get("mode", "replace")
+    changed, new = selections.update(session.get("pid"), selection.width, selection.height,
+                                     lambda active: active.combine(selection, mode))
+    return _mask_response(changed if "mode" in data else new, fmt)
+
+# One route per selection type
 @bp.post("/rect")
 def rect():
     data = request.json # get json data from request
     if not data or 'image_id' not in data or 'coords' not in data:
         return jsonify({"error": "Missing image_id or coords (x1, y1, x2, y2)"}), 400 # error if missing data
+    fmt, error = _options(data)
+    if error:
+        return error
     try:
-        mask_data = rectangular_select(data['image_id'], data['coords']) # call function from imaging.py
-        return jsonify({"mask": mask_data}), 200 # return mask data as json
+        selection = rectangular_select(data['image_id'], data['coords']) # call function from imaging.py
+        return _store(selection, data, fmt) # remember it and return mask in the requested format
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 404 # no project, or no such layer
     except Exception as e:
         return jsonify({"error": str(e)}), 500 # error if exception
 
@@ -24,9 +64,14 @@ def freeform():
     data = request.json 
     if not data or 'image_id' not in data or 'path' not in data:
         return jsonify({"error": "Missing image_id or path (list of [x,y] points)"}), 400
+    fmt, error = _options(data)
+    if error:
+        return error
     try:
-        mask_data = freeform_select(data['image_id'], data['path'])
-        return jsonify({"mask": mask_data}), 200
+        selection = freeform_select(data['image_id'], data['path'])
+        return _store(selection, data, fmt)
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 404
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -36,9 +81,14 @@ def polygonal():
     data = request.json
     if not data or 'image_id' not in data or 'vertices' not in data:
         return jsonify({"error": "Missing image_id or vertices (list of [x,y] points)"}), 400
+    fmt, error = _options(data)
+    if error:
+        return error
     try:
-        mask_data = polygonal_select(data['image_id'], data['vertices'])
-        return jsonify({"mask": mask_data}), 200
+        selection = polygonal_select(data['image_id'], data['vertices'])
+        return _store(selection, data, fmt)
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 404
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -49,8 +99,83 @@ def magic_lasso():
     data = request.json
     if not data or 'image_id' not in data or 'seed_points' not in data:
         return jsonify({"error": "Missing image_id or seed_points (list of [x,y] for path snapping)"}), 400
+    fmt, error = _options(data)
+    if error:
+        return error
+    try:
+        selection = magic_lasso_select(data['image_id'], data['seed_points'])
+        return _store(selection, data, fmt)
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 404
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Intelligent scissors. With anchor and cursor it returns the preview path from the last
+# anchor to the cursor, which is fast enough to call on every mouse move.
+# With anchors it returns the mask of the closed path through all of them
+@bp.post("/live-wire")
+def live_wire():
+    data = request.json
+    if not data or 'image_id' not in data or not ('anchors' in data or ('anchor' in data and 'cursor' in data)):
+        return jsonify({"error": "Missing image_id and anchor + cursor, or anchors (list of [x,y])"}), 400
+    fmt, error = _options(data)
+    if error:
+        return error
     try:
-        mask_data = magic_lasso_select(data['image_id'], data['seed_points'])
-        return jsonify({"mask": mask_data}), 200
+        if 'anchors' in data:
+            if len(data['anchors']) < 2:
+                return jsonify({"error": "Need at least two anchors"}), 400
+            return _store(live_wire_select(data['image_id'], data['anchors']), data, fmt)
+        return jsonify({"path": live_wire_path(data['image_id'], data['anchor'], data['cursor'])}), 200
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 404
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
\ No newline at end of file
+        return jsonify({"error": str(e)}), 500
+
+# The active selection, whole
+@bp.get("/active")
+def active():
+    fmt, error = _options({})
+    if error:
+        return error
+    try:
+        height, width = image_size(request.args.get("image_id", "composite"))
+        return _mask_response(selections.active(session.get("pid"), width, height), fmt)
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 404
+
+# Operations on the active selection. Each returns only the region that changed
+def _selection_op(change):
+    data = request.get_json(silent=True) or {}
+    fmt, error = _options(data)
+    if error:
+        return error
+    try:
+        radius = int(data.get("radius", 1))
+        height, width = image_size(data.get("image_id", "composite"))
+        changed, _ = selections.update(session.get("pid"), width, height, lambda active: change(active, radius))
+        return _mask_response(changed, fmt)
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 404
+
+@bp.post("/invert")
+def invert():
+    return _selection_op(lambda active, radius: active.invert())
+
+@bp.post("/grow")
+def grow():
+    return _selection_op(lambda active, radius: active.grow(radius))
+
+@bp.post("/shrink")
+def shrink():
+    return _selection_op(lambda active, radius: active.grow(-radius))
+
+@bp.post("/feather")
+def feather():
+    return _selection_op(lambda active, radius: active.feather(radius))
+
+@bp.post("/clear")
+def clear():
+    return _selection_op(lambda active, radius: SelectionMask(active.width, active.height))
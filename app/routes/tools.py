@@ -1,66 +1,32 @@
 from flask import Blueprint, jsonify, request, session
-from app.models.LayerStack import LayerStack
-from app.services.tools import tool_brush, tool_eraser, tool_bucket
-import os
-import cv2
-import numpy as np
+from app.models.AdjustmentLayer import AdjustmentLayer
+from app.services import exporter, fill, strokes
+from app.services.stack_cache import stacks
+from app.services.tools import brush, eraser, hex_to_bgr, stroke_rect
+import json
+import time
 
 bp = Blueprint("tools", __name__)
 
-# Load LayerStack, validate selected layer
-def _get_layer_stack(pid):
-    pickle_path = os.path.join("users", pid, "layers.pickle")
-    if not os.path.exists(pickle_path):
-        return None, jsonify({"error": f"Layer stack not found: {pickle_path}"}), 404
-    
-    stack = LayerStack(0, 0)
-    if not stack.load_pickle(pickle_path):
-        return None, jsonify({"error": "Failed to load LayerStack pickle"}), 500
-    
+# Validate the checked out LayerStack and its selected layer
+def _check_layer_stack(pid, stack):
+    if stack is None:
+        return jsonify({"error": f"Layer stack not found: {stacks.path(pid)}"}), 404
+
     if stack.get_current_layer() == 0:
-        return None, jsonify({"error": "Selected layer invalid"}), 400
-    
-    return stack, None, None
+        return jsonify({"error": "Selected layer invalid"}), 400
 
-# Ensure layer PNG exists, create if missing
-def _ensure_layer_png(pid, stack, idx):
-    layers_dir = os.path.join("users", pid, "layers")
-    os.makedirs(layers_dir, exist_ok=True)
-    layer_path = os.path.join(layers_dir, f"Layer{idx}.png")
-    
-    if not os.path.exists(layer_path):
-        layer = stack.get_current_layer()
-        arr = layer.get_image()
-        if arr is None:
-            h, w = stack._height, stack._width
-            arr = np.zeros((h, w, 4), dtype=np.uint8)
-        if arr.ndim == 2:
-            arr = cv2.cvtColor(arr, cv2.COLOR_GRAY2BGRA)
-        elif arr.shape[2] == 3:
-            bgra = np.zeros((arr.shape[0], arr.shape[1], 4), dtype=np.uint8)
-            bgra[:, :, :3] = arr
-            arr = bgra
-        cv2.imwrite(layer_path, arr)
-    
-    return layer_path
+    if isinstance(stack.get_current_layer(), AdjustmentLayer):
+        return jsonify({"error": "Selected layer is an adjustment layer, it has no pixels to draw on"}), 400
 
+    return None
 
-def _update_and_save(stack, layer_path, pickle_path):
-    img = cv2.imread(layer_path, cv2.IMREAD_UNCHANGED)
-    if img is None:
-        return jsonify({"error": f"Failed to reload edited PNG: {layer_path}"}), 500
-    
-    if img.ndim == 2:
-        img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGRA)
-    elif img.shape[2] == 3:
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2BGRA)
-    
-    stack.get_current_layer().update(img)
-    
-    if not stack.save_pickle(pickle_path):
-        return jsonify({"status": "ok", "warning": "PNG updated but pickle save failed"}), 200
-    
-    return jsonify({"status": "ok"}), 200
+# Tools draw straight into the selected layer's pixels. The layer PNG shown by the
+# editor is written afterwards on the export thread, and the stack cache writes the
+# project to disk later
+def _layer_changed(pid, stack, rect):
+    exporter.export_layers(stack, stacks.layers_folder(pid))
+    return jsonify({"status": "ok", "rect": None if rect is None else list(rect)}), 200
 
 
 @bp.post("/stroke")
@@ -82,27 +48,110 @@ def stroke():
     if len(points) < 2:
         return jsonify({"error": "Need at least two points"}), 400
 
-    # Load stack
-    stack, error_response, status_code = _get_layer_stack(pid)
-    if stack is None:
-        return error_response, status_code
+    with stacks.edit(pid) as stack:
+        error = _check_layer_stack(pid, stack)
+        if error:
+            return error
 
-    # Ensure PNG exists
-    idx = stack._selected_layer
-    layer_path = _ensure_layer_png(pid, stack, idx)
+        layer = stack.get_current_layer()
+        h, w = layer.pixels().shape[:2]
+
+        # Execute tool
+        try:
+            with stack.record_pixels(stroke_rect(points, size, h, w)):
+                if tool == "eraser":
+                    rect = eraser(layer.get_image(), size, points)
+                else:
+                    rect = brush(layer.get_image(), color, size, points)
+                layer.mark_dirty(rect)
+        except Exception as e:
+            return jsonify({"error": f"Tool '{tool}' failed: {e}"}), 500
+
+        return _layer_changed(pid, stack, rect)
+
+
+# Stroke points as NDJSON, one JSON value per line, drawn as they arrive.
+# The first line names the stroke and tool: {"stroke": id, "tool", "color", "size"}.
+# Further lines hold {"points": [[x, y], ...]} or a single [x, y] point, and
+# {"end": true} finishes the stroke. A stroke can be sent as one chunked request, or
+# as several requests that repeat the header line with the same stroke id.
+# Points that arrive close together are drawn in one pass
+@bp.post("/stroke/stream")
+def stroke_stream():
+    pid = session.get("pid")
+    if not pid:
+        return jsonify({"error": "Not logged in / missing pid"}), 401
 
-    # Execute tool
+    header = {}
     try:
-        if tool == "eraser":
-            tool_eraser(layer_path, size, points)
+        return _stream_stroke(pid, header)
+    except BaseException:
+        # Reading failed, e.g. the connection dropped: no end line is coming
+        if header.get("stroke"):
+            strokes.close(pid, header["stroke"])
+        raise
+
+def _stream_stroke(pid, header):
+    pending = []
+    ended = False
+    current = None
+    last_draw = time.monotonic()
+    for raw in request.stream:
+        line = raw.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+            if isinstance(item, dict):
+                for key in ("stroke", "tool", "color", "size"):
+                    if key in item:
+                        header[key] = item[key]
+                pending.extend(_points(item.get("points") or []))
+                ended = ended or bool(item.get("end"))
+            else:
+                pending.extend(_points([item]))
+        except (TypeError, ValueError) as e:
+            return jsonify({"error": f"Bad stroke line: {e}"}), 400
+
+        if time.monotonic() - last_draw >= strokes.COALESCE_SECONDS:
+            current, error = _draw_streamed(pid, header, pending, False)
+            if error:
+                return error
+            pending = []
+            last_draw = time.monotonic()
+
+    current, error = _draw_streamed(pid, header, pending, ended)
+    if error:
+        return error
+    return jsonify({"status": "ok", **current.as_json()}), 200
+
+def _points(points):
+    return [[int(x), int(y)] for x, y in points]
+
+def _draw_streamed(pid, header, points, end):
+    # Other strokes are ended here, this one carries on
+    with stacks.edit(pid, hooks=False) as stack:
+        error = _check_layer_stack(pid, stack)
+        if error:
+            return None, error
+        strokes.end_open(pid, stack, keep=header.get("stroke"))
+        try:
+            size = int(header.get("size", 5))
+        except (TypeError, ValueError):
+            size = 5
+        current = strokes.session(pid, stack, header.get("stroke"), tool=header.get("tool", "brush"),
+                                  color=header.get("color", "#000000"), size=size)
+        header["stroke"] = current.id
+        try:
+            current.draw(points)
+        except Exception as e:
+            strokes.end(stack, current)
+            return None, (jsonify({"error": f"Tool '{current.tool}' failed: {e}"}), 500)
+        if end:
+            strokes.end(stack, current)
         else:
-            tool_brush(layer_path, color, size, points)
-    except Exception as e:
-        return jsonify({"error": f"Tool '{tool}' failed: {e}"}), 500
-
-    # Update and save
-    pickle_path = os.path.join("users", pid, "layers.pickle")
-    return _update_and_save(stack, layer_path, pickle_path)
+            current.export(stack)
+        return current, None
 
 
 @bp.post("/bucket_fill")
@@ -114,36 +163,40 @@ def bucket_fill():
     data = request.get_json() or {}
     color = data.get("color", "#000000")
     start_point = data.get("start_point")
+    # contiguous=False fills every pixel of a similar color, not only the clicked region
+    contiguous = bool(data.get("contiguous", True))
+    try:
+        tolerance = int(data.get("tolerance", 10))
+    except (TypeError, ValueError):
+        return jsonify({"error": "tolerance must be a number"}), 400
 
     # Validate input
     if not (isinstance(start_point, (list, tuple)) and len(start_point) == 2):
         return jsonify({"error": "start_point must be [x, y]"}), 400
 
-    # Load stack
-    stack, error_response, status_code = _get_layer_stack(pid)
-    if stack is None:
-        return error_response, status_code
-
-    # Ensure PNG exists
-    idx = stack._selected_layer
-    layer_path = _ensure_layer_png(pid, stack, idx)
-
-    # Bounds check
-    probe = cv2.imread(layer_path, cv2.IMREAD_UNCHANGED)
-    if probe is None:
-        return jsonify({"error": f"Failed to open {layer_path}"}), 500
-    
-    h, w = probe.shape[:2]
-    x, y = map(int, start_point)
-    if not (0 <= x < w and 0 <= y < h):
-        return jsonify({"error": f"start_point out of bounds: ({x},{y})"}), 400
+    with stacks.edit(pid) as stack:
+        error = _check_layer_stack(pid, stack)
+        if error:
+            return error
 
-    # Execute bucket fill
-    try:
-        tool_bucket(layer_path, color, [x, y])
-    except Exception as e:
-        return jsonify({"error": f"Bucket failed: {e}"}), 500
+        layer = stack.get_current_layer()
 
-    # Update and save
-    pickle_path = os.path.join("users", pid, "layers.pickle")
-    return _update_and_save(stack, layer_path, pickle_path)
\ No newline at end of file
+        # Bounds check
+        h, w = layer.pixels().shape[:2]
+        x, y = map(int, start_point)
+        if not (0 <= x < w and 0 <= y < h):
+            return jsonify({"error": f"start_point out of bounds: ({x},{y})"}), 400
+
+        # Filled region from the layer's cached label map, then filled in place
+        try:
+            bgr = hex_to_bgr(color)
+            found = fill.region(layer, bgr, x, y, tolerance, contiguous)
+        except Exception as e:
+            return jsonify({"error": f"Bucket failed: {e}"}), 500
+
+        rect = None
+        if found is not None:
+            rect, mask = found
+            with stack.record_pixels(rect):
+                fill.apply(layer, rect, mask, bgr, tolerance)
+        return _layer_changed(pid, stack, rect)
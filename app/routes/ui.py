@@ -1,11 +1,13 @@
 # Renders HTML templates (e.g., / → index.html, /editor → editor.html).
 import os
 
+import cv2
 import numpy as np
-from flask import Blueprint, current_app, jsonify, render_template, session, redirect, url_for, send_from_directory
+from flask import Blueprint, Response, jsonify, render_template, request, session, redirect, url_for
 
 from app.models import LayerStack
-from app.services import storage
+from app.services import exporter, pyramid, storage
+from app.services.stack_cache import stacks
 
 bp = Blueprint("ui", __name__)
 
@@ -18,9 +20,11 @@ def routes():
     base = "/api/v1"
     return jsonify({
         "files":  [f"{base}/files/new", f"{base}/files/open", f"{base}/files/save"],
-        "layers": [f"{base}/layers/add", f"{base}/layers/remove", f"{base}/layers/list", f"{base}/layers/composite"],
+        "layers": [f"{base}/layers/add", f"{base}/layers/remove", f"{base}/layers/list", f"{base}/layers/composite",
+                   f"{base}/layers/<i>/raw", f"{base}/layers/adjustment", f"{base}/layers/adjustment/params"],
         "select": [f"{base}/select/rect", f"{base}/select/lasso"],
-        "filters":[f"{base}/filters/gaussian", f"{base}/filters/grayscale"],
+        "filters":[f"{base}/filters/apply", f"{base}/filters/gaussian", f"{base}/filters/grayscale", f"{base}/filters/sharpen",
+                   f"{base}/filters/brightness-contrast", f"{base}/filters/invert"],
         "tools":  [f"{base}/tools/brush", f"{base}/tools/eraser"],
         "health": f"{base}/health"
     })
@@ -34,17 +38,77 @@ def index():
 @bp.get("/editor")
 def editor():
     pid = session["pid"]
-    stack = LayerStack.LayerStack(0, 0)
-    stack.load_pickle(f"users/{pid}/layers.pickle")
-    data = stack.get_as_json()
+    with stacks.view(pid) as stack:
+        if stack is None:
+            return redirect(url_for("ui.index"))
+        data = stack.get_as_json()
     return render_template("editor.html", data=data)
 
-# Returns path to images in user storage for displaying canvas in frontend
+# Returns path to images in user storage for displaying canvas in frontend.
+# LayerN.png is layer N, composite.png all layers collapsed. The file names from
+# get_as_json carry the version of the image (LayerN.<tag>.png): those are cached by the
+# browser for good, any other name is checked with the ETag every time.
+# With ?scale= (the zoom times the device pixel ratio) the smallest pyramid level with
+# at least that resolution is sent, the editor stretches it to the canvas size
 @bp.get("/layer_img/<filename>")
 def layer_img(filename):
     pid = session["pid"]
-    user_folder = os.path.join(current_app.root_path, "..", "users", pid, "layers")
-    return send_from_directory(user_folder, filename)
+    name, _, tag = os.path.splitext(os.path.basename(filename))[0].partition(".")
+    try:
+        level = pyramid.level_for(request.args.get("scale", 1))
+    except ValueError:
+        return jsonify({"error": "scale must be a positive number"}), 400
+    folder = stacks.layers_folder(pid)
+
+    with stacks.view(pid) as stack:
+        if stack is None:
+            return jsonify({"error": f"Layer stack not found for project: {pid}"}), 404
+        index = name[len("Layer"):]
+        if name == "composite":
+            index, version = None, stack.composite_tag()
+        elif name.startswith("Layer") and index.isdigit() and int(index) < stack.size():
+            index = int(index)
+            version = stack.layer_tag(index)
+        else:
+            return jsonify({"error": f"Image not found: {filename}"}), 404
+        etag = f"{version}-{level}"
+        if request.if_none_match.contains(etag):
+            return _cached(Response(status=304), etag, tag == version)
+        queued = None
+        if level or index is None:
+            data = pyramid.png(pid, stack, index, level)
+        else:
+            # The PNG the edit routes export, exported now if the layer changed since.
+            # A written one is read before the stack is let go, so an edit cannot put
+            # newer pixels in the file under this etag. A queued one is waited for after,
+            # and its bytes taken from the export, with the pixels kept in case a newer
+            # export replaces it before it starts
+            path = os.path.join(folder, f"Layer{index}.png")
+            exporter.export_layers(stack, folder)
+            queued = exporter.pending(path)
+            if queued is None:
+                with open(path, "rb") as f:
+                    data = f.read()
+            else:
+                pixels = stack.layer_image(index, copy=True)
+
+    if queued is not None:
+        data = _export_result(queued, pixels)
+    return _cached(Response(data, mimetype="image/png"), etag, tag == version)
+
+# PNG bytes written by the export future, or encoded from pixels if it was cancelled
+# or failed
+def _export_result(future, pixels):
+    try:
+        return future.result()
+    except Exception:
+        return cv2.imencode(".png", pixels)[1].tobytes()
+
+# Strong ETag of the image version. Versioned names never change content
+def _cached(response, etag, versioned):
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, max-age=31536000, immutable" if versioned else "private, no-cache"
+    return response
 
 # Create user storage, create empty canvas, add bg and l1,
 # export images to user storage, save canvas in user storage
@@ -55,8 +119,9 @@ def open_new_project():
     # TODO: layer size based on user input
     stack = LayerStack.LayerStack(500, 500)
     stack.add_base_layers()
-    stack.create_images_from_layers_at(f"users/{pid}/layers")
-    stack.save_pickle(f"users/{pid}/layers.pickle")
+    stack.create_images_from_layers_at(stacks.layers_folder(pid))
+    stacks.put(pid, stack)
+    stacks.save(pid)
     return redirect(url_for("ui.editor"))
 
 
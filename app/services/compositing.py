@@ -0,0 +1,248 @@
+# Compositing engine used to flatten layer stacks.
+# Layers are straight-alpha BGRA uint8 images blended with the "over" operator.
+# Work is done block by block: blocks where the top layer is fully transparent are
+# skipped, fully opaque blocks are copied, and only the rest is blended in float32
+# (premultiply, add, divide by the new alpha) using scratch buffers that are reused
+# across blocks and layers.
+# Large frames are split into row bands that are blended on a thread pool. NumPy and
+# OpenCV release the GIL while they work, so the bands run on separate cores.
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+BLOCK_SIZE = 64
+
+_INV_255 = np.float32(1 / 255)
+
+# Frames with fewer rows than this are not worth splitting into bands
+MIN_BAND_ROWS = 2 * BLOCK_SIZE
+
+# Scratch buffers are per thread, so several requests can composite at once
+_local = threading.local()
+
+_workers = os.cpu_count() or 1
+_executor = None
+_executor_lock = threading.Lock()
+
+
+# Set the number of compositing threads. 1 turns the thread pool off
+def configure(workers=None):
+    global _workers, _executor
+    if workers is None:
+        return
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
+        _workers = max(int(workers), 1)
+
+
+def workers():
+    return _workers
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=_workers, thread_name_prefix="composite",
+                                           initializer=_mark_worker)
+        return _executor
+
+
+def _mark_worker():
+    _local.worker = True
+
+
+# Run fn on every item, on the thread pool unless there is only one worker or we
+# are already on a pool thread
+def parallel_map(fn, items):
+    items = list(items)
+    if _workers <= 1 or len(items) <= 1 or getattr(_local, "worker", False):
+        for item in items:
+            fn(item)
+        return
+    for future in [_get_executor().submit(fn, item) for item in items]:
+        future.result()
+
+
+# Row slices splitting h rows into about two bands per worker, on block boundaries
+def bands(h):
+    count = min(2 * _workers, max(h // MIN_BAND_ROWS, 1))
+    rows = -(-h // count)
+    rows = -(-rows // BLOCK_SIZE) * BLOCK_SIZE
+    return [slice(y, min(y + rows, h)) for y in range(0, h, rows)]
+
+
+class _Scratch:
+
+    def __init__(self, h, w):
+        self.shape = (h, w)
+        self.at = np.empty((h, w), np.float32)
+        self.k = np.empty((h, w), np.float32)
+        self.ao = np.empty((h, w), np.float32)
+
+
+# Scratch buffers at least h x w, grown when a bigger region comes along
+def _scratch(h, w):
+    scratch = getattr(_local, "scratch", None)
+    if scratch is None or scratch.shape[0] < h or scratch.shape[1] < w:
+        if scratch is not None:
+            h, w = max(h, scratch.shape[0]), max(w, scratch.shape[1])
+        scratch = _local.scratch = _Scratch(h, w)
+    return scratch
+
+
+# Lowest and highest alpha in every block of the image, as two (rows, cols) uint8 arrays.
+# Pixels are read as little-endian uint32 so alpha is the high byte, which lets
+# min/max run over whole pixels instead of a strided alpha channel
+def block_alpha_range(image, block=BLOCK_SIZE):
+    pixels = image.view("<u4")[:, :, 0]
+    h, w = pixels.shape
+    full = h // block
+    starts = np.arange(0, h, block)
+    lo = np.empty((len(starts), w), pixels.dtype)
+    hi = np.empty((len(starts), w), pixels.dtype)
+    if full:
+        rows = pixels[:full * block].reshape(full, block, w)
+        np.min(rows, axis=1, out=lo[:full])
+        np.max(rows, axis=1, out=hi[:full])
+    if h % block:
+        np.min(pixels[full * block:], axis=0, out=lo[full])
+        np.max(pixels[full * block:], axis=0, out=hi[full])
+    cols = np.arange(0, w, block)
+    lo = np.minimum.reduceat(lo, cols, axis=1)
+    hi = np.maximum.reduceat(hi, cols, axis=1)
+    return (lo >> 24).astype(np.uint8), (hi >> 24).astype(np.uint8)
+
+
+# Blend a region of src over dst, in place. Both are uint8 BGRA views of the same shape.
+# Alpha is kept in 0-255 float32: the top layer weighs at, the background shows through
+# with k = ab * (1 - at), and the new color is (ct * at + cb * k) / (at + k)
+def _blend_region(dst, src):
+    h, w = dst.shape[:2]
+    scratch = _scratch(h, w)
+    at = scratch.at[:h, :w]
+    k = scratch.k[:h, :w]
+    ao = scratch.ao[:h, :w]
+
+    np.copyto(at, src[:, :, 3])
+    np.subtract(255, at, out=k)
+    np.multiply(k, dst[:, :, 3], out=k)
+    np.multiply(k, _INV_255, out=k)
+    np.add(at, k, out=ao)
+
+    # Weighted sum divided by the weights, rounded to nearest
+    cv2.blendLinear(src, dst, at, k, dst=dst)
+    np.add(ao, np.float32(0.5), out=ao)
+    np.copyto(dst[:, :, 3], ao, casting="unsafe")
+
+
+# Blend src over dst in place, in parallel row bands when the frame is large
+def blend(dst, src, block=BLOCK_SIZE):
+    parallel_map(lambda rows: _blend_serial(dst[rows], src[rows], block), bands(dst.shape[0]))
+    return dst
+
+
+# Blocks where src is fully transparent are skipped, fully opaque ones copied,
+# and runs of neighbouring partial blocks blended together
+def _blend_serial(dst, src, block=BLOCK_SIZE):
+    lo, hi = block_alpha_range(src, block)
+    cols = hi.shape[1]
+    for by in np.flatnonzero(hi.any(axis=1)):
+        y = by * block
+        bx = 0
+        while bx < cols:
+            if not hi[by, bx]:
+                bx += 1
+                continue
+            if lo[by, bx] == 255:
+                x = bx * block
+                dst[y:y + block, x:x + block] = src[y:y + block, x:x + block]
+                bx += 1
+                continue
+            end = bx + 1
+            while end < cols and hi[by, end] and lo[by, end] != 255:
+                end += 1
+            _blend_region(dst[y:y + block, bx * block:end * block], src[y:y + block, bx * block:end * block])
+            bx = end
+    return dst
+
+
+# Flatten images (bottom first) into a new image, or into out if given.
+# Each row band goes through the whole stack on one thread
+def composite(images, out=None):
+    if out is None:
+        out = np.empty(images[0].shape, dtype=np.uint8)
+
+    def composite_band(rows):
+        np.copyto(out[rows], images[0][rows])
+        for image in images[1:]:
+            _blend_serial(out[rows], image[rows])
+
+    parallel_map(composite_band, bands(out.shape[0]))
+    return out
+
+
+# Flatten images (bottom first) over a transparent background into a premultiplied
+# float32 BGRA image, or into out if given: colors are multiplied by alpha, and alpha
+# is 0..1. Nothing is rounded, so blending the result with blend_premultiplied gives
+# what blending the images one by one would, without the rounding of every step
+def composite_premultiplied(images, out=None):
+    if out is None:
+        out = np.empty(images[0].shape, dtype=np.float32)
+
+    def composite_band(rows):
+        dst = out[rows]
+        dst[...] = 0
+        for image in images:
+            src = image[rows]
+            if not src[:, :, 3].any():
+                continue
+            at = np.multiply(src[:, :, 3:], _INV_255, dtype=np.float32)
+            np.multiply(dst, 1 - at, out=dst)
+            dst[:, :, :3] += src[:, :, :3] * at
+            dst[:, :, 3:] += at
+
+    parallel_map(composite_band, bands(out.shape[0]))
+    return out
+
+
+# Blend premultiplied src (see composite_premultiplied) over uint8 BGRA dst, in place.
+# The result is rounded once
+def blend_premultiplied(dst, src):
+    def blend_band(rows):
+        top, bottom = src[rows], dst[rows]
+        at = top[:, :, 3:]
+        if not at.any():
+            return
+        k = np.multiply(bottom[:, :, 3:], _INV_255, dtype=np.float32)
+        k *= 1 - at
+        ao = at + k
+        color = bottom[:, :, :3] * k
+        color += top[:, :, :3]
+        color /= np.maximum(ao, np.float32(1e-12))
+        np.copyto(bottom[:, :, :3], np.minimum(color + 0.5, 255), casting="unsafe")
+        np.copyto(bottom[:, :, 3:], np.minimum(ao * 255 + 0.5, 255), casting="unsafe")
+
+    parallel_map(blend_band, bands(dst.shape[0]))
+    return dst
+
+
+# Straightforward float64 version of the same blend equation over whole frames.
+# Slow; kept to check the block engine against
+def composite_reference(images):
+    dst = images[0].astype(np.float64)
+    for image in images[1:]:
+        src = image.astype(np.float64)
+        at = src[:, :, 3:] / 255.0
+        ab = dst[:, :, 3:] / 255.0
+        ao = at + ab * (1 - at)
+        co = (src[:, :, :3] * at + dst[:, :, :3] * ab * (1 - at)) / np.maximum(ao, 1e-12)
+        dst[:, :, :3] = np.floor(co + 0.5)
+        dst[:, :, 3:] = np.floor(ao * 255 + 0.5)
+    return dst.astype(np.uint8)
@@ -0,0 +1,99 @@
+# Edge data for the edge-snapping selection tools, computed once per image.
+# EdgeIndex turns a Canny edge map into a nearest-edge lookup: a distance transform
+# with labels gives every pixel the distance to, and the position of, the closest
+# edge pixel, so snapping a point is two array reads instead of a search.
+# Results are cached per image, keyed by image id and the image's content version (or a
+# checksum of the pixels when there is none), so repeated lasso calls on an unchanged
+# image skip edge detection.
+
+import threading
+import zlib
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+_cache = OrderedDict()  # (kind, image id, shape, version or crc) -> edge data, least recently used first
+_lock = threading.Lock()
+# Edge data is kept up to this. An EdgeIndex of a 4K image is about 108 MB
+EDGE_CACHE_MAX_BYTES = 256 * 1024 ** 2
+
+
+def configure(max_bytes):
+    global EDGE_CACHE_MAX_BYTES
+    if max_bytes is not None:
+        EDGE_CACHE_MAX_BYTES = int(max_bytes)
+
+
+class EdgeIndex:
+
+    def __init__(self, img, low=50, high=150):
+        gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY if img.shape[2] == 3 else cv2.COLOR_BGRA2GRAY)
+        self.edges = cv2.Canny(gray, low, high)
+        self.shape = self.edges.shape
+        edge_pixels = np.argwhere(self.edges > 0)
+        if not len(edge_pixels):
+            self._distance = None
+            return
+        # Labels number the edge pixels (the zeros of the input) in row-major order from 1
+        distance, labels = cv2.distanceTransformWithLabels((self.edges == 0).astype(np.uint8), cv2.DIST_L2, 5,
+                                                           labelType=cv2.DIST_LABEL_PIXEL)
+        self._distance = distance
+        # (y, x) of the nearest edge pixel, for every pixel
+        self._nearest = edge_pixels[labels - 1].astype(np.int32)
+
+    # Move each (x, y) point to the nearest edge pixel closer than max_distance.
+    # Points with no edge that close, or outside the image, stay where they are
+    def snap(self, points, max_distance=30):
+        points = np.asarray(points, dtype=np.int32).reshape(-1, 2)
+        snapped = points.copy()
+        if self._distance is None or not len(points):
+            return snapped
+        h, w = self.shape
+        x, y = points[:, 0], points[:, 1]
+        inside = (x >= 0) & (x < w) & (y >= 0) & (y < h)
+        xi, yi = x[inside], y[inside]
+        near = self._distance[yi, xi] < max_distance
+        nearest = self._nearest[yi[near], xi[near]]
+        rows = np.flatnonzero(inside)[near]
+        snapped[rows, 0] = nearest[:, 1]
+        snapped[rows, 1] = nearest[:, 0]
+        return snapped
+
+    def nbytes(self):
+        extra = 0 if self._distance is None else self._distance.nbytes + self._nearest.nbytes
+        return self.edges.nbytes + extra
+
+
+# Edge data of kind for img, built with build(img) on a cache miss.
+# version identifies the pixels of image_id, without it they are checksummed
+def cached(kind, image_id, img, build, version=None):
+    if version is None:
+        version = zlib.crc32(np.ascontiguousarray(img))
+    key = (kind, str(image_id), img.shape, version)
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    value = build(img)
+    with _lock:
+        _cache[key] = value
+        # The newest entry is kept even when it alone is over the budget
+        total = sum(_nbytes(x) for x in _cache.values())
+        while total > EDGE_CACHE_MAX_BYTES and len(_cache) > 1:
+            total -= _nbytes(_cache.popitem(last=False)[1])
+    return value
+
+
+# Bytes of a cached value, an EdgeIndex or an array (the live-wire cost maps)
+def _nbytes(value):
+    return value.nbytes if isinstance(value, np.ndarray) else value.nbytes()
+
+
+def edge_index(image_id, img, version=None):
+    return cached("edges", image_id, img, EdgeIndex, version)
+
+
+def clear():
+    with _lock:
+        _cache.clear()
@@ -0,0 +1,69 @@
+# Images (BGRA uint8) encoded for sending, as chunks a response can stream.
+# png, jpeg and webp are encoded when the first chunk is asked for, so a route can take
+# what it needs from a layer stack, let go of the stack and only then encode.
+# raw is RGBA, 4 bytes per pixel, rows top to bottom with no padding, for putImageData.
+# It skips compression, or is deflated at a fast level, for LAN and localhost use.
+
+import zlib
+
+import cv2
+
+# format -> mimetype
+FORMATS = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp", "raw": "application/octet-stream"}
+
+CHUNK_SIZE = 64 * 1024
+# zlib level for raw pixels, fast: on a LAN the time to compress matters more than size
+DEFLATE_LEVEL = 1
+
+
+# Chunks of image in format (one of FORMATS). quality 1..100 is used by jpeg and webp,
+# deflate by raw, see raw_chunks
+def stream(image, format="png", quality=90, deflate=False):
+    if format not in FORMATS:
+        raise ValueError(f"Unknown format: {format}")
+    if not 1 <= int(quality) <= 100:
+        raise ValueError("quality must be in 1..100")
+    if format == "raw":
+        return raw_chunks(to_rgba(image), deflate)
+    return _encoded_chunks(image, format, int(quality))
+
+
+# RGBA copy of a BGRA image, in one vectorized pass. The only whole copy raw makes
+def to_rgba(image):
+    return cv2.cvtColor(image, cv2.COLOR_BGRA2RGBA)
+
+
+# Chunks of a contiguous RGBA image, sliced from its buffer through a memoryview.
+# With deflate they are one zlib stream compressed at DEFLATE_LEVEL, which is what
+# Content-Encoding: deflate means
+def raw_chunks(rgba, deflate=False):
+    data = memoryview(rgba).cast("B")
+    compressor = zlib.compressobj(DEFLATE_LEVEL) if deflate else None
+    for start in range(0, len(data), CHUNK_SIZE):
+        chunk = data[start:start + CHUNK_SIZE]
+        if compressor is None:
+            # WSGI servers only take bytes, copied a chunk at a time
+            yield bytes(chunk)
+        else:
+            out = compressor.compress(chunk)
+            if out:
+                yield out
+    if compressor is not None:
+        yield compressor.flush()
+
+
+def _encoded_chunks(image, format, quality):
+    if format == "jpeg":
+        # No alpha in JPEG
+        image = cv2.cvtColor(image, cv2.COLOR_BGRA2BGR)
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+    elif format == "webp":
+        params = [cv2.IMWRITE_WEBP_QUALITY, quality]
+    else:
+        params = []
+    ok, buffer = cv2.imencode(f".{format}", image, params)
+    if not ok:
+        raise IOError(f"Failed to encode {format}")
+    data = memoryview(buffer).cast("B")
+    for start in range(0, len(data), CHUNK_SIZE):
+        yield bytes(data[start:start + CHUNK_SIZE])
@@ -0,0 +1,96 @@
+# Writes layer PNGs for display in the browser, on a background thread.
+# The PNGs are only a view of the layer pixels, the project folder is the real copy,
+# so edits return as soon as the pixels are changed in memory. A newer export of
+# the same file replaces one that has not started yet. A layer is only marked as
+# exported on its stack once its PNG is written, and readers can take the PNG bytes
+# of a pending export from its future.
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="export")
+_pending = {}   # absolute path -> (future of the latest export, layer version)
+_lock = threading.Lock()
+
+
+# Queue PNGs for the layers of stack that changed. Call while holding the stack
+def export_layers(stack, folder):
+    os.makedirs(folder, exist_ok=True)
+    for path, image, version in stack.stale_layer_images(folder, queued=_queued):
+        _submit(path, image, version, stack.mark_exported)
+
+
+# Future of the export of path that is queued or being written, None if there is
+# none. Its result is the PNG bytes
+def pending(path):
+    with _lock:
+        entry = _pending.get(os.path.abspath(path))
+    return entry[0] if entry is not None else None
+
+
+# True when the export of path at version is queued or being written
+def _queued(path, version):
+    with _lock:
+        entry = _pending.get(os.path.abspath(path))
+    return entry is not None and entry[1] == version and not entry[0].cancelled()
+
+
+# written(path, version) is called once the file is written
+def _submit(path, image, version, written):
+    key = os.path.abspath(path)
+    with _lock:
+        previous = _pending.get(key)
+        future = _executor.submit(_write, key, image, lambda: written(path, version))
+        _pending[key] = future, version
+    # Outside the lock, cancelling runs the done callbacks right away
+    if previous is not None:
+        previous[0].cancel()
+    future.add_done_callback(lambda f: _forget(key, f))
+
+
+def _forget(key, future):
+    with _lock:
+        entry = _pending.get(key)
+        if entry is not None and entry[0] is future:
+            del _pending[key]
+
+
+# Written next to the file and swapped in, so a reader never gets half a PNG. done()
+# is called before the export counts as finished. Returns the PNG bytes
+def _write(path, image, done):
+    ok, buffer = cv2.imencode(".png", image)
+    if not ok:
+        raise IOError(f"Failed to encode {path}")
+    data = buffer.tobytes()
+    tmp = f"{path[:-4]}.tmp.png"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+    done()
+    return data
+
+
+# Block until the queued export of path, if any, is written
+def wait(path, timeout=None):
+    path = os.path.abspath(path)
+    while True:
+        with _lock:
+            future, _ = _pending.get(path, (None, None))
+        if future is None:
+            return
+        # A cancelled export was replaced by a newer one, wait for that instead
+        if not future.cancelled():
+            future.exception(timeout)
+            return
+
+
+# Block until every queued export is written
+def flush(timeout=None):
+    with _lock:
+        futures = [future for future, _ in _pending.values()]
+    for future in futures:
+        if not future.cancelled():
+            future.exception(timeout)
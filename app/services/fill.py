@@ -0,0 +1,166 @@
+# Bucket fill on layers, with the regions found kept between fills.
+# A bucket fill covers the connected component of the clicked pixel, where 4-neighbours
+# are connected when no channel differs by more than the tolerance (what cv2.floodFill
+# does). Components are labelled the first time they are clicked, by a scanline flood
+# fill into a label map kept per layer and tolerance, and clicking a labelled pixel is a
+# label lookup inside the component's bounding box.
+# When pixels change only the components on or next to them are forgotten: the others
+# are still connected the same way, and cannot have grown into pixels that did not change.
+
+import threading
+import weakref
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from app.models.Layer import TILE_SIZE
+
+_maps = OrderedDict()  # (layer id, tolerance) -> LabelMap, least recently used first
+_lock = threading.Lock()
+# Label maps of all projects are kept up to this, each costs 8 bytes per pixel
+FILL_CACHE_MAX_BYTES = 256 * 1024 ** 2
+
+
+def configure(max_bytes):
+    global FILL_CACHE_MAX_BYTES
+    if max_bytes is not None:
+        FILL_CACHE_MAX_BYTES = int(max_bytes)
+
+
+class LabelMap:
+
+    def __init__(self, layer, tolerance):
+        self.tolerance = int(tolerance)
+        # Layer objects are replaced when a project is reloaded, with the same ids
+        self.layer = weakref.ref(layer)
+        self.revision = layer.revision()
+        self._bgr = cv2.cvtColor(layer.pixels(), cv2.COLOR_BGRA2BGR)
+        h, w = self._bgr.shape[:2]
+        self._labels = np.zeros((h, w), np.int32)
+        # floodFill does not cross non-zero mask pixels, so labelled pixels are set here
+        self._mask = np.zeros((h + 2, w + 2), np.uint8)
+        self._rects = {}  # label -> bounding rect (x, y, w, h)
+        self._next = 1
+
+    def nbytes(self):
+        return self._bgr.nbytes + self._labels.nbytes + self._mask.nbytes
+
+    # Forget the components touching pixels of layer changed since the last call
+    def sync(self, layer):
+        if layer.revision() == self.revision:
+            return
+        pixels = layer.pixels()
+        for ty, tx in np.argwhere(layer.changed_tiles(self.revision)):
+            rows = slice(ty * TILE_SIZE, (ty + 1) * TILE_SIZE)
+            cols = slice(tx * TILE_SIZE, (tx + 1) * TILE_SIZE)
+            cv2.cvtColor(pixels[rows, cols], cv2.COLOR_BGRA2BGR, dst=self._bgr[rows, cols])
+            self._forget_near((tx * TILE_SIZE, ty * TILE_SIZE, TILE_SIZE, TILE_SIZE), None)
+        self.revision = layer.revision()
+
+    # Record that the mask of rect was filled on layer, and nothing else changed
+    def filled(self, layer, rect, mask):
+        x, y, w, h = rect
+        cv2.cvtColor(layer.pixels()[y:y + h, x:x + w], cv2.COLOR_BGRA2BGR, dst=self._bgr[y:y + h, x:x + w])
+        self._forget_near(rect, mask)
+        self.revision = layer.revision()
+
+    # (rect, mask of rect) of the component of (x, y)
+    def component(self, x, y):
+        label = self._labels[y, x] or self._label(x, y)
+        rx, ry, rw, rh = self._rects[label]
+        return (rx, ry, rw, rh), self._labels[ry:ry + rh, rx:rx + rw] == label
+
+    # Pixels within the tolerance of the color at (x, y), anywhere in the layer
+    def similar(self, x, y):
+        diff = cv2.absdiff(self._bgr, np.full_like(self._bgr, self._bgr[y, x]))
+        mask = (diff.max(axis=2) <= self.tolerance).view(np.uint8)
+        rx, ry, rw, rh = cv2.boundingRect(mask)
+        return (rx, ry, rw, rh), mask[ry:ry + rh, rx:rx + rw] > 0
+
+    def _label(self, x, y):
+        t = (self.tolerance,) * 3
+        # The new component is marked 255 in the mask, then 1 like the other labelled pixels
+        _, _, _, rect = cv2.floodFill(self._bgr, self._mask, (x, y), 0, t, t,
+                                      4 | cv2.FLOODFILL_MASK_ONLY | (255 << 8))
+        rx, ry, rw, rh = rect
+        mask = self._mask[1 + ry:1 + ry + rh, 1 + rx:1 + rx + rw]
+        new = mask == 255
+        np.minimum(mask, 1, out=mask)
+        label = self._next
+        self._next += 1
+        np.copyto(self._labels[ry:ry + rh, rx:rx + rw], label, where=new)
+        self._rects[label] = tuple(rect)
+        return label
+
+    # Forget the components with pixels in the mask of rect (all of rect if mask is None)
+    # or next to them
+    def _forget_near(self, rect, mask):
+        h, w = self._labels.shape
+        x, y, rw, rh = rect
+        x0, y0 = max(x - 1, 0), max(y - 1, 0)
+        x1, y1 = min(x + rw + 1, w), min(y + rh + 1, h)
+        near = self._labels[y0:y1, x0:x1]
+        if mask is not None:
+            inside = self._labels[y:y + rh, x:x + rw]
+            label = inside.flat[np.argmax(mask)]
+            grown = np.zeros(near.shape, np.uint8)
+            grown[y - y0:y - y0 + rh, x - x0:x - x0 + rw] = mask
+            if label and np.array_equal(inside == label, mask):
+                # A whole component was filled, as usual: only the pixels around it are
+                # searched for other components, it is cleared through the mask
+                self._rects.pop(label)
+                np.copyto(inside, 0, where=mask)
+                np.copyto(self._mask[1 + y:1 + y + rh, 1 + x:1 + x + rw], 0, where=mask)
+                near = near[cv2.dilate(grown, np.ones((3, 3), np.uint8)) > grown]
+            else:
+                near = near[cv2.dilate(grown, np.ones((3, 3), np.uint8)) > 0]
+        for label in np.flatnonzero(np.bincount(near.ravel(), minlength=1)[1:]) + 1:
+            lx, ly, lw, lh = self._rects.pop(label)
+            labels = self._labels[ly:ly + lh, lx:lx + lw]
+            gone = labels == label
+            np.copyto(labels, 0, where=gone)
+            np.copyto(self._mask[1 + ly:1 + ly + lh, 1 + lx:1 + lx + lw], 0, where=gone)
+
+
+def label_map(layer, tolerance):
+    key = (layer.id(), int(tolerance))
+    with _lock:
+        labels = _maps.get(key)
+        if labels is not None:
+            _maps.move_to_end(key)
+    if labels is None or labels.layer() is not layer:
+        labels = LabelMap(layer, tolerance)
+        with _lock:
+            _maps[key] = labels
+            # The newest map is kept even when it alone is over the budget
+            total = sum(x.nbytes() for x in _maps.values())
+            while total > FILL_CACHE_MAX_BYTES and len(_maps) > 1:
+                total -= _maps.popitem(last=False)[1].nbytes()
+    else:
+        labels.sync(layer)
+    return labels
+
+
+# (rect, mask of rect) a bucket click at (x, y) on layer covers: the connected
+# component, or with contiguous=False every pixel of a similar color.
+# None if the clicked pixel already has the color
+def region(layer, color_bgr, x, y, tolerance=10, contiguous=True):
+    if tuple(layer.pixels()[y, x, :3]) == tuple(color_bgr):
+        return None
+    labels = label_map(layer, tolerance)
+    return labels.component(x, y) if contiguous else labels.similar(x, y)
+
+
+# Fill the region with the color, inside LayerStack.record_pixels(rect) to record undo
+def apply(layer, rect, mask, color_bgr, tolerance=10):
+    x, y, w, h = rect
+    # One uint32 per pixel, much faster to write through a mask than 4 channels
+    roi = layer.get_image()[y:y + h, x:x + w].view(np.uint32)[..., 0]
+    np.copyto(roi, np.array((*color_bgr, 255), np.uint8).view(np.uint32)[0], where=mask)
+    layer.mark_dirty(rect)
+    with _lock:
+        labels = _maps.get((layer.id(), int(tolerance)))
+    # Only the fill itself changed the layer since the map was synced
+    if labels is not None and labels.layer() is layer and labels.revision == layer.revision() - 1:
+        labels.filled(layer, rect, mask)
@@ -0,0 +1,198 @@
+# Filters applied to layer pixels (straight-alpha BGRA uint8), in place.
+# A request is a chain of filters, e.g. [{"name": "brightness_contrast", "brightness": 20},
+# {"name": "gaussian", "radius": 3}]. The chain is compiled into stages:
+#   point stages  - runs of grayscale, invert and brightness_contrast. Per-channel
+#                   filters are combined into a single lookup table, so a run of them
+#                   is one pass over the pixels whatever its length
+#   kernel stages - gaussian and sharpen, which read a neighbourhood of radius pixels
+# Every stage works tile by tile on the compositing thread pool. Kernel stages read
+# from a copy of the area taken before the stage, with a halo of radius pixels around
+# each tile, so tiles give the same result as filtering the whole image at once.
+# Work is limited to a rect, normally the bounding box of the active selection, and
+# with a mask only the selected pixels change (feathered pixels partly).
+
+import math
+
+import cv2
+import numpy as np
+
+from app.models.Layer import TILE_SIZE
+from app.services import compositing
+
+_IDENTITY = np.arange(256, dtype=np.uint8)
+
+
+def _brightness_contrast(brightness=0, contrast=0):
+    # brightness -255..255 is added, contrast -100..100 scales around the middle gray
+    brightness, contrast = float(brightness), float(contrast)
+    if not (-255 <= brightness <= 255 and -100 <= contrast <= 100):
+        raise ValueError("brightness must be in -255..255 and contrast in -100..100")
+    values = (np.arange(256) - 127.5) * (1 + contrast / 100) + 127.5 + brightness
+    return np.clip(np.floor(values + 0.5), 0, 255).astype(np.uint8)
+
+
+# Per-channel filters as a lookup table of the 256 values
+_TABLES = {
+    "invert": lambda: _IDENTITY[::-1].copy(),
+    "brightness_contrast": _brightness_contrast,
+}
+
+# Filters that mix the color channels, as a 4x4 BGRA matrix for cv2.transform
+_GRAY = [0.114, 0.587, 0.299, 0]
+_MATRICES = {
+    "grayscale": lambda: np.array([_GRAY, _GRAY, _GRAY, [0, 0, 0, 1]], np.float32),
+}
+
+NAMES = ("grayscale", "invert", "brightness_contrast", "gaussian", "sharpen")
+
+
+class _PointStage:
+
+    def __init__(self):
+        # BGRA lookup tables (1, 256, 4) and matrices (4, 4) in order, neighbouring
+        # tables combined into one
+        self.ops = []
+
+    def add_table(self, table):
+        # Alpha keeps its values
+        lut = np.stack([table, table, table, _IDENTITY], axis=1).reshape(1, 256, 4)
+        if self.ops and self.ops[-1].shape == lut.shape:
+            lut = np.take_along_axis(lut, self.ops.pop().astype(np.intp), axis=1)
+        self.ops.append(lut)
+
+    def add_matrix(self, matrix):
+        self.ops.append(matrix)
+
+    def run(self, src, dst):
+        for op in self.ops:
+            if op.dtype == np.uint8:
+                cv2.LUT(src, op, dst=dst)
+            else:
+                cv2.transform(src, op, dst=dst)
+            src = dst
+
+
+class _KernelStage:
+
+    def __init__(self, name, radius=2, amount=100):
+        self.name = name
+        radius, amount = float(radius), float(amount)
+        # int() of inf raises OverflowError, nan fails the range checks below
+        if not math.isfinite(radius) or not 1 <= radius <= 250:
+            raise ValueError("radius must be in 1..250")
+        self.radius = int(radius)
+        self.amount = amount / 100
+        if name == "sharpen" and not 0 <= self.amount <= 5:
+            raise ValueError("amount must be in 0..500")
+        self.halo = self.radius
+
+    def _blur(self, src):
+        size = 2 * self.radius + 1
+        return cv2.GaussianBlur(src, (size, size), 0, borderType=cv2.BORDER_REFLECT_101)
+
+    # Filtered src (a tile with its halo)
+    def run(self, src):
+        if self.name == "gaussian":
+            if src[:, :, 3].min() == 255:
+                return self._blur(src)
+            # Blurred with premultiplied colors, so transparent pixels do not darken the edges
+            premultiplied = src.astype(np.float32)
+            premultiplied[:, :, :3] *= premultiplied[:, :, 3:] * np.float32(1 / 255)
+            blurred = self._blur(premultiplied)
+            alpha = blurred[:, :, 3:]
+            blurred[:, :, :3] *= np.float32(255) / np.maximum(alpha, np.float32(1e-3))
+            return np.clip(blurred + 0.5, 0, 255).astype(np.uint8)
+        # Unsharp mask, alpha is left alone
+        out = cv2.addWeighted(src, 1 + self.amount, self._blur(src), -self.amount, 0)
+        out[:, :, 3] = src[:, :, 3]
+        return out
+
+
+# Stages for a chain of {"name": ..., params} filters. ValueError for a bad chain
+def compile_chain(chain):
+    if not chain:
+        raise ValueError("No filters given")
+    stages = []
+    for spec in chain:
+        spec = dict(spec)
+        name = spec.pop("name", None)
+        if name not in NAMES:
+            raise ValueError(f"Unknown filter: {name}")
+        try:
+            if name in _TABLES or name in _MATRICES:
+                if not stages or not isinstance(stages[-1], _PointStage):
+                    stages.append(_PointStage())
+                if name in _TABLES:
+                    stages[-1].add_table(_TABLES[name](**spec))
+                else:
+                    stages[-1].add_matrix(_MATRICES[name](**spec))
+            else:
+                stages.append(_KernelStage(name, **spec))
+        except TypeError as e:
+            raise ValueError(f"Bad parameters for {name}: {e}")
+    return stages
+
+
+# Tiles of rect (x, y, w, h) as (rows, cols) slices of the image, skipping tiles where
+# mask (the mask of rect) selects nothing
+def _tiles(rect, mask):
+    x, y, w, h = rect
+    tiles = []
+    for ty in range(y, y + h, TILE_SIZE):
+        for tx in range(x, x + w, TILE_SIZE):
+            rows = slice(ty, min(ty + TILE_SIZE, y + h))
+            cols = slice(tx, min(tx + TILE_SIZE, x + w))
+            if mask is None or mask[rows.start - y:rows.stop - y, cols.start - x:cols.stop - x].any():
+                tiles.append((rows, cols))
+    return tiles
+
+
+# Apply the filter chain to img (BGRA) inside rect, or the whole image. With mask, a
+# uint8 mask of rect, pixels are changed in proportion to it. Returns the rect
+def apply(img, chain, rect=None, mask=None):
+    return apply_stages(img, compile_chain(chain), rect, mask)
+
+
+# apply() with a chain compile_chain already compiled
+def apply_stages(img, stages, rect=None, mask=None):
+    h, w = img.shape[:2]
+    if rect is None:
+        rect = (0, 0, w, h)
+    x, y, rw, rh = rect
+    if not rw or not rh:
+        return rect
+    tiles = _tiles(rect, mask)
+    before = img[y:y + rh, x:x + rw].copy() if mask is not None else None
+
+    for stage in stages:
+        if isinstance(stage, _PointStage):
+            compositing.parallel_map(lambda tile: stage.run(img[tile], img[tile]), tiles)
+            continue
+        # Kernel stages read the area as it was before the stage, halo included
+        halo = stage.halo
+        x0, y0 = max(x - halo, 0), max(y - halo, 0)
+        x1, y1 = min(x + rw + halo, w), min(y + rh + halo, h)
+        source = img[y0:y1, x0:x1].copy()
+
+        def run_tile(tile, stage=stage, source=source, x0=x0, y0=y0, x1=x1, y1=y1, halo=halo):
+            rows, cols = tile
+            sy0, sx0 = max(rows.start - halo, y0), max(cols.start - halo, x0)
+            sy1, sx1 = min(rows.stop + halo, y1), min(cols.stop + halo, x1)
+            out = stage.run(source[sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0])
+            img[tile] = out[rows.start - sy0:rows.stop - sy0, cols.start - sx0:cols.stop - sx0]
+
+        compositing.parallel_map(run_tile, tiles)
+
+    if mask is not None:
+        _keep_unselected(img[y:y + rh, x:x + rw], before, mask)
+    return rect
+
+
+# Put back the pixels of before that mask does not select, blend the partly selected ones
+def _keep_unselected(region, before, mask):
+    if ((mask == 0) | (mask == 255)).all():
+        # One uint32 per pixel, much faster to copy through a mask than 4 channels
+        np.copyto(region.view(np.uint32)[..., 0], before.view(np.uint32)[..., 0], where=mask == 0)
+        return
+    weight = mask.astype(np.float32) * np.float32(1 / 255)
+    cv2.blendLinear(region, before, weight, 1 - weight, dst=region)
@@ -1,56 +1,127 @@
 # Handles image operations (resize, crop, filter, combine layers) using Pillow/OpenCV.
+import threading
+from collections import OrderedDict
+
 import numpy as np
 import cv2
-import base64
-from flask import current_app
+from flask import current_app, has_request_context, session
+from app.models.AdjustmentLayer import AdjustmentLayer
+from app.services import livewire
+from app.services.edges import edge_index
+from app.models.selection import SelectionMask
+from app.services.stack_cache import stacks
+
+# Decoded images, (project id, image id, version) -> read-only BGR array, least recently used first
+_images = OrderedDict()
+_images_bytes = 0
+_images_lock = threading.Lock()
+IMAGE_CACHE_MAX_BYTES = 256 * 1024 ** 2
+
+def configure_image_cache(max_bytes=None):
+    """Set the byte budget of the decoded-image cache."""
+    global IMAGE_CACHE_MAX_BYTES
+    if max_bytes is not None:
+        IMAGE_CACHE_MAX_BYTES = int(max_bytes)
+
+def load_image(image_id, pid=None):
+    """Resolve image_id in the project (the session's by default) and return (key, BGR image).
+
+    image_id is "composite" for the flattened layer stack, a layer index, or a layer id.
+    key includes the image's content version, so it changes whenever the pixels do.
+    Images are cached by key: repeated selections on an unchanged image reuse the array.
+    """
+    pid = _project_id(image_id, pid)
+    with stacks.view(pid) as stack:
+        version, source = _resolve(stack, image_id)
+        key = (pid, str(image_id), version)
+        img = _cached_image(key)
+        if img is None:
+            img = cv2.cvtColor(source(), cv2.COLOR_BGRA2BGR)
+            img.flags.writeable = False
+            _cache_image(key, img)
+    return key, img
+
+def image_size(image_id, pid=None):
+    """(height, width) of image_id, without decoding it."""
+    with stacks.view(_project_id(image_id, pid)) as stack:
+        _resolve(stack, image_id)
+        return stack.shape()
+
+def _project_id(image_id, pid):
+    if pid is None and has_request_context():
+        pid = session.get("pid")
+    if pid is None:
+        raise LookupError(f"No project loaded for image: {image_id}")
+    return pid
+
+# (version, function returning the BGRA pixels) of image_id in stack
+def _resolve(stack, image_id):
+    if stack is None:
+        raise LookupError(f"No project loaded for image: {image_id}")
+    if image_id in (None, "", "composite"):
+        return ("composite", stack.composite_version()), stack.get_collapsed_stack_as_image
+    layer = _find_layer(stack, image_id)
+    if isinstance(layer, AdjustmentLayer):
+        # What the adjustment layer shows: the composite through it
+        i = next(i for i in range(stack.size()) if stack.at(i) is layer)
+        return stack.layer_version(i), lambda: stack.layer_image(i)
+    return (layer.id(), layer.revision()), layer.pixels
+
+def _find_layer(stack, image_id):
+    # Layer ids are hex and can be all digits, so they are matched before indices
+    for i in range(stack.size()):
+        if stack.at(i).id() == str(image_id):
+            return stack.at(i)
+    if isinstance(image_id, int) or str(image_id).isdigit():
+        layer = stack.at(int(image_id))
+        if layer != 0:
+            return layer
+    raise LookupError(f"Image not found: {image_id}")
+
+def _cached_image(key):
+    with _images_lock:
+        img = _images.get(key)
+        if img is not None:
+            _images.move_to_end(key)
+        return img
+
+def _cache_image(key, img):
+    global _images_bytes
+    with _images_lock:
+        # Older versions of the same image are not needed any more
+        for old in [k for k in _images if k[:2] == key[:2]]:
+            _images_bytes -= _images.pop(old).nbytes
+        _images[key] = img
+        _images_bytes += img.nbytes
+        while _images_bytes > IMAGE_CACHE_MAX_BYTES and len(_images) > 1:
+            _images_bytes -= _images.popitem(last=False)[1].nbytes
 
 def process_image(image_id):
-    """Load image from storage based on image_id?"""
-    """Not sure how this works yet, placeholder for now"""
-    img = cv2.imread('tests/test_image.png')
-    return img
+    """Load image_id (see load_image) as a read-only BGR array."""
+    return load_image(image_id)[1]
 
 # def apply_grayscale(...): ...
 # def apply_gaussian(...): ...
 
-def create_mask(height, width):
-    """Helper to create a blank mask."""
-    return np.zeros((height, width), dtype=np.uint8)
-
-def encode_mask(mask):
-    """Encode mask as base64 PNG."""
-    _, buffer = cv2.imencode('.png', mask)
-    return base64.b64encode(buffer).decode('utf-8')
+# Selections return a SelectionMask, which only holds the bounding box of the selection.
+# The routes send it in the format the client asks for
 
 def rectangular_select(image_id, coords):
-    img = process_image(image_id) # Load image
-    height, width = img.shape[:2] # Get dimensions
-    x1, y1, x2, y2 = coords # Unpack coords
-    mask = create_mask(height, width) # Create blank mask
-    cv2.rectangle(mask, (x1, y1), (x2, y2), 255, -1) # Fill rectangle on mask
-    return encode_mask(mask)
+    height, width = image_size(image_id) # Get dimensions
+    return SelectionMask.rectangle(width, height, coords) # Rectangle between the two corners
 
 def freeform_select(image_id, path):
-    img = process_image(image_id)
-    height, width = img.shape[:2]
-    path = np.array(path, np.int32) # Convert path to numpy array
-    mask = create_mask(height, width)
-    cv2.fillPoly(mask, [path], 255) # Fill polygon defined by path
-    return encode_mask(mask)
+    height, width = image_size(image_id)
+    return SelectionMask.polygon(width, height, path) # Fill polygon defined by path
 
 def polygonal_select(image_id, vertices):
-    img = process_image(image_id)
-    height, width = img.shape[:2]
-    vertices = np.array(vertices, np.int32) # Convert vertices to numpy array
-    mask = create_mask(height, width)
-    cv2.fillPoly(mask, [vertices], 255) # Fill polygon defined by vertices
-    return encode_mask(mask)
+    height, width = image_size(image_id)
+    return SelectionMask.polygon(width, height, vertices) # Fill polygon defined by vertices
 
 def magic_lasso_select(image_id, seed_points):
-    img = process_image(image_id)
+    key, img = load_image(image_id)
     height, width = img.shape[:2]
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) # Grayscale
-    edges = cv2.Canny(gray, 50, 150) # Edge detection, adjust thresholds as needed, but adjusting didnt seem to fix much its just bad
+    index = edge_index(key[:2], img, key[2]) # Canny edges and nearest-edge lookup, cached per image version
     path = []
     seed_points = seed_points + [seed_points[0]]  # Close loop
     for i in range(len(seed_points) - 1): # loop through seed points, for each calculate distance and interpolate points between them
@@ -58,28 +129,22 @@ def magic_lasso_select(image_id, seed_points):
         start_arr, end_arr = np.array(start), np.array(end)
         distance = np.linalg.norm(end_arr - start_arr)
         num_steps = int(distance / 5) + 1 if distance > 0 else 1
-        line_path = np.linspace(start_arr, end_arr, num=num_steps, dtype=int)
-        for pt in line_path:
-            snapped = False
-            for r in range(1, 30):  # search radially up to 30 pixels for edge intersection, can adjust but doesnt seem to help much
-                circle = np.zeros_like(edges)
-                cv2.circle(circle, tuple(pt), r, 255, 1)
-                intersects = cv2.bitwise_and(edges, circle)
-                if np.any(intersects): # snap to strongest edge point
-                    max_val = np.max(intersects)
-                    snap_pt_idx = np.argwhere(intersects == max_val)[0]
-                    snap_pt = snap_pt_idx[::-1]  # (y,x) to (x,y)
-                    path.append(snap_pt.tolist())  # As list
-                    snapped = True
-                    break
-            if not snapped: # if no edge found, just use original point
-                path.append(pt.tolist())
-    path = np.array(path, np.int32) # Convert path to numpy array
-    mask = create_mask(height, width)
-    if len(path) >= 3:
-        cv2.fillPoly(mask, [path], 255) # Fill polygon defined by path
-    return encode_mask(mask)
+        path.append(np.linspace(start_arr, end_arr, num=num_steps, dtype=int))
+    # snap every point to the nearest edge pixel within 30 pixels, if no edge found the original point is used
+    path = index.snap(np.concatenate(path), max_distance=30)
+    return SelectionMask.polygon(width, height, path) # Fill polygon defined by path
 # Soltution chosen to be lightweight but not very good at all, will improve
 
+def live_wire_path(image_id, anchor, cursor):
+    # Preview: cheapest path along edges from the last anchor to the cursor, as [x, y] points
+    key, _ = load_image(image_id) # cheap on a cache hit, and the key changes with the pixels
+    return livewire.path(key[:2], lambda: process_image(image_id), anchor, cursor, key[2]).tolist()
+
+def live_wire_select(image_id, anchors):
+    key, img = load_image(image_id)
+    height, width = img.shape[:2]
+    path = livewire.closed_path(key[:2], lambda: img, anchors, key[2]) # Edge-following path through all anchors, closed
+    return SelectionMask.polygon(width, height, path)
+
 # def brush_stroke(...): ...
 # def eraser_stroke(...): ...
@@ -0,0 +1,198 @@
+# Live-wire (intelligent scissors) selection.
+# Every pixel gets a cost that is low on strong edges: gradient magnitude plus Canny
+# edges, computed once per image and cached. A path from an anchor to the cursor is
+# the cheapest 8-connected path through these costs, entering a pixel costs its cost,
+# times sqrt(2) for diagonal steps.
+# The shortest path tree is built for a window around the anchor and kept, so while
+# the cursor moves around the same anchor a preview only walks back through the tree.
+# When the cursor leaves the window, the window is grown and the tree rebuilt.
+# The tree is the same one Dijkstra would give, but found with fast sweeping: rows
+# are relaxed one after another, down and up the window and then across it, each row
+# with a few whole-row NumPy operations. Sweeps are repeated until nothing improves,
+# which takes a few rounds instead of one Python heap operation per pixel, more on
+# winding cost maps (spirals, mazes) where paths keep turning back.
+
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from app.services import edges
+
+# Window half-size around the anchor, grown up to MAX_RADIUS when the cursor leaves it
+START_RADIUS = 128
+MAX_RADIUS = 1024
+# Sweeps run until a round changes nothing. A round settles at least one more turn
+# back of every path, this cap only guards against a cost map that never settles
+MAX_ROUNDS = 1000
+# Trees, one per (image, anchor, version), are kept up to this. One at MAX_RADIUS is
+# about 67 MB
+LIVEWIRE_CACHE_MAX_BYTES = 256 * 1024 ** 2
+
+_SQRT2 = np.sqrt(2)
+
+_trees = OrderedDict()  # (image id, anchor, version) -> ShortestPathTree, least recently used first
+_lock = threading.Lock()
+
+
+def configure(max_bytes):
+    global LIVEWIRE_CACHE_MAX_BYTES
+    if max_bytes is not None:
+        LIVEWIRE_CACHE_MAX_BYTES = int(max_bytes)
+
+
+# Cost of entering each pixel, float32 in 0.05-0.91. Low on edges
+def cost_map(img):
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY if img.shape[2] == 3 else cv2.COLOR_BGRA2GRAY)
+    gray = cv2.GaussianBlur(gray, (3, 3), 0)
+    gx = cv2.Sobel(gray, cv2.CV_32F, 1, 0, ksize=3)
+    gy = cv2.Sobel(gray, cv2.CV_32F, 0, 1, ksize=3)
+    magnitude = cv2.magnitude(gx, gy)
+    top = float(magnitude.max()) or 1.0
+    not_edge = (cv2.Canny(gray, 50, 150) == 0).astype(np.float32)
+    # Gradient and edge terms weighted as in the intelligent scissors paper, plus a
+    # small constant so the shortest of equally good paths wins
+    return 0.05 + 0.43 * (1 - magnitude / top) + 0.43 * not_edge
+
+
+# Relax d row by row in the given order: each row from the row before it (straight
+# and diagonal steps), then along the row in both directions. The cheapest way into
+# x from any k before it on the row is a running minimum of d[k] - S[k], plus S[x],
+# where S is the cumulative cost along the row. One pass settles every path that is
+# monotone in the pass direction, however much it wanders sideways
+def _sweep(d, cost, rows):
+    diagonal = cost * _SQRT2
+    forward = np.cumsum(cost, axis=1)
+    backward = np.cumsum(cost[:, ::-1], axis=1)[:, ::-1]
+    prev = None
+    for r in rows:
+        row, c = d[r], cost[r]
+        if prev is not None:
+            np.minimum(row, prev + c, out=row)
+            np.minimum(row[1:], prev[:-1] + diagonal[r, 1:], out=row[1:])
+            np.minimum(row[:-1], prev[1:] + diagonal[r, :-1], out=row[:-1])
+        s = forward[r]
+        np.minimum(row, np.minimum.accumulate(row - s) + s, out=row)
+        s = backward[r]
+        np.minimum(row, np.minimum.accumulate((row - s)[::-1])[::-1] + s, out=row)
+        prev = row
+
+
+class ShortestPathTree:
+
+    # Tree of cheapest paths from anchor (x, y) inside the window of radius around it
+    def __init__(self, cost, anchor, radius):
+        h, w = cost.shape
+        ax, ay = min(max(int(anchor[0]), 0), w - 1), min(max(int(anchor[1]), 0), h - 1)
+        self.anchor = (int(ax), int(ay))
+        self.radius = radius
+        self.x0, self.y0 = max(ax - radius, 0), max(ay - radius, 0)
+        self.x1, self.y1 = min(ax + radius + 1, w), min(ay + radius + 1, h)
+        window = cost[self.y0:self.y1, self.x0:self.x1].astype(np.float64)
+        wh, ww = window.shape
+        self._width = ww
+
+        d = np.full((wh, ww), np.inf)
+        ay, ax = ay - self.y0, ax - self.x0
+        d[ay, ax] = 0
+        for _ in range(MAX_ROUNDS):
+            before = d.copy()
+            # Down and up the rows, then down and up the columns
+            _sweep(d, window, range(wh))
+            _sweep(d, window, range(wh - 1, -1, -1))
+            columns, window_t = d.T.copy(), window.T.copy()
+            _sweep(columns, window_t, range(ww))
+            _sweep(columns, window_t, range(ww - 1, -1, -1))
+            d[...] = columns.T
+            # Cumulative sums round a little differently every round, so stop once
+            # nothing improves by more than rounding
+            np.subtract(before, d, out=before)
+            if not (before > 1e-9).any():
+                break
+        self.distance = d
+        self._parent = self._parents(d, window, ay * ww + ax)
+
+    # Flat index of the neighbour each pixel is reached from, -1 for the anchor
+    @staticmethod
+    def _parents(distance, cost, start):
+        wh, ww = distance.shape
+        padded = np.pad(distance, 1, constant_values=np.inf)
+        index = np.pad(np.arange(wh * ww).reshape(wh, ww), 1, constant_values=-1)
+        best = np.full((wh, ww), np.inf)
+        parent = np.full((wh, ww), -1, dtype=np.int64)
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                if not dx and not dy:
+                    continue
+                step = _SQRT2 if dx and dy else 1.0
+                via = padded[1 + dy:1 + dy + wh, 1 + dx:1 + dx + ww] + cost * step
+                better = via < best
+                best[better] = via[better]
+                parent[better] = index[1 + dy:1 + dy + wh, 1 + dx:1 + dx + ww][better]
+        parent = parent.ravel()
+        parent[start] = -1
+        return parent
+
+    def nbytes(self):
+        return self.distance.nbytes + self._parent.nbytes
+
+    def contains(self, point):
+        x, y = point
+        return self.x0 <= x < self.x1 and self.y0 <= y < self.y1
+
+    # Path of (x, y) points from the anchor to point, clamped into the window
+    def path_to(self, point):
+        x = min(max(int(point[0]), self.x0), self.x1 - 1) - self.x0
+        y = min(max(int(point[1]), self.y0), self.y1 - 1) - self.y0
+        i = y * self._width + x
+        parent = self._parent
+        flat = []
+        while i >= 0:
+            flat.append(i)
+            i = parent.item(i)
+        flat = np.array(flat[::-1])
+        return np.stack([flat % self._width + self.x0, flat // self._width + self.y0], axis=1)
+
+
+# Cheapest path from anchor to cursor on the image load() returns. The tree for
+# (image id, version, anchor) is reused while the cursor stays inside its window, and
+# then the image is not even loaded, so previews only cost the walk back through the tree.
+# version identifies the pixels of image_id, see edges.cached
+def path(image_id, load, anchor, cursor, version=None):
+    key = (str(image_id), int(anchor[0]), int(anchor[1]), version)
+    with _lock:
+        tree = _trees.get(key)
+        if tree is not None:
+            _trees.move_to_end(key)
+    if tree is not None and tree.contains(cursor):
+        return tree.path_to(cursor)
+
+    radius = START_RADIUS if tree is None else tree.radius
+    reach = max(abs(int(cursor[0]) - key[1]), abs(int(cursor[1]) - key[2]))
+    while radius < min(reach + 16, MAX_RADIUS):
+        radius *= 2
+    if tree is None or radius > tree.radius:
+        img = load()
+        cost = edges.cached("livewire", image_id, img, cost_map, version)
+        tree = ShortestPathTree(cost, anchor, min(radius, MAX_RADIUS))
+        with _lock:
+            _trees[key] = tree
+            # The newest tree is kept even when it alone is over the budget
+            total = sum(x.nbytes() for x in _trees.values())
+            while total > LIVEWIRE_CACHE_MAX_BYTES and len(_trees) > 1:
+                total -= _trees.popitem(last=False)[1].nbytes()
+    return tree.path_to(cursor)
+
+
+# Closed path through all anchors, each leg found with path()
+def closed_path(image_id, load, anchors, version=None):
+    anchors = list(anchors) + [anchors[0]]
+    return np.concatenate([path(image_id, load, start, end, version) for start, end in zip(anchors, anchors[1:])])
+
+
+# Forget the trees of image_id, after the image changed
+def forget(image_id):
+    with _lock:
+        for key in [k for k in _trees if k[0] == str(image_id)]:
+            del _trees[key]
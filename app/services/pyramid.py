@@ -0,0 +1,201 @@
+# Downscaled copies of the layers and the composite (1/2, 1/4, 1/8, ...), so the editor
+# can load small images when zoomed out instead of every layer at full size.
+# Level k is 1/2**k of the full size, each pixel the average of 2x2 pixels of level
+# k - 1, with colors weighted by alpha where they are not opaque. The last row or column
+# of an odd size is averaged with itself.
+# TILE_SIZE is a power of two, so a tile of the full image is a whole block of pixels
+# at every level: levels are kept per image and only the blocks of changed tiles are
+# computed again, and only when a level is asked for. Their PNGs are kept too.
+
+import threading
+import weakref
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from app.models.Layer import TILE_SIZE
+from app.services import compositing
+
+# Smallest level is 1/2**LEVELS of the full size
+LEVELS = 5
+
+_pyramids = OrderedDict()  # (project id, layer id or "composite") -> Pyramid, least recently used first
+_lock = threading.Lock()
+PYRAMID_CACHE_MAX_BYTES = 256 * 1024 ** 2
+
+
+def configure(max_bytes):
+    global PYRAMID_CACHE_MAX_BYTES
+    if max_bytes is not None:
+        PYRAMID_CACHE_MAX_BYTES = int(max_bytes)
+
+
+# Smallest level that still has at least scale times the full resolution
+def level_for(scale):
+    scale = float(scale)
+    if not scale > 0:
+        raise ValueError("scale must be positive")
+    level = 0
+    while level < LEVELS and 0.5 ** (level + 1) >= scale:
+        level += 1
+    return level
+
+
+class Pyramid:
+
+    def __init__(self, height, width):
+        self.height, self.width = height, width
+        rows, cols = -(-height // TILE_SIZE), -(-width // TILE_SIZE)
+        # Index k - 1 holds level k, and the tiles of the full image not in it yet
+        self.levels = []
+        self.pending = []
+        for k in range(1, LEVELS + 1):
+            self.levels.append(np.zeros((-(-height >> k), -(-width >> k), 4), np.uint8))
+            self.pending.append(np.ones((rows, cols), bool))
+        # Layers and stacks are replaced when a project is reloaded, with the same ids and
+        # revisions starting over
+        self.source = None
+        self.version = None
+        self._pngs = {}  # level -> PNG bytes
+
+    # Record that the tiles in changed (a boolean (rows, cols) array) of the image changed
+    def changed(self, changed, version, source):
+        for pending in self.pending:
+            pending |= changed
+        self.source = weakref.ref(source)
+        self.version = version
+        self._pngs.clear()
+
+    # Level k of image, the full size image the pyramid is of. With rect (x, y, w, h) of
+    # the full image, only the part of the level inside it is brought up to date
+    def level(self, image, k, rect=None):
+        area = (slice(None), slice(None))
+        if rect is not None:
+            x, y, w, h = rect
+            area = (slice(y // TILE_SIZE, -(-(y + h) // TILE_SIZE)), slice(x // TILE_SIZE, -(-(x + w) // TILE_SIZE)))
+        for i in range(1, k + 1):
+            src = image if i == 1 else self.levels[i - 2]
+            dst = self.levels[i - 1]
+            pending = self.pending[i - 1][area]
+            tiles = [(ty + (area[0].start or 0), tx + (area[1].start or 0)) for ty, tx in zip(*np.nonzero(pending))]
+            compositing.parallel_map(lambda tile: self._half_tile(src, dst, i, tile), tiles)
+            pending[...] = False
+        return image if k == 0 else self.levels[k - 1]
+
+    def png(self, image, k):
+        data = self._pngs.get(k)
+        if data is None:
+            _, buffer = cv2.imencode(".png", self.level(image, k))
+            data = self._pngs[k] = buffer.tobytes()
+        return data
+
+    def nbytes(self):
+        return sum(x.nbytes for x in self.levels) + sum(len(x) for x in self._pngs.values())
+
+    # Block of tile (ty, tx) at level k from level k - 1 (src)
+    @staticmethod
+    def _half_tile(src, dst, k, tile):
+        ty, tx = tile
+        size = TILE_SIZE >> k
+        rows = slice(ty * size, min((ty + 1) * size, dst.shape[0]))
+        cols = slice(tx * size, min((tx + 1) * size, dst.shape[1]))
+        block = src[2 * rows.start:2 * rows.stop, 2 * cols.start:2 * cols.stop]
+        dst[rows, cols] = _half(block)
+
+
+def _half(src):
+    h, w = src.shape[:2]
+    if h % 2 or w % 2:
+        src = cv2.copyMakeBorder(src, 0, h % 2, 0, w % 2, cv2.BORDER_REPLICATE)
+    return _shrink(src, (src.shape[1] // 2, src.shape[0] // 2))
+
+
+# src resized to size (width, height) by averaging
+def _shrink(src, size):
+    if src[:, :, 3].min() == 255:
+        return cv2.resize(src, size, interpolation=cv2.INTER_AREA)
+    # Transparent pixels would darken the colors around them otherwise
+    premultiplied = src.astype(np.float32)
+    premultiplied[:, :, :3] *= premultiplied[:, :, 3:] * np.float32(1 / 255)
+    small = cv2.resize(premultiplied, size, interpolation=cv2.INTER_AREA)
+    small[:, :, :3] *= np.float32(255) / np.maximum(small[:, :, 3:], np.float32(1e-3))
+    return np.clip(small + 0.5, 0, 255).astype(np.uint8)
+
+
+# PNG of layer i of stack (or the composite when i is None) at level k.
+# Call while holding the stack
+def png(pid, stack, i, k):
+    if i is None:
+        version = stack.composite_version()
+        image = stack.get_collapsed_stack_as_image
+    else:
+        version = stack.layer_version(i)
+        image = lambda: stack.layer_image(i)
+    if k == 0:
+        _, buffer = cv2.imencode(".png", image())
+        return buffer.tobytes()
+
+    pyramid = _pyramid(pid, stack, i, version)
+    data = pyramid.png(image(), k)
+    _keep((pid, "composite" if i is None else stack.at(i).id()), pyramid)
+    return data
+
+
+# Composite of stack inside rect (x, y, w, h) at scale (0 < scale <= 1), as a new array.
+# It is cut from the smallest pyramid level with enough pixels, of which only the part
+# in rect is brought up to date. Call while holding the stack
+def composite_region(pid, stack, rect, scale):
+    x, y, w, h = rect
+    size = (max(round(w * scale), 1), max(round(h * scale), 1))
+    k = level_for(scale)
+    image = stack.get_collapsed_stack_as_image()
+    if k:
+        pyramid = _pyramid(pid, stack, None, stack.composite_version())
+        level = pyramid.level(image, k, rect)
+        _keep((pid, "composite"), pyramid)
+    else:
+        level = image
+    region = level[y >> k:-(-(y + h) >> k), x >> k:-(-(x + w) >> k)]
+    if region.shape[1::-1] == size:
+        return region.copy()
+    return _shrink(region, size)
+
+
+# Pyramid of layer i of stack (or the composite when i is None), told what changed
+# since it was last used
+def _pyramid(pid, stack, i, version):
+    source = stack if i is None else stack.at(i)
+    key = (pid, "composite" if i is None else source.id())
+    with _lock:
+        pyramid = _pyramids.get(key)
+        if pyramid is not None:
+            _pyramids.move_to_end(key)
+    height, width = stack.shape()
+    if pyramid is None or (pyramid.height, pyramid.width) != (height, width):
+        pyramid = Pyramid(height, width)
+    if pyramid.source is None or pyramid.source() is not source:
+        pyramid.changed(_changes(stack, i, None), version, source)
+    elif pyramid.version != version:
+        pyramid.changed(_changes(stack, i, pyramid.version), version, source)
+    return pyramid
+
+
+# Tiles of layer i (or the composite) that changed since version
+def _changes(stack, i, version):
+    if i is None:
+        return stack.composite_changes(version)
+    layer = stack.at(i)
+    # Adjustment layers show the composite below them, every tile may have changed
+    if version is None or version[:1] != (layer.id(),) or len(version) != 2:
+        rows, cols = -(-stack.shape()[0] // TILE_SIZE), -(-stack.shape()[1] // TILE_SIZE)
+        return np.ones((rows, cols), bool)
+    return layer.changed_tiles(version[1])
+
+
+def _keep(key, pyramid):
+    with _lock:
+        _pyramids[key] = pyramid
+        total = sum(x.nbytes() for x in _pyramids.values())
+        while total > PYRAMID_CACHE_MAX_BYTES and len(_pyramids) > 1:
+            total -= _pyramids.popitem(last=False)[1].nbytes()
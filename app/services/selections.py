@@ -0,0 +1,48 @@
+# Active selection of each project, kept on the server so selection modes (add,
+# subtract, intersect) and operations (invert, grow, shrink, feather) only need the
+# new part from the client, and only the part that changed goes back.
+# Selections are stored as their bounding box and, unless feathered, 1 bit per pixel.
+
+import threading
+
+from app.models.selection import SelectionMask
+
+_selections = {}  # project id -> packed selection bytes, or SelectionMask when feathered
+_lock = threading.Lock()
+
+
+# Active selection of pid on a width x height canvas, empty if there is none.
+# A selection made on a canvas of another size is dropped
+def active(pid, width, height):
+    with _lock:
+        return _active(pid, width, height)
+
+
+def _active(pid, width, height):
+    stored = _selections.get(pid)
+    if stored is not None:
+        selection = SelectionMask.from_packed(stored) if isinstance(stored, bytes) else stored
+        if (selection.width, selection.height) == (width, height):
+            return selection
+    return SelectionMask(width, height)
+
+
+# Replace the active selection of pid with change(active selection).
+# Returns (the changed region of the selection, the new selection). The lock is held
+# throughout, so concurrent changes of a selection are applied one after the other
+def update(pid, width, height, change):
+    with _lock:
+        before = _active(pid, width, height)
+        after = change(before)
+        if after.is_empty():
+            _selections.pop(pid, None)
+        else:
+            _selections[pid] = after.packed() if after.is_hard() else after
+    return before.changes_to(after), after
+
+
+# Drop the active selection of pid. Registered with stacks.on_evict, so selections
+# go with their project
+def clear(pid):
+    with _lock:
+        _selections.pop(pid, None)
@@ -0,0 +1,326 @@
+# In-process LRU cache of live LayerStacks keyed by project id.
+# Handlers check stacks out of here instead of loading users/<pid> on every request.
+# Changed stacks are only marked dirty and written back later: when they are
+# evicted, by the background flush timer, or on an explicit save.
+# Stacks are stored in the project folder format (users/<pid>/project), projects
+# that only have the old users/<pid>/layers.pickle are converted on first save.
+# With mmap on, layer pixels are memory-mapped from the project folder instead of
+# held in RAM, and do not count against the memory budget.
+
+import atexit
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from app.models.LayerStack import LayerStack
+
+
+class StackCache:
+
+    def __init__(self, root="users", max_bytes=1024 ** 3, flush_interval=5.0, mmap=False):
+        self._root = root
+        self._mmap = mmap
+        self._max_bytes = max_bytes
+        self._flush_interval = flush_interval
+        self._stacks = OrderedDict()    # pid -> LayerStack, least recently used first
+        self._sizes = {}                # pid -> bytes used by the stack's pixels
+        self._dirty = set()
+        self._locks = {}                # pid -> lock held while a stack is in use
+        self._lock = threading.RLock()  # guards the dicts above
+        self._edit_hooks = []
+        self._evict_hooks = []
+        self._timer = None
+        self._stop = threading.Event()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writebacks = 0
+
+    def configure(self, root=None, max_bytes=None, flush_interval=None, mmap=None):
+        if root is not None:
+            self._root = root
+        if max_bytes is not None:
+            self._max_bytes = max_bytes
+        if flush_interval is not None:
+            self._flush_interval = flush_interval
+        if mmap is not None:
+            self._mmap = mmap
+
+    def path(self, pid):
+        return os.path.join(self._root, pid, "project")
+
+    def legacy_path(self, pid):
+        return os.path.join(self._root, pid, "layers.pickle")
+
+    # Folder of the layer PNGs the editor shows. Every export goes here, under the same
+    # path, so a layer exported once is not exported again until it changes
+    def layers_folder(self, pid):
+        return os.path.join(self._root, pid, "layers")
+
+    # Check out a stack for reading. Yields None if the project does not exist
+    @contextmanager
+    def view(self, pid):
+        with self._locked(pid):
+            yield self._get(pid)
+
+    # Check out a stack for changing it. The stack is marked dirty when the block exits,
+    # also by an exception: whatever was changed before it still has to be written back.
+    # hooks=False skips the on_edit functions
+    @contextmanager
+    def edit(self, pid, hooks=True):
+        with self._locked(pid):
+            stack = self._get(pid)
+            try:
+                if stack is not None and hooks:
+                    for fn in self._edit_hooks:
+                        fn(pid, stack)
+                yield stack
+            finally:
+                if stack is not None:
+                    self._release_dirty(pid, stack)
+
+    # Have fn(pid, stack) called whenever a stack is checked out for editing, before the
+    # caller changes it
+    def on_edit(self, fn):
+        if fn not in self._edit_hooks:
+            self._edit_hooks.append(fn)
+
+    # Have fn(pid) called whenever a project leaves the cache, evicted or replaced by
+    # another stack, so state kept per project elsewhere can be let go with it
+    def on_evict(self, fn):
+        if fn not in self._evict_hooks:
+            self._evict_hooks.append(fn)
+
+    # Add a new (or replaced) stack to the cache
+    def put(self, pid, stack, dirty=True):
+        with self._locked(pid):
+            if self._mmap:
+                stack.use_memmap(self.path(pid))
+            with self._lock:
+                replaced = self._stacks.get(pid) not in (None, stack)
+                self._stacks[pid] = stack
+                self._stacks.move_to_end(pid)
+                self._sizes[pid] = stack.nbytes()
+                if dirty:
+                    self._dirty.add(pid)
+            if replaced:
+                self._run_evict_hooks(pid)
+            self._enforce_budget(keep=pid)
+            self._start_timer()
+
+    def mark_dirty(self, pid):
+        with self._lock:
+            if pid in self._stacks:
+                self._dirty.add(pid)
+                self._sizes[pid] = self._stacks[pid].nbytes()
+
+    # Write one project back to disk now, if it has unsaved changes
+    def save(self, pid):
+        with self._locked(pid):
+            with self._lock:
+                stack = self._stacks.get(pid)
+                if stack is None or pid not in self._dirty:
+                    return True
+                self._dirty.discard(pid)
+            return self._write(pid, stack)
+
+    # Write every dirty stack back to disk. Returns number of stacks written
+    def flush(self):
+        with self._lock:
+            pids = list(self._dirty)
+        written = 0
+        for pid in pids:
+            with self._locked(pid):
+                with self._lock:
+                    stack = self._stacks.get(pid)
+                    if stack is None or pid not in self._dirty:
+                        continue
+                    self._dirty.discard(pid)
+                if self._write(pid, stack):
+                    written += 1
+        return written
+
+    # Drop a project from the cache, writing it back first if it is dirty
+    def evict(self, pid):
+        with self._locked(pid):
+            self._evict_locked(pid)
+
+    def _evict_locked(self, pid):
+        with self._lock:
+            stack = self._stacks.pop(pid, None)
+            self._sizes.pop(pid, None)
+            dirty = pid in self._dirty
+            self._dirty.discard(pid)
+            if stack is not None:
+                self.evictions += 1
+        if stack is not None and dirty:
+            self._write(pid, stack)
+        if stack is not None:
+            self._run_evict_hooks(pid)
+        # Only once written, so nobody loads it half way. Whoever waits for the lock
+        # finds it gone and takes a new one, see _acquire
+        with self._lock:
+            self._locks.pop(pid, None)
+
+    # Flush and empty the cache, stopping the flush timer
+    def close(self):
+        self._stop.set()
+        self.flush()
+        with self._lock:
+            self._stacks.clear()
+            self._sizes.clear()
+            self._dirty.clear()
+        if self._timer is not None:
+            self._timer.join()
+            self._timer = None
+        self._stop.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "projects": len(self._stacks),
+                "dirty": len(self._dirty),
+                "bytes": sum(self._sizes.values()),
+                "max_bytes": self._max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "writebacks": self.writebacks,
+            }
+
+    def _run_evict_hooks(self, pid):
+        for fn in self._evict_hooks:
+            fn(pid)
+
+    def _project_lock(self, pid):
+        with self._lock:
+            lock = self._locks.get(pid)
+            if lock is None:
+                lock = self._locks[pid] = threading.RLock()
+            return lock
+
+    # Acquire the lock of pid and return it, or None when blocking is off and it is held.
+    # A lock dropped by evict while waiting for it is let go, and the current one taken
+    def _acquire(self, pid, blocking=True):
+        while True:
+            lock = self._project_lock(pid)
+            if not lock.acquire(blocking=blocking):
+                return None
+            with self._lock:
+                if self._locks.get(pid) is lock:
+                    return lock
+            lock.release()
+
+    @contextmanager
+    def _locked(self, pid):
+        lock = self._acquire(pid)
+        try:
+            yield
+        finally:
+            lock.release()
+
+    # Return cached stack, or load it from disk. Caller holds the project lock
+    def _get(self, pid):
+        with self._lock:
+            stack = self._stacks.get(pid)
+            if stack is not None:
+                self._stacks.move_to_end(pid)
+                self.hits += 1
+                return stack
+            self.misses += 1
+
+        stack = self._load(pid)
+        if stack is None:
+            return None
+        with self._lock:
+            self._stacks[pid] = stack
+            self._sizes[pid] = stack.nbytes()
+        self._enforce_budget(keep=pid)
+        self._start_timer()
+        return stack
+
+    def _release_dirty(self, pid, stack):
+        with self._lock:
+            cached = self._stacks.get(pid) is stack
+            if cached:
+                self._dirty.add(pid)
+                self._sizes[pid] = stack.nbytes()
+        # Evicted while in use, so nobody else will write it back
+        if not cached:
+            self._write(pid, stack)
+        else:
+            self._enforce_budget(keep=pid)
+
+    def _load(self, pid):
+        stack = LayerStack(0, 0)
+        if os.path.exists(os.path.join(self.path(pid), "manifest.json")):
+            if not stack.load_project(self.path(pid), mmap=self._mmap):
+                return None
+            return stack
+        if os.path.exists(self.legacy_path(pid)):
+            if not stack.load_pickle(self.legacy_path(pid)):
+                return None
+            if self._mmap:
+                stack.use_memmap(self.path(pid))
+            return stack
+        return None
+
+    def _write(self, pid, stack):
+        ok = stack.save_project(self.path(pid))
+        with self._lock:
+            if ok:
+                self.writebacks += 1
+            else:
+                # Keep it dirty so the next flush tries again
+                if self._stacks.get(pid) is stack:
+                    self._dirty.add(pid)
+        return ok
+
+    # Evict least recently used stacks until the cache fits in its budget.
+    # Stacks another request is using right now are skipped, not waited for
+    def _enforce_budget(self, keep=None):
+        while True:
+            with self._lock:
+                if sum(self._sizes.values()) <= self._max_bytes:
+                    return
+                candidates = [pid for pid in self._stacks if pid != keep]
+            for pid in candidates:
+                lock = self._acquire(pid, blocking=False)
+                if lock is not None:
+                    try:
+                        self._evict_locked(pid)
+                    finally:
+                        lock.release()
+                    break
+            else:
+                return
+
+    def _start_timer(self):
+        if not self._flush_interval or self._flush_interval <= 0:
+            return
+        with self._lock:
+            if self._timer is not None:
+                return
+            self._timer = threading.Thread(target=self._run_timer, name="stack-cache-flush", daemon=True)
+            self._timer.start()
+
+    def _run_timer(self):
+        while not self._stop.wait(self._flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print("stack cache flush error:", e)
+
+
+# Shared by all blueprints
+stacks = StackCache()
+atexit.register(stacks.flush)
+
+
+def init_app(app):
+    stacks.configure(
+        max_bytes=app.config.get("STACK_CACHE_MAX_BYTES"),
+        flush_interval=app.config.get("STACK_CACHE_FLUSH_SECONDS"),
+        mmap=app.config.get("STACK_CACHE_MMAP"),
+    )
@@ -0,0 +1,206 @@
+# Streamed strokes: the points of one brush or eraser stroke arrive in many small
+# batches, over one chunked NDJSON request or over several short ones, and are drawn
+# into the live layer as they come in.
+# Points that arrive within COALESCE_SECONDS of each other are drawn in one pass.
+# The layer PNG is exported at most every DISPLAY_SECONDS and once more when the
+# stroke ends, and the whole stroke becomes a single undo entry. Writing the project
+# to disk is left to the stack cache as usual.
+
+import threading
+import time
+import uuid
+
+import numpy as np
+
+from app.models import history
+from app.models.Layer import TILE_SIZE, tile_span
+from app.services import exporter
+from app.services.stack_cache import stacks
+from app.services.tools import brush, eraser, stroke_rect
+
+COALESCE_SECONDS = 1 / 120
+DISPLAY_SECONDS = 0.1
+# Strokes that get no points for this long are finished by a background sweep
+IDLE_SECONDS = 30
+
+_sessions = {}  # (pid, stroke id) -> StrokeSession
+_lock = threading.Lock()
+_sweeper = None  # thread finishing idle strokes, runs while there are sessions
+
+
+class StrokeSession:
+
+    def __init__(self, pid, stroke_id, layer, tool="brush", color="#000000", size=5):
+        self.pid = pid
+        self.id = stroke_id
+        self.layer = layer
+        self.tool = tool
+        self.color = color
+        self.size = size
+        self.rect = None        # union of everything drawn so far
+        self.points = 0
+        self.batches = 0
+        self._last = None       # last point drawn, the next batch continues from it
+        self._before = {}       # (tile row, tile col) -> tile pixels before the stroke
+        self._exported_at = 0.0
+        self.touched = time.monotonic()
+
+    # The stack may have been evicted from the cache and loaded again between
+    # batches, keep drawing on the same layer of the new copy
+    def rebind(self, stack):
+        if any(x is self.layer for x in stack._layer_array):
+            return
+        for x in stack._layer_array:
+            if x.id() == self.layer.id():
+                self.layer = x
+                return
+
+    # Draw points (after the last point drawn) into the layer, with one cv2 pass
+    def draw(self, points):
+        self.touched = time.monotonic()
+        if not points:
+            return None
+        points = [self._last, *points] if self._last is not None else list(points)
+        if len(points) == 1:
+            points = points * 2
+        self._last = points[-1]
+
+        h, w = self.layer.pixels().shape[:2]
+        rect = stroke_rect(points, self.size, h, w)
+        if not rect[2] or not rect[3]:
+            return None
+        self._save_tiles(rect)
+        if self.tool == "eraser":
+            eraser(self.layer.get_image(), self.size, points)
+        else:
+            brush(self.layer.get_image(), self.color, self.size, points)
+        self.layer.mark_dirty(rect)
+
+        self.rect = rect if self.rect is None else _union(self.rect, rect)
+        self.points += len(points) - 1
+        self.batches += 1
+        return rect
+
+    # Keep the old pixels of tiles the stroke is about to touch for the first time
+    def _save_tiles(self, rect):
+        pixels = self.layer.pixels()
+        h, w = pixels.shape[:2]
+        rows, cols = tile_span(rect, -(-h // TILE_SIZE), -(-w // TILE_SIZE))
+        for ty in range(rows.start, rows.stop):
+            for tx in range(cols.start, cols.stop):
+                if (ty, tx) not in self._before:
+                    y, x = ty * TILE_SIZE, tx * TILE_SIZE
+                    self._before[ty, tx] = np.array(pixels[y:y + TILE_SIZE, x:x + TILE_SIZE])
+
+    # Queue the layer PNG, at most every DISPLAY_SECONDS unless forced
+    def export(self, stack, force=False):
+        now = time.monotonic()
+        if force or now - self._exported_at >= DISPLAY_SECONDS:
+            self._exported_at = now
+            exporter.export_layers(stack, stacks.layers_folder(self.pid))
+
+    # Record the stroke as one undo entry. The old pixels of its rect are the saved
+    # tiles, everything else in the rect was not drawn on
+    def finish(self, stack):
+        if self.rect is not None:
+            x, y, w, h = self.rect
+            before = np.array(self.layer.pixels()[y:y + h, x:x + w])
+            for (ty, tx), tile in self._before.items():
+                ty, tx = ty * TILE_SIZE, tx * TILE_SIZE
+                y0, y1 = max(ty, y), min(ty + tile.shape[0], y + h)
+                x0, x1 = max(tx, x), min(tx + tile.shape[1], x + w)
+                if y1 > y0 and x1 > x0:
+                    before[y0 - y:y1 - y, x0 - x:x1 - x] = tile[y0 - ty:y1 - ty, x0 - tx:x1 - tx]
+            stack.history().push(history.PixelChange(self.layer, self.rect, before))
+        self.export(stack, force=True)
+
+    def as_json(self):
+        return {"stroke": self.id, "rect": None if self.rect is None else list(self.rect),
+                "points": self.points, "batches": self.batches}
+
+
+def _union(a, b):
+    x0, y0 = min(a[0], b[0]), min(a[1], b[1])
+    x1, y1 = max(a[0] + a[2], b[0] + b[2]), max(a[1] + a[3], b[1] + b[3])
+    return x0, y0, x1 - x0, y1 - y0
+
+
+# Session for stroke_id, started on the selected layer of stack if it is new.
+# options are the tool, color and size sent with the first batch
+def session(pid, stack, stroke_id=None, **options):
+    stroke_id = stroke_id or uuid.uuid4().hex
+    with _lock:
+        current = _sessions.get((pid, stroke_id))
+        if current is None:
+            current = _sessions[pid, stroke_id] = StrokeSession(pid, stroke_id, stack.get_current_layer(), **options)
+            _start_sweeper()
+    current.rebind(stack)
+    return current
+
+
+# Finish current, once: a stroke ended by more than one caller is recorded only once
+def end(stack, current):
+    with _lock:
+        if _sessions.pop((current.pid, current.id), None) is None:
+            return
+    current.finish(stack)
+
+
+# Finish stroke_id of pid if it is still open. Call holding no stack
+def close(pid, stroke_id):
+    with _lock:
+        current = _sessions.get((pid, stroke_id))
+    if current is not None:
+        _close(current)
+
+
+# Finish the strokes of every project that got no points for IDLE_SECONDS, e.g. of a
+# stream that dropped in a project nobody edits again. Call holding no stack
+def end_idle():
+    now = time.monotonic()
+    with _lock:
+        idle = [x for x in _sessions.values() if now - x.touched > IDLE_SECONDS]
+    for x in idle:
+        _close(x)
+
+
+def _close(current):
+    with stacks.edit(current.pid, hooks=False) as stack:
+        if stack is not None:
+            end(stack, current)
+            return
+    # The project is gone, there is nothing to record the stroke in
+    with _lock:
+        _sessions.pop((current.pid, current.id), None)
+
+
+# Caller holds _lock
+def _start_sweeper():
+    global _sweeper
+    if _sweeper is None:
+        _sweeper = threading.Thread(target=_sweep, name="stroke-sweep", daemon=True)
+        _sweeper.start()
+
+
+def _sweep():
+    global _sweeper
+    while True:
+        time.sleep(IDLE_SECONDS / 2)
+        try:
+            end_idle()
+        except Exception as e:
+            print("stroke sweep error:", e)
+        with _lock:
+            if not _sessions:
+                _sweeper = None
+                return
+
+
+# End the open strokes of pid, except the one with id keep. No other edit may land in
+# the middle of a stroke, e.g. of one whose connection dropped before its end line:
+# registered with stacks.on_edit, this runs before every edit of the project
+def end_open(pid, stack, keep=None):
+    with _lock:
+        open_ = [x for (p, stroke_id), x in _sessions.items() if p == pid and stroke_id != keep]
+    for x in open_:
+        end(stack, x)
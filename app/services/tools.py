@@ -9,6 +9,15 @@ def hex_to_bgr(hex_color: str) -> tuple[int, int, int]:
     r, g, b = tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
     return (b, g, r)
 
+# Bounding rect (x, y, w, h) of a stroke through points, padded by the brush size
+# and clipped to the image
+def stroke_rect(points, size, height, width):
+    pts = np.asarray(points, dtype=np.int64).reshape(-1, 2)
+    pad = size // 2 + 2
+    x0, y0 = np.maximum(pts.min(axis=0) - pad, 0)
+    x1, y1 = np.minimum(pts.max(axis=0) + pad + 1, (width, height))
+    return int(x0), int(y0), max(int(x1 - x0), 0), max(int(y1 - y0), 0)
+
 def _ensure_bgra(img):
     if img.ndim == 2:
         return cv2.cvtColor(img, cv2.COLOR_GRAY2BGRA)
@@ -16,77 +25,89 @@ def _ensure_bgra(img):
         return cv2.cvtColor(img, cv2.COLOR_BGR2BGRA)
     return img
 
-def tool_brush(image_path: str, color: str, size: int, points: list[list[int]]):
-    if not points or len(points) < 2:
-        return
+# Array tools draw on a BGRA uint8 image in place and return the rect (x, y, w, h) they
+# changed, or None if nothing changed. They are used on layer pixels directly.
+# Brush and eraser only touch the stroke's bounding box, padded by the brush size:
+# they draw into a view of that rect, so a stroke costs the same on any canvas size
 
-    img = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
-    if img is None:
-        raise FileNotFoundError(f"Could not open picture: {image_path}")
-
-    # Convert to BGRA if needed
-    img = _ensure_bgra(img)
+def brush(img, color: str, size: int, points: list[list[int]]):
+    if not points or len(points) < 2:
+        return None
 
     # draw directly with cv2.line
     bgr_color = hex_to_bgr(color)
     bgra_color = (*bgr_color, 255)  # Full opacity
-    
-    for i in range(len(points) - 1):
-        x1, y1 = map(int, points[i])
-        x2, y2 = map(int, points[i+1])
-        cv2.line(img, (x1, y1), (x2, y2), bgra_color, thickness=size, lineType=cv2.LINE_AA)
-
-    cv2.imwrite(image_path, img)
-    
-def tool_eraser(image_path: str, size: int, points: list[list[int]]):
-    if not points or len(points) < 2:
-        return
-
-    img = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
-    if img is None:
-        raise FileNotFoundError(f"Could not open picture: {image_path}")
-
-    # Convert to BGRA if needed
-    img = _ensure_bgra(img)
-
-    # draw directly with cv2.line
-    transparent_color = (0, 0, 0, 0)  
-    
-    for i in range(len(points) - 1):
-        x1, y1 = map(int, points[i])
-        x2, y2 = map(int, points[i+1])
-        cv2.line(img, (x1, y1), (x2, y2), transparent_color, thickness=size, lineType=cv2.LINE_AA)
-
-    cv2.imwrite(image_path, img)
-    
+    return _draw_lines(img, points, bgra_color, size)
 
-def tool_bucket(image_path: str, color: str, start_point: list[int], tolerance: int = 10):
-    img = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
-    if img is None:
-        raise FileNotFoundError(f"Could not open picture: {image_path}")
-    
-    img = _ensure_bgra(img)
+def eraser(img, size: int, points: list[list[int]]):
+    if not points or len(points) < 2:
+        return None
+
+    transparent_color = (0, 0, 0, 0)
+    return _draw_lines(img, points, transparent_color, size)
+
+# Draw the polyline into the view of its rect, with points moved to the rect's origin
+def _draw_lines(img, points, color, size):
+    rect = stroke_rect(points, size, *img.shape[:2])
+    x, y, w, h = rect
+    if not w or not h:
+        return rect
+    roi = img[y:y + h, x:x + w]
+    pts = np.asarray(points, dtype=np.int64).reshape(-1, 2) - (x, y)
+    for i in range(len(pts) - 1):
+        x1, y1 = map(int, pts[i])
+        x2, y2 = map(int, pts[i+1])
+        cv2.line(roi, (x1, y1), (x2, y2), color, thickness=size, lineType=cv2.LINE_AA)
+    return rect
+
+def bucket(img, color: str, start_point: list[int], tolerance: int = 10):
     h, w = img.shape[:2]
     x, y = map(int, start_point)
-    
+
     if not (0 <= x < w and 0 <= y < h):
         raise ValueError(f"start_point out of bounds: ({x},{y}) not in [0..{w-1}]x[0..{h-1}]")
 
     new_bgr = hex_to_bgr(color)
-    
+
     # Check if the target color is the same as new color
     if tuple(img[y, x, :3]) == tuple(new_bgr):
-        return
+        return None
 
     # Fill using floodFill
     bgr_img = img[:, :, :3].copy()
     mask = np.zeros((h + 2, w + 2), np.uint8)
-    cv2.floodFill(bgr_img, mask, (x, y), new_bgr, 
+    cv2.floodFill(bgr_img, mask, (x, y), new_bgr,
                   loDiff=(tolerance,)*3, upDiff=(tolerance,)*3)
 
     # Updates to original image
     img[:, :, :3] = bgr_img
     filled = mask[1:-1, 1:-1] > 0
     img[filled, 3] = 255
+    return cv2.boundingRect(mask[1:-1, 1:-1])
+
+# PNG file versions of the tools: read the image, run the array tool, write it back
+
+def _on_png(image_path, tool, *args):
+    img = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
+    if img is None:
+        raise FileNotFoundError(f"Could not open picture: {image_path}")
 
-    cv2.imwrite(image_path, img)
\ No newline at end of file
+    # Convert to BGRA if needed
+    img = _ensure_bgra(img)
+    rect = tool(img, *args)
+    if rect is not None:
+        cv2.imwrite(image_path, img)
+    return rect
+
+def tool_brush(image_path: str, color: str, size: int, points: list[list[int]]):
+    if not points or len(points) < 2:
+        return
+    return _on_png(image_path, brush, color, size, points)
+
+def tool_eraser(image_path: str, size: int, points: list[list[int]]):
+    if not points or len(points) < 2:
+        return
+    return _on_png(image_path, eraser, size, points)
+
+def tool_bucket(image_path: str, color: str, start_point: list[int], tolerance: int = 10):
+    return _on_png(image_path, bucket, color, start_point, tolerance)
@@ -23,6 +23,25 @@
 
         if (slider) slider.value = Math.round(zoom * 100);
         if (valueEl) valueEl.textContent = `${Math.round(zoom * 100)}%`;
+        updateImageScale();
+    }
+
+    // Zoomed out, layers are loaded from the smallest pyramid level that still has
+    // enough pixels for the screen (1, 1/2, 1/4, ... of the full size, see layer_img)
+    let scaleTimer = null;
+    function updateImageScale(){
+        clearTimeout(scaleTimer);
+        scaleTimer = setTimeout(() => {
+            const needed = zoom * (window.devicePixelRatio || 1);
+            const level = Math.max(0, Math.min(5, Math.floor(Math.log2(1 / needed))));
+            const scale = String(Math.pow(2, -level));
+            document.querySelectorAll('.stacked-img').forEach((img) => {
+                const url = new URL(img.src, location.href);
+                if ((url.searchParams.get('scale') || '1') === scale) return;
+                url.searchParams.set('scale', scale);
+                img.src = url.toString();
+            });
+        }, 150);
     }
 
     stack.addEventListener('wheel', (e) => {
@@ -82,8 +82,31 @@ async function renameLayer(){
     })
 }
 
+async function undo(){
+    const res = await fetch("/api/v1/layers/undo", {
+        method: "POST"
+    });
+    if (res.ok) {
+        location.reload();
+    }
+}
+async function redo(){
+    const res = await fetch("/api/v1/layers/redo", {
+        method: "POST"
+    });
+    if (res.ok) {
+        location.reload();
+    }
+}
 
-
-
-
-
+// Run a filter on the selected layer, params go in the request body
+async function applyFilter(name, params = {}){
+    const res = await fetch(`/api/v1/filters/${name}`, {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify(params)
+    });
+    if (res.ok) {
+        location.reload();
+    }
+}
@@ -9,6 +9,7 @@ let state = {
   size: 10,
   drawing: false,
   points: [],
+  stroke: null,
   colors: {
     brush: "#ff0000",
     bucket: "#00ff00",
@@ -53,12 +54,14 @@ function reloadImage() {
   const imgEl = getActiveImgEl();
   if (!imgEl) return;
   
-  const base = imgEl.src.split("?")[0];
+  // Keeps the scale the zoom picked
+  const url = new URL(imgEl.src, location.href);
+  url.searchParams.set("t", Date.now());
   imgEl.addEventListener("load", function onload() {
     imgEl.removeEventListener("load", onload);
     ctx.clearRect(0, 0, canvas.width, canvas.height);
   });
-  imgEl.src = `${base}?t=${Date.now()}`;
+  imgEl.src = url.toString();
 }
 
 // Drawing
@@ -78,41 +81,75 @@ function drawSegment(a, b) {
 }
 
 //API Callss
-async function sendStroke() {
-  if (!state.points.length) return;
-  
+// Stroke points are streamed to the server while drawing, in small NDJSON batches.
+// One batch is in flight at a time, points that come in meanwhile go in the next one
+const STROKE_BATCH_MS = 33;
+
+function newStroke() {
+  return {
+    id: Date.now().toString(36) + Math.random().toString(36).slice(2),
+    tool: state.tool,
+    color: state.colors[state.tool],
+    size: Math.round(state.size),
+    queue: [],
+    ended: false,
+    timer: null,
+    sending: false
+  };
+}
+
+function queueStrokePoint(stroke, p) {
+  stroke.queue.push(p);
+  if (!stroke.timer && !stroke.sending) {
+    stroke.timer = setTimeout(() => sendStrokeBatch(stroke), STROKE_BATCH_MS);
+  }
+}
+
+async function sendStrokeBatch(stroke) {
+  clearTimeout(stroke.timer);
+  stroke.timer = null;
+  if (stroke.sending) return;
+  stroke.sending = true;
+
+  const points = stroke.queue;
+  const end = stroke.ended;
+  stroke.queue = [];
+  const lines = [
+    { stroke: stroke.id, tool: stroke.tool, color: stroke.color, size: stroke.size },
+    { points: points, end: end }
+  ];
+
   try {
-    const res = await fetch("/api/v1/tools/stroke", {
+    const res = await fetch("/api/v1/tools/stroke/stream", {
       method: "POST",
-      headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({
-        tool: state.tool,
-        color: state.colors[state.tool],
-        size: Math.round(state.size),
-        points: state.points
-      })
+      headers: { "Content-Type": "application/x-ndjson" },
+      body: lines.map(x => JSON.stringify(x)).join("\n") + "\n"
     });
-    
     if (!res.ok) {
       console.error("Stroke failed:", await res.text());
-      return;
     }
   } catch (err) {
     console.error("Fetch error:", err);
   }
-  
-  state.points = [];
-  reloadImage();
+  stroke.sending = false;
+
+  if (end) {
+    reloadImage();
+  } else if (stroke.queue.length || stroke.ended) {
+    sendStrokeBatch(stroke);
+  }
 }
 
-async function sendBucketFill(x, y) {
+// Shift-click fills every pixel of a similar color instead of only the clicked region
+async function sendBucketFill(x, y, similar) {
   try {
     const res = await fetch("/api/v1/tools/bucket_fill", {
       method: "POST",
       headers: { "Content-Type": "application/json" },
       body: JSON.stringify({
         color: state.colors.bucket,
-        start_point: [x, y]
+        start_point: [x, y],
+        contiguous: !similar
       })
     });
     
@@ -175,7 +212,7 @@ canvas.addEventListener("pointerdown", async (e) => {
   
   if (state.tool === "bucket") {
     const [x, y] = getCanvasXY(e);
-    await sendBucketFill(x, y);
+    await sendBucketFill(x, y, e.shiftKey);
     return;
   }
   
@@ -183,6 +220,8 @@ canvas.addEventListener("pointerdown", async (e) => {
     canvas.setPointerCapture(e.pointerId);
     state.drawing = true;
     state.points = [getCanvasXY(e)];
+    state.stroke = newStroke();
+    queueStrokePoint(state.stroke, state.points[0]);
   }
 });
 
@@ -193,19 +232,27 @@ canvas.addEventListener("pointermove", (e) => {
   const last = state.points[state.points.length - 1];
   drawSegment(last, p);
   state.points.push(p);
+  queueStrokePoint(state.stroke, p);
 });
 
 canvas.addEventListener("pointerup", async (e) => {
   if (!state.drawing) return;
   
   state.drawing = false;
-  state.points.push(getCanvasXY(e));
-  await sendStroke();
+  const p = getCanvasXY(e);
+  state.points = [];
+  state.stroke.queue.push(p);
+  state.stroke.ended = true;
+  await sendStrokeBatch(state.stroke);
 });
 
 canvas.addEventListener("pointercancel", () => {
   state.drawing = false;
   state.points = [];
+  if (state.stroke) {
+    state.stroke.ended = true;
+    sendStrokeBatch(state.stroke);
+  }
   ctx.clearRect(0, 0, canvas.width, canvas.height);
 });
 
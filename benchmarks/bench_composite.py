@@ -0,0 +1,63 @@
+# Times flattening a layer stack with the single-threaded compositor against the
+# thread pool compositor.
+# Run from the repository root: python -m benchmarks.bench_composite --workers 16
+
+import argparse
+import os
+import time
+
+import cv2
+import numpy as np
+
+from app.services import compositing
+
+
+# White background plus layers with a few thick anti-aliased strokes each
+def make_layers(count, height, width, seed=0):
+    rng = np.random.default_rng(seed)
+    images = [np.full((height, width, 4), 255, np.uint8)]
+    for _ in range(count - 1):
+        image = np.zeros((height, width, 4), np.uint8)
+        for _ in range(3):
+            p1, p2 = rng.integers(0, [width, height], size=(2, 2)).tolist()
+            color = rng.integers(0, 256, 3).tolist() + [int(rng.integers(100, 256))]
+            cv2.line(image, tuple(p1), tuple(p2), color, int(rng.integers(5, 40)), cv2.LINE_AA)
+        images.append(image)
+    return images
+
+
+def best_of(repeat, fn):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Single-threaded vs thread pool compositing")
+    parser.add_argument("--width", type=int, default=3840)
+    parser.add_argument("--height", type=int, default=2160)
+    parser.add_argument("--layers", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    images = make_layers(args.layers, args.height, args.width)
+    out = np.empty_like(images[0])
+
+    results = {}
+    for workers in sorted({1, args.workers}):
+        compositing.configure(workers)
+        compositing.composite(images, out)
+        results[workers] = best_of(args.repeat, lambda: compositing.composite(images, out))
+        print(f"{args.width}x{args.height}, {args.layers} layers, {workers:>2} worker(s): "
+              f"{results[workers] * 1000:8.1f} ms")
+
+    if args.workers > 1:
+        print(f"speedup: {results[1] / results[args.workers]:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
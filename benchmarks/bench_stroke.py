@@ -0,0 +1,58 @@
+# Times one brush stroke on growing canvases: the array tool drawing into the
+# stroke's bounding box, and the same stroke as the /tools/stroke route does it
+# (undo record, draw, tile update of the cached composite). Both should stay flat as
+# the canvas grows. For comparison, the old path that read and wrote the layer PNG.
+# Run from the repository root: python -m benchmarks.bench_stroke
+
+import argparse
+import os
+import tempfile
+
+import cv2
+import numpy as np
+
+from app.models.LayerStack import LayerStack
+from app.services.tools import brush, stroke_rect, tool_brush
+from benchmarks.bench_composite import best_of
+
+# A short freehand stroke, like one batch of pointer moves
+POINTS = [[100 + 6 * i, 120 + int(20 * np.sin(i / 3))] for i in range(40)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stroke cost against canvas size")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[512, 1024, 2048, 4096, 8192])
+    parser.add_argument("--brush", type=int, default=12)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--png", action="store_true", help="also time the PNG round trip")
+    args = parser.parse_args()
+
+    print(f"{'canvas':>11} {'tool':>10} {'route':>10}" + (f" {'png':>10}" if args.png else ""))
+    for size in args.sizes:
+        img = np.zeros((size, size, 4), np.uint8)
+        tool = best_of(args.repeat, lambda: brush(img, "#ff0000", args.brush, POINTS))
+
+        stack = LayerStack(size, size)
+        stack.add_base_layers()
+        stack.get_collapsed_stack_as_image()
+
+        def route_stroke():
+            layer = stack.get_current_layer()
+            with stack.record_pixels(stroke_rect(POINTS, args.brush, size, size)):
+                layer.mark_dirty(brush(layer.get_image(), "#ff0000", args.brush, POINTS))
+            stack.get_collapsed_stack_as_image()
+
+        route = best_of(args.repeat, route_stroke)
+        line = f"{size:>5}x{size:<5} {tool * 1000:8.2f}ms {route * 1000:8.2f}ms"
+
+        if args.png:
+            with tempfile.TemporaryDirectory() as folder:
+                path = os.path.join(folder, "layer.png")
+                cv2.imwrite(path, img)
+                png = best_of(3, lambda: tool_brush(path, "#ff0000", args.brush, POINTS))
+            line += f" {png * 1000:8.2f}ms"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+# Benchmark suite: compositing, tools, selections and persistence on synthetic
+# projects, over canvas sizes, layer counts and stroke lengths. Results go to a JSON
+# file, and a run can be compared with a stored one to catch slowdowns.
+# Run from the repository root:
+#   python -m benchmarks.suite --out results.json
+#   python -m benchmarks.suite --sizes 500 4k --baseline results.json --threshold 0.2
+#   python -m benchmarks.suite --results new.json --baseline results.json
+# Comparing exits with status 1 when a case got slower than the threshold allows.
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+from flask import session
+
+from app import create_app
+from app.config import TestConfig
+from app.models.LayerStack import LayerStack
+from app.services import imaging
+from app.services.stack_cache import stacks
+from app.services.tools import tool_brush, tool_bucket, tool_eraser
+from benchmarks.bench_composite import make_layers
+
+SIZES = {"500": (500, 500), "1k": (1024, 1024), "1080p": (1080, 1920), "2k": (2048, 2048),
+         "4k": (2160, 3840), "8k": (4320, 7680)}
+
+PID = "benchmark"
+
+
+# Canvas size as "WxH" or one of SIZES, (height, width)
+def parse_size(text):
+    if text in SIZES:
+        return SIZES[text]
+    w, _, h = text.partition("x")
+    return int(h or w), int(w)
+
+
+# Something like a photo for the edge based selections: a gradient with filled shapes
+def make_photo(height, width, seed=0):
+    rng = np.random.default_rng(seed)
+    image = np.empty((height, width, 4), np.uint8)
+    image[..., 0] = np.linspace(40, 200, width, dtype=np.uint8)
+    image[..., 1] = np.linspace(60, 180, height, dtype=np.uint8)[:, None]
+    image[..., 2] = 120
+    image[..., 3] = 255
+    for _ in range(12):
+        center = rng.integers(0, [width, height]).tolist()
+        radius = int(rng.integers(min(height, width) // 20, min(height, width) // 5))
+        cv2.circle(image, tuple(center), radius, rng.integers(0, 256, 3).tolist() + [255], -1, cv2.LINE_AA)
+    return image
+
+
+# Freehand stroke of length points, a random walk in steps of about 6 pixels
+def make_stroke(length, height, width, seed=0):
+    rng = np.random.default_rng(seed)
+    steps = rng.normal(0, 6, (length, 2)).cumsum(axis=0) + (width / 2, height / 2)
+    return np.clip(steps, 0, (width - 1, height - 1)).astype(int).tolist()
+
+
+def make_stack(height, width, layers):
+    stack = LayerStack(height, width)
+    stack.add_base_layers()
+    images = make_layers(layers, height, width)
+    stack.at(0).update(make_photo(height, width))
+    stack.at(1).update(images[1])
+    for image in images[2:]:
+        stack.create_layer()
+        stack.get_current_layer().update(image)
+    stack.history().clear()
+    return stack
+
+
+# Best time of repeat calls of fn, with setup() run untimed before each
+def timed(repeat, fn, setup=None):
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def touch_layers(stack):
+    for i in range(stack.size()):
+        stack.at(i).mark_dirty()
+
+
+def bench_stack(results, label, stack, repeat, folder):
+    results[f"composite_cold {label}"] = timed(repeat, stack.get_collapsed_stack_as_image, stack.invalidate_composite)
+    layer = stack.at(1)
+    results[f"composite_one_tile {label}"] = timed(
+        repeat * 4, stack.get_collapsed_stack_as_image, lambda: layer.mark_dirty((10, 10, 20, 20)))
+
+    path = os.path.join(folder, "stack.pkl")
+    results[f"save_pickle {label}"] = timed(repeat, lambda: stack.save_pickle(path))
+    loaded = LayerStack(0, 0)
+    results[f"load_pickle {label}"] = timed(repeat, lambda: loaded.load_pickle(path))
+
+    export = os.path.join(folder, "layers")
+    os.makedirs(export, exist_ok=True)
+    results[f"create_images_from_layers_at {label}"] = timed(
+        repeat, lambda: stack.create_images_from_layers_at(export), lambda: touch_layers(stack))
+
+
+# The PNG tools read and write the layer file on every call
+def bench_tools(results, label, height, width, strokes, repeat, folder):
+    path = os.path.join(folder, "tool.png")
+    cv2.imwrite(path, make_layers(2, height, width)[1])
+    for length in strokes:
+        points = make_stroke(length, height, width)
+        results[f"tool_brush {label} stroke={length}"] = timed(repeat, lambda: tool_brush(path, "#ff0000", 12, points))
+        results[f"tool_eraser {label} stroke={length}"] = timed(repeat, lambda: tool_eraser(path, 12, points))
+    # Alternate colors so every click fills
+    colors = iter(["#123456", "#654321"] * repeat)
+    results[f"tool_bucket {label}"] = timed(repeat, lambda: tool_bucket(path, next(colors), [0, 0]))
+
+
+# Selections on the composite. The edge based ones are timed cold, decoding the image
+# and building the edge data again, and warm, finding them cached
+def bench_selections(results, label, stack, repeat):
+    height, width = stack.shape()
+    corners = [width // 5, height // 5, width * 4 // 5, height * 4 // 5]
+    polygon = [[width // 5, height // 5], [width * 4 // 5, height // 3], [width // 2, height * 4 // 5]]
+    path = make_stroke(200, height, width)
+    anchors = [[width // 4, height // 4], [width * 3 // 4, height // 4], [width // 2, height * 3 // 4]]
+    layer = stack.at(0)
+    shapes = {
+        "rectangular_select": lambda: imaging.rectangular_select("composite", corners),
+        "freeform_select": lambda: imaging.freeform_select("composite", path),
+        "polygonal_select": lambda: imaging.polygonal_select("composite", polygon),
+    }
+    edges = {
+        "magic_lasso_select": lambda: imaging.magic_lasso_select("composite", polygon),
+        "live_wire_path": lambda: imaging.live_wire_path("composite", anchors[0], anchors[1]),
+        "live_wire_select": lambda: imaging.live_wire_select("composite", anchors),
+    }
+    for name, fn in shapes.items():
+        results[f"{name} {label}"] = timed(repeat, fn)
+    for name, fn in edges.items():
+        results[f"{name}_cold {label}"] = timed(repeat, fn, lambda: layer.mark_dirty((0, 0, 1, 1)))
+        results[f"{name}_warm {label}"] = timed(repeat, fn)
+
+
+def run(args):
+    results = {}
+    app = create_app(TestConfig)
+    with tempfile.TemporaryDirectory() as folder:
+        # The stack cache and the selections find projects under users/
+        os.chdir(folder)
+        os.makedirs(os.path.join("users", PID, "layers"))
+        for size in args.sizes:
+            height, width = parse_size(size)
+            bench_tools(results, f"size={size}", height, width, args.strokes, args.repeat, folder)
+            for layers in args.layers:
+                label = f"size={size} layers={layers}"
+                print(f"{label} ...", file=sys.stderr)
+                stack = make_stack(height, width, layers)
+                bench_stack(results, label, stack, args.repeat, folder)
+                stacks.put(PID, stack, dirty=False)
+                with app.test_request_context():
+                    session["pid"] = PID
+                    bench_selections(results, label, stack, args.repeat)
+                stacks.evict(PID)
+    return {"meta": meta(), "results": results}
+
+
+def meta():
+    return {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+# Cases slower than baseline by more than threshold (0.2 = 20%) and by more than
+# min_delta seconds, which keeps timer noise in the fastest cases out, as
+# (name, baseline seconds, seconds)
+def slowdowns(baseline, current, threshold, min_delta=0.0):
+    slower = []
+    for name, seconds in current["results"].items():
+        before = baseline["results"].get(name)
+        if before is not None and seconds > before * (1 + threshold) and seconds - before > min_delta:
+            slower.append((name, before, seconds))
+    return slower
+
+
+def print_results(current, baseline=None):
+    for name, seconds in current["results"].items():
+        line = f"{name:<60} {seconds * 1000:10.2f} ms"
+        before = baseline["results"].get(name) if baseline else None
+        if before:
+            line += f" {(seconds / before - 1) * 100:+7.1f}%"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark suite with JSON results and baseline comparison")
+    parser.add_argument("--sizes", nargs="+", default=["500", "2k", "4k"],
+                        help=f"canvas sizes, WxH or one of {', '.join(SIZES)}")
+    parser.add_argument("--layers", type=int, nargs="+", default=[2, 8])
+    parser.add_argument("--strokes", type=int, nargs="+", default=[10, 100], help="stroke lengths in points")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--out", help="write the results to this JSON file")
+    parser.add_argument("--results", help="compare this results file instead of running")
+    parser.add_argument("--baseline", help="results file to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown, 0.2 is 20%%")
+    parser.add_argument("--min-delta-ms", type=float, default=0.5, help="slowdowns smaller than this are ignored")
+    args = parser.parse_args()
+
+    if args.results:
+        with open(args.results) as f:
+            current = json.load(f)
+    else:
+        cwd = os.getcwd()
+        try:
+            current = run(args)
+        finally:
+            os.chdir(cwd)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(current, f, indent=2)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_results(current, baseline)
+    if baseline is None:
+        return
+
+    slower = slowdowns(baseline, current, args.threshold, args.min_delta_ms / 1000)
+    for name, before, seconds in slower:
+        print(f"SLOWER {name}: {before * 1000:.2f} ms -> {seconds * 1000:.2f} ms", file=sys.stderr)
+    if slower:
+        sys.exit(1)
+    print(f"no case slower than {args.threshold:.0%} over the baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+import pytest
+
+from app import create_app
+from app.config import TestConfig
+from app.models.LayerStack import LayerStack
+from app.services import exporter
+from app.services.stack_cache import stacks
+
+
+# Opens a project for route tests: project(stack, pid) puts stack (by default a blank
+# 300x400 one with the base layers) in the stack cache under users/<pid> of a temporary
+# folder, and returns a client logged in to it with the stack. Every project opened is
+# evicted afterwards, also when the test fails
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    opened = []
+
+    def open_project(stack=None, pid="project"):
+        if stack is None:
+            stack = LayerStack(300, 400)
+            stack.add_base_layers()
+        (tmp_path / "users" / pid / "layers").mkdir(parents=True, exist_ok=True)
+        stacks.put(pid, stack)
+        opened.append(pid)
+        client = create_app(TestConfig).test_client()
+        with client.session_transaction() as s:
+            s["pid"] = pid
+        return client, stack
+
+    yield open_project
+    exporter.flush()
+    for pid in opened:
+        stacks.evict(pid)
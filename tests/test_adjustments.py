@@ -0,0 +1,105 @@
+import cv2
+import numpy as np
+
+from app.models.LayerStack import LayerStack
+from app.services import compositing
+from app.services.stack_cache import stacks
+
+
+def _stack():
+    stack = LayerStack(600, 700)
+    stack.add_base_layers()
+    image = np.random.default_rng(7).integers(0, 256, (600, 700, 4), dtype=np.uint8)
+    stack.at(1).update(image)
+    return stack
+
+
+def _paint(stack, i, rect, color):
+    x, y, w, h = rect
+    layer = stack.at(i)
+    with stack.record_pixels(rect, layer):
+        layer.get_image()[y:y + h, x:x + w] = color
+        layer.mark_dirty(rect)
+
+
+def test_adjustments_apply_to_the_layers_below():
+    stack = _stack()
+    below = stack.get_collapsed_stack_as_image().copy()
+    stack.create_adjustment_layer("levels", {"in_black": 20, "in_white": 220, "gamma": 1.4})
+    levels = stack.at(2)
+    assert np.array_equal(stack.get_collapsed_stack_as_image(), levels.apply(below))
+
+    stack.create_adjustment_layer("hue_saturation", {"hue": 90, "saturation": -40, "lightness": 10})
+    expected = stack.at(3).apply(levels.apply(below))
+    assert np.array_equal(stack.get_collapsed_stack_as_image(), expected)
+
+    stack.toggle_visible_at(2)
+    assert np.array_equal(stack.get_collapsed_stack_as_image(), stack.at(3).apply(below))
+
+
+def test_only_changed_tiles_are_computed_again():
+    stack = _stack()
+    stack.create_adjustment_layer("levels", {"gamma": 2.0})
+    levels = stack.at(2)
+    stack.get_collapsed_stack_as_image()
+    kept = {tile: image for tile, (_, image) in levels._tiles.items()}
+
+    # Below the adjustment in one tile, and on a new layer above it
+    _paint(stack, 1, (300, 280, 20, 20), (0, 0, 255, 255))
+    stack.create_layer()
+    _paint(stack, 3, (10, 10, 5, 5), (255, 0, 0, 255))
+    result = stack.get_collapsed_stack_as_image()
+    assert [tile for tile, (_, image) in levels._tiles.items() if image is not kept[tile]] == [(1, 1)]
+
+    expected = compositing.blend(levels.apply(stack._composite_rect(2, (0, 0, 700, 600))), stack.at(3).pixels())
+    assert np.array_equal(result, expected)
+
+    stack.select_layer(2)
+    assert stack.set_adjustment_params({"gamma": 0.5})
+    stack.get_collapsed_stack_as_image()
+    assert all(image is not kept[tile] for tile, (_, image) in levels._tiles.items())
+
+
+def test_blur_matches_the_whole_image():
+    stack = _stack()
+    stack.create_adjustment_layer("blur", {"radius": 6})
+    below = stack._composite_rect(2, (0, 0, 700, 600))
+    expected = cv2.GaussianBlur(below, (13, 13), 0, borderType=cv2.BORDER_REFLECT_101)
+    assert np.array_equal(stack.get_collapsed_stack_as_image(), expected)
+
+    # Next to a tile border, so the tiles around it read the change too
+    _paint(stack, 1, (250, 250, 4, 4), (0, 255, 0, 255))
+    below = stack._composite_rect(2, (0, 0, 700, 600))
+    expected = cv2.GaussianBlur(below, (13, 13), 0, borderType=cv2.BORDER_REFLECT_101)
+    assert np.array_equal(stack.get_collapsed_stack_as_image(), expected)
+
+
+def test_undo_params_and_round_trip(tmp_path):
+    stack = _stack()
+    stack.create_adjustment_layer("levels", {"out_white": 200})
+    before = stack.get_collapsed_stack_as_image().copy()
+    assert stack.set_adjustment_params({"out_white": 100})
+    assert not np.array_equal(stack.get_collapsed_stack_as_image(), before)
+    assert stack.undo()
+    assert stack.at(2).params()["out_white"] == 200
+    assert np.array_equal(stack.get_collapsed_stack_as_image(), before)
+
+    assert stack.save_project(tmp_path)
+    loaded = LayerStack(0, 0)
+    assert loaded.load_project(tmp_path)
+    assert loaded.get_as_json()["layers"][2]["adjustment"] == "levels"
+    assert np.array_equal(loaded.get_collapsed_stack_as_image(), before)
+
+
+def test_adjustment_routes(project):
+    client, _ = project()
+
+    assert client.post("/api/v1/layers/adjustment", json={"kind": "curves"}).status_code == 400
+    assert client.post("/api/v1/layers/adjustment", json={"kind": "blur", "params": {"radius": 2}}).status_code == 200
+    assert client.post("/api/v1/layers/adjustment/params", json={"params": {"radius": 0}}).status_code == 400
+    assert client.post("/api/v1/layers/adjustment/params", json={"params": {"radius": 3}}).status_code == 200
+    # Nothing to draw on
+    res = client.post("/api/v1/tools/bucket_fill", json={"start_point": [5, 5], "color": "#ff0000"})
+    assert res.status_code == 400
+    with stacks.view("project") as stack:
+        assert stack.at(2).params() == {"radius": 3}
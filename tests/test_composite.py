@@ -0,0 +1,76 @@
+import zlib
+
+import cv2
+import numpy as np
+
+from app.models.LayerStack import LayerStack
+from app.services import pyramid
+from app.services.stack_cache import stacks
+
+
+def _stack():
+    stack = LayerStack(300, 520)
+    stack.add_base_layers()
+    image = np.random.default_rng(5).integers(0, 256, (300, 520, 4), dtype=np.uint8)
+    stack.at(1).update(image)
+    return stack
+
+
+def test_composite_regions(project):
+    client, stack = project(_stack())
+    full = stack.get_collapsed_stack_as_image().copy()
+
+    res = client.get("/api/v1/layers/composite")
+    assert res.status_code == 200 and res.mimetype == "image/png"
+    assert np.array_equal(cv2.imdecode(np.frombuffer(res.data, np.uint8), cv2.IMREAD_UNCHANGED), full)
+
+    res = client.get("/api/v1/layers/composite?x=-10&y=20&w=300&h=400&format=raw")
+    assert res.headers["X-Rect"] == "0,20,290,280"
+    raw = np.frombuffer(res.data, np.uint8).reshape(280, 290, 4)
+    assert np.array_equal(raw, cv2.cvtColor(full[20:300, :290], cv2.COLOR_BGRA2RGBA))
+
+    # A pyramid level, cut to the viewport
+    res = client.get("/api/v1/layers/composite?x=256&y=0&w=256&h=128&scale=0.5&format=raw")
+    assert (res.headers["X-Width"], res.headers["X-Height"]) == ("128", "64")
+    level = pyramid.Pyramid(300, 520)
+    level.changed(np.ones((2, 3), bool), None, stack)
+    expected = cv2.cvtColor(level.level(full, 1)[:64, 128:256], cv2.COLOR_BGRA2RGBA)
+    assert np.array_equal(np.frombuffer(res.data, np.uint8).reshape(64, 128, 4), expected)
+
+    res = client.get("/api/v1/layers/composite?scale=0.3&format=jpeg&quality=80")
+    assert res.mimetype == "image/jpeg"
+    assert cv2.imdecode(np.frombuffer(res.data, np.uint8), cv2.IMREAD_UNCHANGED).shape == (90, 156, 3)
+
+    etag = res.headers["ETag"]
+    again = client.get("/api/v1/layers/composite?scale=0.3&format=jpeg&quality=80", headers={"If-None-Match": etag})
+    assert again.status_code == 304
+    with stacks.edit("project") as stack:
+        stack.at(1).get_image()[0, 0] = 0
+        stack.at(1).mark_dirty((0, 0, 1, 1))
+    changed = client.get("/api/v1/layers/composite?scale=0.3&format=jpeg&quality=80", headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+
+    for query in ("scale=2", "format=gif", "quality=0", "x=1", "x=600&y=0&w=10&h=10"):
+        assert client.get(f"/api/v1/layers/composite?{query}").status_code == 400
+
+
+def test_layer_raw(project):
+    client, stack = project(_stack())
+    layer = stack.at(1).pixels()
+
+    res = client.get("/api/v1/layers/1/raw?tile=1,2")
+    assert res.headers["X-Rect"] == "512,256,8,44"
+    assert (res.headers["X-Width"], res.headers["X-Height"], res.headers["X-Stride"]) == ("8", "44", "32")
+    assert "Content-Encoding" not in res.headers and res.content_length == 8 * 44 * 4
+    assert np.array_equal(np.frombuffer(res.data, np.uint8).reshape(44, 8, 4),
+                          cv2.cvtColor(layer[256:, 512:], cv2.COLOR_BGRA2RGBA))
+
+    res = client.get("/api/v1/layers/1/raw?deflate=1", headers={"Accept-Encoding": "gzip, deflate"})
+    assert res.headers["Content-Encoding"] == "deflate"
+    pixels = np.frombuffer(zlib.decompress(res.data), np.uint8).reshape(300, 520, 4)
+    assert np.array_equal(pixels, cv2.cvtColor(layer, cv2.COLOR_BGRA2RGBA))
+    # Not compressed for a client that cannot decompress it
+    assert "Content-Encoding" not in client.get("/api/v1/layers/1/raw?deflate=1").headers
+
+    assert client.get("/api/v1/layers/5/raw").status_code == 404
+    assert client.get("/api/v1/layers/1/raw?tile=a").status_code == 400
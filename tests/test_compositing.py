@@ -0,0 +1,161 @@
+import cv2
+import numpy as np
+
+from app.models.LayerStack import LayerStack
+from app.services import compositing
+
+
+def _random_layers(count, h, w, seed=0):
+    rng = np.random.default_rng(seed)
+    images = [np.full((h, w, 4), 255, np.uint8)]
+    for _ in range(count):
+        image = np.zeros((h, w, 4), np.uint8)
+        for _ in range(4):
+            p1, p2 = rng.integers(0, [w, h], size=(2, 2)).tolist()
+            color = rng.integers(0, 256, 3).tolist() + [int(rng.integers(1, 256))]
+            cv2.line(image, tuple(p1), tuple(p2), color, int(rng.integers(1, 30)), cv2.LINE_AA)
+        # Semi-transparent noise in one corner, fully opaque patch in another
+        image[:40, :50] = rng.integers(0, 256, (40, 50, 4))
+        image[-30:, -70:] = (*rng.integers(0, 256, 3).tolist(), 255)
+        images.append(image)
+    return images
+
+
+def test_matches_reference_within_one_level():
+    # Sizes that are not multiples of the block size
+    images = _random_layers(8, 203, 317)
+    result = compositing.composite(images)
+    reference = compositing.composite_reference(images)
+    assert np.abs(result.astype(int) - reference).max() <= 1
+
+
+def test_transparent_base():
+    images = _random_layers(4, 130, 90, seed=1)
+    images[0] = np.zeros_like(images[0])
+    result = compositing.composite(images)
+    reference = compositing.composite_reference(images)
+    assert np.abs(result.astype(int) - reference).max() <= 1
+
+
+# get_collapsed_stack_as_image before the block engine, kept to compare against.
+# It truncated instead of rounding, and the + 0.000001 made even opaque colors
+# truncate one level down, so every layer darkened the image by up to one level
+def _baseline_collapse(images):
+    dst = images[0].copy()
+    for foreground in images[1:]:
+        cb, ab = dst[:, :, :3], dst[:, :, 3] / 255.0
+        ct, at = foreground[:, :, :3], foreground[:, :, 3] / 255.0
+        ao = at + ab * (1 - at)
+        co = (ct * at[:, :, None] + cb * ab[:, :, None] * (1 - at[:, :, None])) / (ao[:, :, None] + 0.000001)
+        dst[:, :, :3] = co
+        dst[:, :, 3] = np.clip(ao * 255, 0, 255).astype(np.uint8)
+    return dst
+
+
+def test_against_baseline_collapse():
+    background = np.full((4, 4, 4), 255, np.uint8)
+    square = np.zeros((4, 4, 4), np.uint8)
+    square[:2, :2] = (40, 60, 200, 255)
+    glaze = np.zeros((4, 4, 4), np.uint8)
+    glaze[1:3, 1:3] = (250, 10, 10, 128)
+    images = [background, square, glaze]
+
+    result = compositing.composite(images)
+    assert result[0, 0].tolist() == [40, 60, 200, 255]
+    assert result[3, 3].tolist() == [255, 255, 255, 255]
+    assert result[1, 1].tolist() == [145, 35, 105, 255]
+    # The baseline loses up to a level at every layer, also where it is opaque or fully
+    # transparent
+    baseline = _baseline_collapse(images)
+    assert baseline[0, 0].tolist() == [38, 58, 198, 255]
+    assert baseline[3, 3].tolist() == [253, 253, 253, 255]
+    assert baseline[1, 1].tolist() == [144, 34, 104, 255]
+
+    # Elsewhere the difference stays within the number of layers blended
+    for images in (_random_layers(4, 203, 317), _random_layers(8, 130, 90, seed=1)):
+        difference = compositing.composite(images).astype(int) - _baseline_collapse(images)
+        assert -1 <= difference.min() and difference.max() <= len(images) - 1
+
+
+def test_premultiplied_upper_layers_match_reference():
+    images = _random_layers(8, 203, 317)
+    reference = compositing.composite_reference(images)
+    for split in range(1, len(images)):
+        result = compositing.composite(images[:split])
+        compositing.blend_premultiplied(result, compositing.composite_premultiplied(images[split:]))
+        assert np.abs(result.astype(int) - reference).max() <= 1
+
+
+def test_stack_skips_hidden_layers():
+    stack = LayerStack(64, 64)
+    stack.add_base_layers()
+    image = stack.at(1).get_image().copy()
+    image[10:20, 10:20] = (0, 0, 255, 255)
+    stack.at(1).update(image)
+    assert tuple(stack.get_collapsed_stack_as_image()[15, 15]) == (0, 0, 255, 255)
+    stack.toggle_visible_at(1)
+    assert tuple(stack.get_collapsed_stack_as_image()[15, 15]) == (255, 255, 255, 255)
+
+
+def _flatten(stack):
+    images = [x.get_image() for i, x in enumerate(stack._layer_array) if i == 0 or not x.is_hidden()]
+    return compositing.composite_reference(images)
+
+
+def _assert_close(stack):
+    result = stack.get_collapsed_stack_as_image()
+    assert np.abs(result.astype(int) - _flatten(stack)).max() <= 1
+
+
+def test_cached_composites_follow_stack_changes():
+    images = _random_layers(5, 300, 560, seed=2)
+    stack = LayerStack(300, 560)
+    stack.add_base_layers()
+    stack.at(1).update(images[1])
+    for image in images[2:]:
+        stack.create_layer()
+        stack.get_current_layer().update(image)
+    stack.select_layer(2)
+    _assert_close(stack)
+
+    # Painting on the selected layer reuses the cached composites
+    below = stack._composite_cache["below"]
+    stack.get_current_layer().get_image()[:, :20] = (10, 200, 30, 255)
+    stack.get_current_layer().mark_dirty((0, 0, 20, 300))
+    _assert_close(stack)
+    assert stack._composite_cache["below"] is below
+
+    # So does painting on other layers, only the touched tiles are redone
+    stack.at(1).get_image()[250:260, 300:320] = (0, 0, 0, 255)
+    stack.at(1).mark_dirty((300, 250, 20, 10))
+    stack.at(4).get_image()[:5] = (0, 0, 250, 100)
+    stack.at(4).mark_dirty((0, 0, 560, 5))
+    _assert_close(stack)
+    assert stack._composite_cache["below"] is below
+
+    for change in (lambda: stack.toggle_visible_at(4),
+                   lambda: stack.toggle_visible_at(2),
+                   lambda: stack.swap_layers(1, 3),
+                   lambda: stack.select_layer(4),
+                   stack.duplicate_selected_layer,
+                   lambda: stack.select_layer(0),
+                   lambda: stack.select_layer(1),
+                   stack.delete_selected_layer,
+                   stack.create_layer):
+        change()
+        _assert_close(stack)
+
+
+def test_thread_pool_matches_single_thread():
+    images = _random_layers(6, 700, 300, seed=3)
+    single = compositing.composite(images)
+    workers = compositing.workers()
+    compositing.configure(4)
+    try:
+        assert np.array_equal(compositing.composite(images), single)
+        out = np.array(images[0])
+        for image in images[1:]:
+            compositing.blend(out, image)
+        assert np.array_equal(out, single)
+    finally:
+        compositing.configure(workers)
@@ -0,0 +1,59 @@
+import cv2
+import numpy as np
+
+from app.services import edges, imaging
+from app.services.imaging import magic_lasso_select
+
+
+def _image():
+    img = np.zeros((240, 320, 3), np.uint8)
+    cv2.rectangle(img, (60, 50), (250, 180), (255, 255, 255), -1)
+    cv2.circle(img, (150, 120), 30, (0, 0, 255), -1)
+    return img
+
+
+def test_snap_finds_nearest_edge():
+    index = edges.EdgeIndex(_image())
+    edge_yx = np.argwhere(index.edges > 0)
+    rng = np.random.default_rng(1)
+    points = rng.integers(0, [320, 240], (200, 2))
+    snapped = index.snap(points, max_distance=30)
+
+    for (x, y), (sx, sy) in zip(points, snapped):
+        nearest = np.sqrt(((edge_yx - (y, x)) ** 2).sum(axis=1)).min()
+        if nearest < 29:
+            # The distance transform is a close approximation of the exact distance
+            assert index.edges[sy, sx] and np.hypot(sx - x, sy - y) <= nearest + 1
+        elif nearest > 31:
+            assert (sx, sy) == (x, y)
+
+    # Points outside the image are left alone
+    assert index.snap([[-5, 10], [400, 10]]).tolist() == [[-5, 10], [400, 10]]
+
+
+def test_edge_index_is_cached_per_image(monkeypatch):
+    edges.clear()
+    built = []
+    monkeypatch.setattr(edges, "EdgeIndex", lambda img: built.append(1) or np.zeros(1))
+    img = _image()
+    first = edges.edge_index("a", img)
+    assert edges.edge_index("a", img) is first and len(built) == 1
+    img[0, 0] = 1
+    assert edges.edge_index("a", img) is not first and len(built) == 2
+    edges.clear()
+
+
+def test_cache_stays_within_budget(monkeypatch):
+    edges.clear()
+    index = edges.edge_index("a", _image())
+    monkeypatch.setattr(edges, "EDGE_CACHE_MAX_BYTES", 2 * index.nbytes())
+    for image_id in ("b", "c"):
+        edges.edge_index(image_id, _image())
+    assert [k[1] for k in edges._cache] == ["b", "c"]
+    edges.clear()
+
+
+def test_magic_lasso_returns_mask(monkeypatch):
+    img = _image()
+    monkeypatch.setattr(imaging, "load_image", lambda image_id: (("p", image_id, 1), img))
+    assert magic_lasso_select("test", [[10, 10], [200, 10], [200, 150], [10, 150]])
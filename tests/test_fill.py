@@ -0,0 +1,82 @@
+import cv2
+import numpy as np
+
+from app.models.Layer import Layer
+from app.models.LayerStack import LayerStack
+from app.services import fill
+from app.services.stack_cache import stacks
+from app.services.tools import bucket
+
+
+def _line_art():
+    img = np.zeros((300, 400, 4), np.uint8)
+    img[...] = (255, 255, 255, 255)
+    for i in range(12):
+        cv2.line(img, (0, 25 * i), (399, 25 * i + 40), (0, 0, 0, 255), 2)
+        cv2.circle(img, (30 * i + 20, 150), 18, (40, 40, 40, 255), 2)
+    return img
+
+
+def test_fills_match_flood_fill_after_every_change():
+    layer = Layer("l", 300, 400)
+    layer.update(_line_art())
+    expected = _line_art()
+    rng = np.random.default_rng(3)
+    colors = ["#ff0000", "#00ff00", "#0000ff", "#ffffff"]
+    for i in range(25):
+        x, y = map(int, rng.integers(0, [400, 300]))
+        color = colors[i % len(colors)]
+        if i == 12:
+            # A change the label map did not see
+            layer.get_image()[100:140, 50:90] = (255, 255, 255, 255)
+            layer.mark_dirty((50, 100, 40, 40))
+            expected[100:140, 50:90] = (255, 255, 255, 255)
+        bgr = tuple(int(color[j:j + 2], 16) for j in (5, 3, 1))
+        found = fill.region(layer, bgr, x, y)
+        if found is not None:
+            fill.apply(layer, *found, bgr)
+        bucket(expected, color, [x, y])
+        assert np.array_equal(layer.pixels(), expected), i
+
+
+def test_similar_colors_fill_is_not_contiguous():
+    layer = Layer("l", 300, 400)
+    layer.update(_line_art())
+    rect, mask = fill.region(layer, (0, 0, 255), 5, 5, tolerance=10, contiguous=False)
+    fill.apply(layer, rect, mask, (0, 0, 255))
+    # Every white pixel is now red, the lines are left alone
+    white = (_line_art()[:, :, :3] == 255).all(axis=2)
+    assert (layer.pixels()[white][:, :3] == (0, 0, 255)).all()
+    assert not (layer.pixels()[~white][:, :3] == (0, 0, 255)).all(axis=1).any()
+
+
+def test_bucket_fill_route_and_undo(project):
+    stack = LayerStack(300, 400)
+    stack.add_base_layers()
+    stack.at(1).update(_line_art())
+    client, _ = project(stack)
+
+    r = client.post("/api/v1/tools/bucket_fill", json={"color": "#ff0000", "start_point": [5, 5]})
+    assert r.status_code == 200 and r.json["rect"]
+    # Every red pixel turns green, wherever it is
+    client.post("/api/v1/tools/bucket_fill", json={"color": "#00ff00", "start_point": [5, 5], "contiguous": False})
+    expected = _line_art()
+    bucket(expected, "#ff0000", [5, 5])
+    with stacks.view("project") as stack:
+        green = (stack.at(1).pixels()[:, :, :3] == (0, 255, 0)).all(axis=2)
+        assert np.array_equal(green, (expected[:, :, :3] == (0, 0, 255)).all(axis=2))
+        stack.undo()
+        assert np.array_equal(stack.at(1).pixels(), expected)
+
+
+def test_label_maps_are_kept_within_budget(monkeypatch):
+    monkeypatch.setattr(fill, "_maps", type(fill._maps)())
+    layers = [Layer(f"l{i}", 300, 400) for i in range(5)]
+    # Maps of many layers (of many projects) are kept together
+    maps = [fill.label_map(layer, 10) for layer in layers]
+    assert all(fill.label_map(layer, 10) is m for layer, m in zip(layers, maps))
+
+    monkeypatch.setattr(fill, "FILL_CACHE_MAX_BYTES", 2 * maps[0].nbytes())
+    fill.label_map(Layer("new", 300, 400), 10)
+    assert len(fill._maps) == 2
+    assert fill.label_map(layers[0], 10) is not maps[0]
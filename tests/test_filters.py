@@ -0,0 +1,82 @@
+import cv2
+import numpy as np
+
+from app.models.LayerStack import LayerStack
+from app.services import compositing, filters
+from app.services.stack_cache import stacks
+
+
+def _image(opaque=True):
+    img = np.random.default_rng(4).integers(0, 256, (600, 700, 4), dtype=np.uint8)
+    if opaque:
+        img[:, :, 3] = 255
+    return img
+
+
+def test_tiles_match_whole_image(monkeypatch):
+    img = _image()
+    for workers in (1, 3):
+        monkeypatch.setattr(compositing, "_workers", workers)
+        out = img.copy()
+        filters.apply(out, [{"name": "gaussian", "radius": 4}])
+        assert np.array_equal(out, cv2.GaussianBlur(img, (9, 9), 0, borderType=cv2.BORDER_REFLECT_101))
+
+        out = img.copy()
+        filters.apply(out, [{"name": "sharpen", "radius": 2, "amount": 50}])
+        blurred = cv2.GaussianBlur(img, (5, 5), 0, borderType=cv2.BORDER_REFLECT_101)
+        expected = cv2.addWeighted(img, 1.5, blurred, -0.5, 0)
+        expected[:, :, 3] = 255
+        assert np.array_equal(out, expected)
+
+
+def test_point_filters_are_fused():
+    chain = [{"name": "brightness_contrast", "brightness": 30, "contrast": -20}, {"name": "invert"},
+             {"name": "brightness_contrast", "contrast": 40}]
+    stages = filters.compile_chain(chain)
+    assert len(stages) == 1 and len(stages[0].ops) == 1
+
+    img = _image(opaque=False)
+    out = img.copy()
+    filters.apply(out, chain)
+    expected = img.copy()
+    for spec in chain:
+        filters.apply(expected, [spec])
+    assert np.array_equal(out, expected) and np.array_equal(out[:, :, 3], img[:, :, 3])
+
+
+def test_only_the_selection_changes():
+    img = _image()
+    mask = np.zeros((100, 150), np.uint8)
+    cv2.circle(mask, (75, 50), 40, 255, -1)
+    out = img.copy()
+    filters.apply(out, [{"name": "invert"}, {"name": "gaussian", "radius": 2}], (200, 100, 150, 100), mask)
+    expected = img.copy()
+    filters.apply(expected, [{"name": "invert"}, {"name": "gaussian", "radius": 2}], (200, 100, 150, 100))
+    selected = np.zeros(img.shape[:2], bool)
+    selected[100:200, 200:350] = mask > 0
+    assert np.array_equal(out[selected], expected[selected])
+    assert np.array_equal(out[~selected], img[~selected])
+
+
+def test_filter_routes(project):
+    stack = LayerStack(200, 300)
+    stack.add_base_layers()
+    stack.at(1).update(_image()[:200, :300])
+    client, _ = project(stack)
+
+    client.post("/api/v1/select/rect", json={"image_id": "composite", "coords": [10, 20, 59, 79]})
+    r = client.post("/api/v1/filters/invert", json={})
+    assert r.status_code == 200 and r.json["rect"] == [10, 20, 50, 60]
+    assert client.post("/api/v1/filters/gaussian", json={"radius": 0}).status_code == 400
+    for radius in ("1e400", "NaN"):
+        r = client.post("/api/v1/filters/gaussian", data=f'{{"radius": {radius}}}', content_type="application/json")
+        assert r.status_code == 400
+    assert client.post("/api/v1/filters/apply", json={"filters": [{"name": "emboss"}]}).status_code == 400
+
+    original = _image()[:200, :300]
+    with stacks.view("project") as stack:
+        pixels = stack.at(1).pixels()
+        assert np.array_equal(pixels[20:80, 10:60, :3], 255 - original[20:80, 10:60, :3])
+        assert np.array_equal(pixels[:20], original[:20])
+        stack.undo()
+        assert np.array_equal(stack.at(1).pixels(), original)
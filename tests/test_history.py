@@ -0,0 +1,82 @@
+import numpy as np
+
+from app.models.LayerStack import LayerStack
+
+
+def _stack():
+    stack = LayerStack(300, 400)
+    stack.add_base_layers()
+    return stack
+
+
+def _paint(stack, rect, color):
+    x, y, w, h = rect
+    image = np.array(stack.get_current_layer().pixels())
+    image[y:y + h, x:x + w] = color
+    with stack.record_pixels(rect):
+        stack.get_current_layer().update(image, rect)
+
+
+def test_undo_redo_pixel_edits():
+    stack = _stack()
+    assert not stack.undo()
+    _paint(stack, (10, 10, 20, 20), (0, 0, 255, 255))
+    first = stack.get_collapsed_stack_as_image().copy()
+    _paint(stack, (15, 15, 20, 20), (0, 255, 0, 255))
+
+    assert stack.undo()
+    assert np.array_equal(stack.get_collapsed_stack_as_image(), first)
+    assert stack.undo()
+    assert not stack.get_current_layer().pixels().any()
+    assert stack.redo() and stack.redo()
+    assert tuple(stack.get_current_layer().pixels()[30, 30]) == (0, 255, 0, 255)
+    assert not stack.redo()
+
+    # Only the changed rectangle is stored, compressed
+    assert stack.history().nbytes() < 20 * 20 * 4
+
+
+def test_undo_layer_operations():
+    stack = _stack()
+    ids = [stack.at(i).id() for i in range(2)]
+    stack.duplicate_selected_layer()
+    stack.rename_current_layer("Copy")
+    stack.toggle_visible_at(0)
+    stack.swap_layers(1, 2)
+    stack.delete_selected_layer()
+    assert stack.size() == 2
+
+    for _ in range(5):
+        assert stack.undo()
+    assert [stack.at(i).id() for i in range(stack.size())] == ids
+    assert not stack.at(0).is_hidden()
+
+    for _ in range(5):
+        assert stack.redo()
+    assert stack.size() == 2 and stack.at(0).is_hidden()
+    stack.undo()
+    assert stack.at(1).name() == "Copy" and stack.at(2).name() == "Layer 1"
+
+    # A new change drops the redo list
+    stack.create_layer()
+    assert not stack.redo()
+
+
+def test_budget_drops_oldest_entries():
+    stack = _stack()
+    stack.history().max_bytes = 10_000
+    rng = np.random.default_rng(0)
+    for i in range(10):
+        x, y, w, h = i * 20, 0, 20, 20
+        image = np.array(stack.get_current_layer().pixels())
+        image[y:y + h, x:x + w] = rng.integers(0, 256, (h, w, 4))
+        with stack.record_pixels((x, y, w, h)):
+            stack.get_current_layer().update(image, (x, y, w, h))
+
+    assert stack.history().nbytes() <= 10_000
+    undone = 0
+    while stack.undo():
+        undone += 1
+    assert 0 < undone < 10
+    # The oldest edits could not be undone
+    assert stack.get_current_layer().pixels()[:20, :20].any()
@@ -0,0 +1,58 @@
+import numpy as np
+
+from app.models.LayerStack import LayerStack
+from app.services import imaging
+from app.services.stack_cache import stacks
+
+
+def _project(project):
+    stack = LayerStack(40, 60)
+    stack.add_base_layers()
+    stack.at(1).get_image()[10:20, 10:30] = (0, 0, 255, 255)
+    stack.at(1).mark_dirty()
+    return project(stack, "img1")[1]
+
+
+def test_layers_and_composite_are_looked_up(project):
+    stack = _project(project)
+    by_index = imaging.load_image(1, "img1")[1]
+    by_id = imaging.load_image(stack.at(1).id(), "img1")[1]
+    assert by_index.shape == (40, 60, 3) and np.array_equal(by_index, by_id)
+    assert by_index[15, 15].tolist() == [0, 0, 255] and not by_index[0, 0].any()
+
+    composite = imaging.load_image("composite", "img1")[1]
+    assert composite[15, 15].tolist() == [0, 0, 255] and composite[0, 0].tolist() == [255, 255, 255]
+
+    for missing in (("7", "img1"), ("nope", "img1"), (0, "other")):
+        try:
+            imaging.load_image(*missing)
+            assert False, missing
+        except LookupError:
+            pass
+
+
+def test_images_are_cached_until_they_change(project):
+    _project(project)
+    key, first = imaging.load_image(1, "img1")
+    assert imaging.load_image(1, "img1")[1] is first and not first.flags.writeable
+    composite = imaging.load_image("composite", "img1")[1]
+    assert imaging.load_image("composite", "img1")[1] is composite
+
+    with stacks.edit("img1") as stack:
+        with stack.record_pixels((0, 0, 5, 5)):
+            stack.at(1).get_image()[0:5, 0:5] = (255, 0, 0, 255)
+            stack.at(1).mark_dirty((0, 0, 5, 5))
+    new_key, changed = imaging.load_image(1, "img1")
+    assert new_key != key and changed[0, 0].tolist() == [255, 0, 0]
+    assert imaging.load_image("composite", "img1")[1][0, 0].tolist() == [255, 0, 0]
+    # Only the newest version of an image is kept
+    assert key not in imaging._images
+
+
+def test_cache_stays_within_budget(project, monkeypatch):
+    _project(project)
+    monkeypatch.setattr(imaging, "IMAGE_CACHE_MAX_BYTES", 40 * 60 * 3 * 2)
+    for image_id in (0, 1, "composite"):
+        imaging.load_image(image_id, "img1")
+    assert imaging._images_bytes <= imaging.IMAGE_CACHE_MAX_BYTES
+    assert ("img1", "0") not in [k[:2] for k in imaging._images]
@@ -0,0 +1,89 @@
+import cv2
+import numpy as np
+
+from app.models.LayerStack import LayerStack
+from app.services import exporter
+from app.services.stack_cache import stacks
+
+
+def test_versioned_names_and_etags(project):
+    stack = LayerStack(40, 60)
+    stack.add_base_layers()
+    client, _ = project(stack)
+    pid = "project"
+
+    with stacks.view(pid) as stack:
+        name = stack.get_as_json()["layers"][1]["filename"]
+    res = client.get(f"/api/v1/layer_img/{name}")
+    assert res.status_code == 200 and res.data.startswith(b"\x89PNG")
+    assert "immutable" in res.headers["Cache-Control"]
+    etag = res.headers["ETag"]
+    assert client.get(f"/api/v1/layer_img/{name}", headers={"If-None-Match": etag}).status_code == 304
+    # Unversioned names are checked every time
+    res = client.get("/api/v1/layer_img/Layer1.png", headers={"If-None-Match": etag})
+    assert res.status_code == 304 and res.headers["Cache-Control"] == "private, no-cache"
+
+    with stacks.edit(pid) as stack:
+        stack.at(1).get_image()[5, 5] = (0, 0, 255, 255)
+        stack.at(1).mark_dirty((5, 5, 1, 1))
+        assert stack.get_as_json()["layers"][1]["filename"] != name
+    res = client.get(f"/api/v1/layer_img/{name}", headers={"If-None-Match": etag})
+    assert res.status_code == 200 and res.headers["ETag"] != etag
+    assert res.headers["Cache-Control"] == "private, no-cache"
+
+
+def test_layer_exported_by_an_edit_is_not_encoded_again(project, monkeypatch):
+    client, stack = project()
+    written = []
+    submit = exporter._submit
+    monkeypatch.setattr(exporter, "_submit", lambda path, *args: (written.append(path), submit(path, *args)))
+
+    r = client.post("/api/v1/tools/stroke", json={"points": [[10, 10], [60, 40]], "color": "#ff0000", "size": 5})
+    assert r.status_code == 200
+    res = client.get("/api/v1/layer_img/Layer1.png")
+    assert res.status_code == 200
+    assert [p for p in written if p.endswith("Layer1.png")] == [stacks.layers_folder("project") + "/Layer1.png"]
+    served = cv2.imdecode(np.frombuffer(res.data, np.uint8), cv2.IMREAD_UNCHANGED)
+    assert np.array_equal(served, stack.at(1).pixels())
+
+
+def test_structural_edits_export_the_moved_layers(project, tmp_path):
+    client, stack = project()
+    with stacks.edit("project") as stack:
+        stack.at(1).get_image()[:] = (0, 255, 0, 255)
+        stack.at(1).mark_dirty()
+    folder = tmp_path / stacks.layers_folder("project")
+    for route in ("add_layer", "duplicate_layer", "delete_layer"):
+        assert client.post(f"/api/v1/layers/{route}").status_code == 200
+        exporter.flush()
+        with stacks.view("project") as stack:
+            for i in range(stack.size()):
+                written = cv2.imread(str(folder / f"Layer{i}.png"), cv2.IMREAD_UNCHANGED)
+                assert np.array_equal(written, stack.at(i).pixels()), (route, i)
+
+
+def test_tags_change_when_the_project_is_loaded_again(tmp_path):
+    stack = LayerStack(20, 30)
+    stack.add_base_layers()
+    assert stack.save_project(str(tmp_path / "project"))
+    tags = []
+    for _ in range(2):
+        loaded = LayerStack(0, 0)
+        assert loaded.load_project(str(tmp_path / "project"))
+        tags.append((loaded.layer_tag(1), loaded.composite_tag()))
+    # Same revisions, but a crash may have lost the pixels they stood for
+    assert tags[0][0] != tags[1][0] and tags[0][1] != tags[1][1]
+
+
+def test_failed_export_is_tried_again(tmp_path, monkeypatch):
+    stack = LayerStack(20, 30)
+    stack.add_base_layers()
+    folder = str(tmp_path / "layers")
+    monkeypatch.setattr(exporter.cv2, "imencode", lambda ext, image: (False, None))
+    exporter.export_layers(stack, folder)
+    exporter.flush()
+    assert len(stack.stale_layer_images(folder)) == 2
+    monkeypatch.undo()
+    exporter.export_layers(stack, folder)
+    exporter.flush()
+    assert not stack.stale_layer_images(folder)
@@ -0,0 +1,41 @@
+from app.models.LayerStack import LayerStack
+
+
+def test_duplicate_shares_pixels_until_written():
+    stack = LayerStack(50, 70)
+    stack.add_base_layers()
+    stack.at(1).get_image()[:10, :10] = (0, 0, 255, 255)
+    before = stack.nbytes()
+    stack.duplicate_selected_layer()
+    original, duplicate = stack.at(1), stack.at(2)
+
+    assert duplicate.is_shared() and original.buffer_id() == duplicate.buffer_id()
+    assert stack.nbytes() == before
+    assert not duplicate.pixels().flags.writeable
+
+    duplicate.get_image()[:10, :10] = (255, 0, 0, 255)
+    duplicate.mark_dirty((0, 0, 10, 10))
+    assert not duplicate.is_shared() and not original.is_shared()
+    assert tuple(original.pixels()[0, 0]) == (0, 0, 255, 255)
+    assert tuple(duplicate.pixels()[0, 0]) == (255, 0, 0, 255)
+
+    # Once a deleted duplicate is dropped from the undo history, the other layer is
+    # the only owner again
+    stack.duplicate_selected_layer()
+    stack.delete_selected_layer()
+    assert stack.at(2).is_shared()
+    stack.history().clear()
+    assert not stack.at(2).is_shared()
+
+
+def test_move_layer_keeps_selection():
+    stack = LayerStack(20, 20)
+    stack.add_base_layers()
+    stack.create_layer()
+    stack.create_layer()
+    ids = [stack.at(i).id() for i in range(4)]
+    selected = stack.get_current_layer().id()
+
+    stack.move_layer(3, 1)
+    assert [stack.at(i).id() for i in range(4)] == [ids[0], ids[3], ids[1], ids[2]]
+    assert stack.get_current_layer().id() == selected
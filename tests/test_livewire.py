@@ -0,0 +1,88 @@
+import heapq
+
+import cv2
+import numpy as np
+
+from app.services import livewire
+
+
+def _dijkstra(cost, start):
+    h, w = cost.shape
+    d = np.full((h, w), np.inf)
+    d[start[1], start[0]] = 0
+    queue = [(0.0, start[1], start[0])]
+    while queue:
+        dist, y, x = heapq.heappop(queue)
+        if dist > d[y, x]:
+            continue
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                ny, nx = y + dy, x + dx
+                if (dx or dy) and 0 <= ny < h and 0 <= nx < w:
+                    nd = dist + float(cost[ny, nx]) * (np.sqrt(2) if dx and dy else 1)
+                    if nd < d[ny, nx]:
+                        d[ny, nx] = nd
+                        heapq.heappush(queue, (nd, ny, nx))
+    return d
+
+
+def test_tree_matches_dijkstra():
+    cost = np.random.default_rng(2).random((60, 70)).astype(np.float32) + 0.05
+    tree = livewire.ShortestPathTree(cost, (30, 20), 100)
+    assert np.abs(tree.distance - _dijkstra(cost, (30, 20))).max() < 1e-9
+    path = tree.path_to((65, 55))
+    assert path[0].tolist() == [30, 20] and path[-1].tolist() == [65, 55]
+    assert np.abs(np.diff(path, axis=0)).max() == 1
+
+
+# Square spiral of walls winding in to the middle, corridors gap pixels wide
+def _spiral(size, gap=3):
+    cost = np.full((size, size), 0.1, np.float32)
+    x, y, length = 0, 0, size - 1
+    for turn in range(size):
+        if length <= 0:
+            break
+        dx, dy = [(1, 0), (0, 1), (-1, 0), (0, -1)][turn % 4]
+        for _ in range(length):
+            cost[y, x] = 1e4
+            x, y = x + dx, y + dy
+        if turn % 2:
+            length -= gap + 1
+    return cost
+
+
+def test_tree_matches_dijkstra_in_a_spiral():
+    # Paths out of the middle turn back many times, more rounds than a few
+    cost = _spiral(121)
+    tree = livewire.ShortestPathTree(cost, (60, 60), 100)
+    assert np.abs(tree.distance - _dijkstra(cost, (60, 60))).max() < 1e-6
+
+
+def test_path_follows_edges_and_reuses_tree():
+    img = np.zeros((300, 400, 3), np.uint8)
+    cv2.rectangle(img, (100, 80), (300, 220), (255, 255, 255), -1)
+    loads = []
+
+    def load():
+        loads.append(1)
+        return img
+
+    path = livewire.path("rect", load, (100, 80), (300, 220))
+    # Around the rectangle's border rather than across it
+    inside = path[(path[:, 0] > 104) & (path[:, 0] < 296) & (path[:, 1] > 84) & (path[:, 1] < 216)]
+    assert not len(inside)
+    # Cursor moves around the same anchor only walk the tree
+    livewire.path("rect", load, (100, 80), (290, 210))
+    assert len(loads) == 1
+    livewire.forget("rect")
+
+
+def test_trees_are_kept_within_budget(monkeypatch):
+    img = np.zeros((100, 100, 3), np.uint8)
+    monkeypatch.setattr(livewire, "_trees", type(livewire._trees)())
+    livewire.path("budget", lambda: img, (10, 10), (20, 20))
+    tree = next(iter(livewire._trees.values()))
+    monkeypatch.setattr(livewire, "LIVEWIRE_CACHE_MAX_BYTES", 2 * tree.nbytes())
+    for anchor in ((30, 30), (50, 50)):
+        livewire.path("budget", lambda: img, anchor, (60, 60))
+    assert [k[1:3] for k in livewire._trees] == [(30, 30), (50, 50)]
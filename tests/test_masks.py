@@ -0,0 +1,125 @@
+import base64
+import threading
+
+import cv2
+import numpy as np
+
+from app.models.LayerStack import LayerStack
+from app.models.selection import SelectionMask
+from app.services import selections
+from app.services.stack_cache import stacks
+
+
+def _from_runs(runs, w, h):
+    values = np.repeat(np.arange(len(runs)) % 2, runs).astype(np.uint8) * 255
+    return values.reshape(h, w)
+
+
+def test_cropped_polygon_matches_full_canvas():
+    points = [[-20, 30], [70, 5], [140, 90], [40, 130]]
+    selection = SelectionMask.polygon(120, 100, points)
+    expected = np.zeros((100, 120), np.uint8)
+    cv2.fillPoly(expected, [np.array(points, np.int32)], 255)
+    assert selection.bbox() == (0, 5, 120, 95)
+    assert np.array_equal(selection.full(), expected)
+
+    x, y, w, h = selection.bbox()
+    assert np.array_equal(_from_runs(selection.runs(), w, h), selection.mask)
+    unpacked = SelectionMask.from_packed(selection.packed())
+    assert unpacked.bbox() == selection.bbox() and np.array_equal(unpacked.full(), expected)
+
+
+def test_rectangle_and_empty_selection():
+    selection = SelectionMask.rectangle(50, 40, (30, 20, 10, 10))
+    assert selection.bbox() == (10, 10, 21, 11) and selection.mask.all()
+    empty = SelectionMask.rectangle(50, 40, (60, 50, 70, 80))
+    assert empty.bbox() == (0, 0, 0, 0) and empty.runs() == [] and not empty.full().any()
+    assert SelectionMask.from_packed(empty.packed()).bbox() == (0, 0, 0, 0)
+
+
+def test_select_route_formats(project):
+    stack = LayerStack(400, 600)
+    stack.add_base_layers()
+    client, _ = project(stack)
+    body = {"image_id": "composite", "coords": [100, 50, 109, 59]}
+
+    png = client.post("/api/v1/select/rect", json=body)
+    mask = cv2.imdecode(np.frombuffer(base64.b64decode(png.json["mask"]), np.uint8), cv2.IMREAD_GRAYSCALE)
+    assert mask.shape == (400, 600) and mask[50:60, 100:110].all() and mask.sum() == 100 * 255
+
+    rle = client.post("/api/v1/select/rect?format=rle", json=body).json
+    assert rle == {"size": [600, 400], "bbox": [100, 50, 10, 10], "runs": [0, 100]}
+
+    packed = client.post("/api/v1/select/rect", json=body, headers={"Accept": "application/octet-stream"})
+    assert packed.mimetype == "application/octet-stream" and len(packed.data) == 24 + 10 * 2
+    assert np.array_equal(SelectionMask.from_packed(packed.data).full(), mask)
+
+    assert client.post("/api/v1/select/rect?format=gif", json=body).status_code == 400
+    assert client.post("/api/v1/select/rect", json={**body, "image_id": "9"}).status_code == 404
+
+
+def test_boolean_operations_match_full_canvas():
+    a = SelectionMask.rectangle(80, 60, (10, 10, 39, 29))
+    b = SelectionMask.polygon(80, 60, [[30, 20], [70, 25], [50, 55]])
+    fa, fb = a.full(), b.full()
+    assert np.array_equal(a.combine(b, "add").full(), np.maximum(fa, fb))
+    assert np.array_equal(a.combine(b, "intersect").full(), np.minimum(fa, fb))
+    assert np.array_equal(a.combine(b, "subtract").full(), np.minimum(fa, 255 - fb))
+    assert np.array_equal(a.invert().full(), 255 - fa)
+
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (7, 7))
+    assert np.array_equal(b.grow(3).full(), cv2.dilate(fb, kernel))
+    assert np.array_equal(b.grow(-3).full(), cv2.erode(fb, kernel))
+    feathered = a.feather(4)
+    assert not feathered.is_hard() and feathered.bbox() == (6, 6, 38, 28)
+
+    changed = a.changes_to(a.combine(b, "add"))
+    assert changed.bbox() == cv2.boundingRect((np.maximum(fa, fb) != fa).astype(np.uint8))
+    assert a.validate() and not feathered.validate()
+    img = np.full((60, 80, 3), 9, np.uint8)
+    assert np.array_equal(a.apply_to_image(img)[:, :, 0], np.minimum(fa, 9))
+
+
+def test_selection_store_routes(project):
+    client, _ = project()
+
+    client.post("/api/v1/select/rect", json={"image_id": "composite", "coords": [0, 0, 99, 99]})
+    # Adding a rectangle that overlaps the selection only sends the new part back
+    r = client.post("/api/v1/select/rect?format=rle", json={"image_id": "composite", "coords": [50, 50, 149, 149], "mode": "add"})
+    assert r.json["bbox"] == [50, 50, 100, 100]
+    r = client.post("/api/v1/select/grow?format=packed", json={"radius": 2})
+    grown = SelectionMask.from_packed(r.data)
+    assert grown.bbox() == (0, 0, 152, 152)
+
+    expected = np.zeros((300, 400), np.uint8)
+    expected[:100, :100] = expected[50:150, 50:150] = 255
+    expected = cv2.dilate(expected, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5)))
+    active = SelectionMask.from_packed(client.get("/api/v1/select/active?format=packed").data)
+    assert np.array_equal(active.full(), expected)
+
+    assert client.post("/api/v1/select/rect", json={"image_id": "composite", "coords": [0, 0, 1, 1], "mode": "xor"}).status_code == 400
+    assert client.post("/api/v1/select/clear?format=rle", json={}).json["bbox"] == [0, 0, 152, 152]
+    assert client.get("/api/v1/select/active?format=rle").json["runs"] == []
+
+
+def test_selection_goes_with_its_project(project):
+    client, _ = project(pid="gone")
+    client.post("/api/v1/select/rect", json={"image_id": "composite", "coords": [0, 0, 9, 9]})
+    assert "gone" in selections._selections
+    stacks.evict("gone")
+    assert "gone" not in selections._selections
+
+
+def test_concurrent_adds_all_land():
+    def add(i):
+        part = SelectionMask.rectangle(400, 40, (i * 10, 0, i * 10 + 4, 39))
+        selections.update("concurrent", 400, 40, lambda active: active.combine(part, "add"))
+
+    threads = [threading.Thread(target=add, args=(i,)) for i in range(40)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    selection = selections.active("concurrent", 400, 40)
+    assert selection.full().sum() == 40 * 5 * 40 * 255
+    selections.update("concurrent", 400, 40, lambda active: SelectionMask(400, 40))
@@ -0,0 +1,82 @@
+import json
+import os
+
+import numpy as np
+
+from app.models.LayerStack import LayerStack
+
+
+def _stack():
+    stack = LayerStack(60, 80)
+    stack.add_base_layers()
+    stack.create_layer()
+    return stack
+
+
+def test_round_trip(tmp_path):
+    stack = _stack()
+    stack.at(1).get_image()[10:20, 10:20] = (1, 2, 3, 255)
+    stack.at(1).mark_dirty((10, 10, 10, 10))
+    stack.at(2).rename("Ink")
+    stack.toggle_visible_at(2)
+    stack.select_layer(1)
+    assert stack.save_project(tmp_path)
+
+    for mmap in (False, True):
+        loaded = LayerStack(0, 0)
+        assert loaded.load_project(tmp_path, mmap=mmap)
+        assert loaded.size() == 3
+        assert loaded.get_as_json()["selected_layer"] == 1
+        assert loaded.at(2).name() == "Ink" and loaded.at(2).is_hidden()
+        assert np.array_equal(loaded.at(1).get_image(), stack.at(1).get_image())
+        # Versions go on from the saved ones
+        assert loaded.at(1).revision() >= stack.at(1).revision()
+
+
+def test_only_dirty_layers_rewritten(tmp_path):
+    stack = _stack()
+    stack.save_project(tmp_path)
+    files = {x.id(): os.path.join(tmp_path, f"{x.id()}.npy") for x in stack._layer_array}
+    for path in files.values():
+        os.utime(path, (0, 0))
+
+    image = stack.at(1).get_image().copy()
+    image[0, 0] = (9, 9, 9, 255)
+    stack.at(1).update(image)
+    stack.delete_selected_layer()
+    stack.save_project(tmp_path)
+
+    assert os.path.getmtime(files[stack.at(0).id()]) == 0
+    assert os.path.getmtime(files[stack.at(1).id()]) > 0
+    # Deleted layer's file is removed
+    assert sorted(os.listdir(tmp_path)) == sorted(["manifest.json", *(f"{x.id()}.npy" for x in stack._layer_array)])
+
+
+def test_rejects_mismatched_layer(tmp_path):
+    stack = _stack()
+    stack.save_project(tmp_path)
+    with open(tmp_path / "manifest.json") as f:
+        manifest = json.load(f)
+    np.save(tmp_path / manifest["layers"][1]["file"], np.zeros((5, 5, 4), np.uint8))
+    assert not LayerStack(0, 0).load_project(tmp_path)
+
+
+def test_memmap_layers_live_in_project_folder(tmp_path):
+    stack = LayerStack(60, 80)
+    stack.use_memmap(tmp_path)
+    stack.add_base_layers()
+    assert stack.nbytes() == 0
+    assert all(os.path.exists(tmp_path / x.filename()) for x in stack._layer_array)
+
+    image = stack.at(1).get_image().copy()
+    image[5:10, 5:10] = (0, 0, 255, 255)
+    stack.at(1).update(image)
+    stack.duplicate_selected_layer()
+    # The duplicate shares the file until it is written
+    assert stack.at(2).is_shared() and stack.nbytes() == 0
+    assert stack.save_project(tmp_path)
+
+    loaded = LayerStack(0, 0)
+    assert loaded.load_project(tmp_path, mmap=True)
+    assert isinstance(loaded.at(2).get_image(), np.memmap)
+    assert np.array_equal(loaded.at(2).get_image(), image)
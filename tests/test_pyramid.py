@@ -0,0 +1,60 @@
+import cv2
+import numpy as np
+
+from app.models.LayerStack import LayerStack
+from app.services import pyramid
+
+
+def _stack():
+    stack = LayerStack(601, 777)
+    stack.add_base_layers()
+    image = np.random.default_rng(3).integers(0, 256, (601, 777, 4), dtype=np.uint8)
+    image[:300, :, 3] = 255
+    image[300:, :, 3] //= 2
+    stack.at(1).update(image)
+    return stack
+
+
+def _decode(data):
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED)
+
+
+def test_level_for():
+    assert pyramid.level_for(1) == 0 and pyramid.level_for(2) == 0
+    assert pyramid.level_for(0.5) == 1 and pyramid.level_for(0.3) == 1
+    assert pyramid.level_for(0.1) == 3 and pyramid.level_for(0.001) == pyramid.LEVELS
+
+
+def test_levels_follow_changed_tiles():
+    stack = _stack()
+    level = _decode(pyramid.png("p", stack, 1, 2))
+    assert level.shape == (151, 195, 4)
+    # Opaque tiles are a plain average of 4x4 blocks
+    half = cv2.resize(stack.at(1).pixels()[:256, :768], (384, 128), interpolation=cv2.INTER_AREA)
+    assert np.array_equal(level[:64, :192], cv2.resize(half, (192, 64), interpolation=cv2.INTER_AREA))
+
+    layer = stack.at(1)
+    layer.get_image()[500:520, 20:40] = (0, 0, 255, 255)
+    layer.mark_dirty((20, 500, 20, 20))
+    for k in (1, 2, 4):
+        expected = pyramid.Pyramid(601, 777)
+        expected.changed(np.ones((3, 4), bool), None, layer)
+        assert np.array_equal(_decode(pyramid.png("p", stack, 1, k)), expected.level(layer.pixels(), k))
+
+    composite = _decode(pyramid.png("p", stack, None, 1))
+    expected = pyramid.Pyramid(601, 777)
+    expected.changed(np.ones((3, 4), bool), None, stack)
+    assert np.array_equal(composite, expected.level(stack.get_collapsed_stack_as_image(), 1))
+
+
+def test_layer_img_scale(project):
+    stack = LayerStack(100, 120)
+    stack.add_base_layers()
+    client, _ = project(stack)
+
+    res = client.get("/api/v1/layer_img/Layer0.png?scale=0.3")
+    assert res.status_code == 200 and _decode(res.data).shape == (50, 60, 4)
+    res = client.get("/api/v1/layer_img/composite.png?scale=0.2")
+    assert res.status_code == 200 and _decode(res.data).shape == (25, 30, 4)
+    assert client.get("/api/v1/layer_img/Layer7.png?scale=0.5").status_code == 404
+    assert client.get("/api/v1/layer_img/Layer0.png?scale=0").status_code == 400
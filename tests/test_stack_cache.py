@@ -0,0 +1,70 @@
+import os
+
+from app.models.LayerStack import LayerStack
+from app.services.stack_cache import StackCache
+
+
+def _new_stack():
+    stack = LayerStack(100, 100)
+    stack.add_base_layers()
+    return stack
+
+
+def test_hit_miss_and_lazy_writeback(tmp_path):
+    cache = StackCache(root=str(tmp_path), flush_interval=0)
+    os.makedirs(tmp_path / "p1")
+    cache.put("p1", _new_stack())
+    assert not os.path.exists(cache.path("p1"))
+
+    with cache.edit("p1") as stack:
+        stack.toggle_visible_at(1)
+    assert cache.flush() == 1
+    assert cache.flush() == 0
+
+    # A fresh cache misses once, then hits
+    cache = StackCache(root=str(tmp_path), flush_interval=0)
+    with cache.view("p1") as stack:
+        assert stack.at(1).is_hidden()
+    with cache.view("p1") as stack:
+        assert stack.size() == 2
+    with cache.view("missing") as stack:
+        assert stack is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"]) == (1, 2)
+
+
+def test_budget_evicts_least_recently_used(tmp_path):
+    one_stack = _new_stack().nbytes()
+    cache = StackCache(root=str(tmp_path), max_bytes=2 * one_stack, flush_interval=0)
+    for pid in ("a", "b", "c"):
+        os.makedirs(tmp_path / pid)
+    cache.put("a", _new_stack())
+    cache.put("b", _new_stack())
+    with cache.view("a"):
+        pass
+    cache.put("c", _new_stack())
+
+    stats = cache.stats()
+    assert stats["evictions"] == 1
+    assert stats["projects"] == 2
+    # "b" was least recently used, and was written back when evicted
+    assert os.path.exists(cache.path("b"))
+    assert not os.path.exists(cache.path("a"))
+
+
+def test_edit_that_raises_is_still_written_back(tmp_path):
+    cache = StackCache(root=str(tmp_path), flush_interval=0)
+    os.makedirs(tmp_path / "p1")
+    cache.put("p1", _new_stack(), dirty=False)
+    try:
+        with cache.edit("p1") as stack:
+            stack.toggle_visible_at(1)
+            raise RuntimeError("handler failed after changing the stack")
+    except RuntimeError:
+        pass
+    assert cache.stats()["dirty"] == 1
+
+    cache.evict("p1")
+    assert "p1" not in cache._locks
+    with cache.view("p1") as stack:
+        assert stack.at(1).is_hidden()
@@ -0,0 +1,108 @@
+import io
+import json
+
+import numpy as np
+
+from app.models.LayerStack import LayerStack
+from app.services import exporter, strokes
+from app.services.stack_cache import stacks
+from app.services.tools import brush
+
+
+def _ndjson(*lines):
+    return "".join(json.dumps(x) + "\n" for x in lines)
+
+
+def test_streamed_stroke_is_drawn_and_undone_as_one(project, tmp_path):
+    stack = LayerStack(120, 160)
+    stack.add_base_layers()
+    client, _ = project(stack, "p1")
+
+    points = [[10, 10], [40, 30], [80, 35], [120, 90], [150, 110]]
+    header = {"stroke": "s1", "tool": "brush", "color": "#00ff00", "size": 6}
+    # The same stroke over two requests, the second one ending it
+    r = client.post("/api/v1/tools/stroke/stream", data=_ndjson(header, {"points": points[:2]}))
+    assert r.status_code == 200
+    r = client.post("/api/v1/tools/stroke/stream",
+                    data=_ndjson(header, *points[2:], {"end": True}))
+    assert r.status_code == 200 and r.json["stroke"] == "s1"
+
+    expected = np.zeros((120, 160, 4), np.uint8)
+    brush(expected, "#00ff00", 6, points)
+    with stacks.view("p1") as stack:
+        assert np.array_equal(stack.at(1).pixels(), expected)
+        assert stack.history().as_json()["undo"] == 1
+        stack.undo()
+        assert not stack.at(1).pixels().any()
+
+    exporter.flush()
+    assert (tmp_path / "users" / "p1" / "layers" / "Layer1.png").exists()
+
+
+def test_other_edits_end_a_dropped_stroke(project):
+    client, _ = project(pid="p2")
+
+    # The connection drops before the end line
+    header = {"stroke": "lost", "tool": "brush", "color": "#ff0000", "size": 4}
+    assert client.post("/api/v1/tools/stroke/stream", data=_ndjson(header, [5, 5], [30, 20])).status_code == 200
+    assert ("p2", "lost") in strokes._sessions
+
+    # Undo finishes the stroke first, then takes it back as one entry
+    assert client.post("/api/v1/layers/undo").status_code == 200
+    assert ("p2", "lost") not in strokes._sessions
+    with stacks.view("p2") as stack:
+        assert not stack.at(1).pixels().any()
+        assert stack.history().as_json()["undo"] == 0
+
+
+def test_bad_stream_line_is_rejected(project):
+    client, _ = project()
+    r = client.post("/api/v1/tools/stroke/stream", data="{not json\n")
+    assert r.status_code == 400
+
+
+class _DroppedStream(io.BytesIO):
+    # Request body that breaks off after its data, like a closed connection
+    def read(self, size=-1):
+        data = super().read(size)
+        if not data:
+            raise ConnectionResetError("connection dropped")
+        return data
+
+    def readinto(self, buffer):
+        n = super().readinto(buffer)
+        if not n:
+            raise ConnectionResetError("connection dropped")
+        return n
+
+
+def test_dropped_stream_finishes_its_stroke(project, monkeypatch):
+    client, _ = project(pid="p3")
+    # Drawn as the lines arrive, as in a stream that runs for a while
+    monkeypatch.setattr(strokes, "COALESCE_SECONDS", 0)
+    header = {"stroke": "cut", "tool": "brush", "color": "#ff0000", "size": 4}
+    body = _ndjson(header, [5, 5], [30, 20]).encode()
+    try:
+        client.post("/api/v1/tools/stroke/stream", input_stream=_DroppedStream(body),
+                    environ_overrides={"CONTENT_LENGTH": str(len(body) + 10)})
+    except ConnectionResetError:
+        pass
+
+    assert ("p3", "cut") not in strokes._sessions
+    with stacks.view("p3") as stack:
+        assert stack.at(1).pixels().any()
+        assert stack.history().as_json()["undo"] == 1
+
+
+def test_idle_strokes_are_finished(project, monkeypatch):
+    client, _ = project(pid="p4")
+    header = {"stroke": "idle", "tool": "brush", "color": "#ff0000", "size": 4}
+    assert client.post("/api/v1/tools/stroke/stream", data=_ndjson(header, [5, 5], [30, 20])).status_code == 200
+
+    strokes.end_idle()
+    assert ("p4", "idle") in strokes._sessions
+    monkeypatch.setattr(strokes, "IDLE_SECONDS", 0)
+    strokes.end_idle()
+    assert ("p4", "idle") not in strokes._sessions
+    with stacks.view("p4") as stack:
+        assert stack.history().as_json()["undo"] == 1
@@ -0,0 +1,62 @@
+import cv2
+import numpy as np
+
+from app.services import exporter
+from app.services.tools import brush, bucket, tool_brush
+
+
+def test_array_brush_matches_png_tool(tmp_path):
+    points = [[10, 12], [80, 40], [90, 95]]
+    img = np.zeros((120, 160, 4), np.uint8)
+    rect = brush(img, "#ff8000", 7, points)
+
+    path = str(tmp_path / "layer.png")
+    cv2.imwrite(path, np.zeros((120, 160, 4), np.uint8))
+    assert tool_brush(path, "#ff8000", 7, points) == rect
+    assert np.array_equal(cv2.imread(path, cv2.IMREAD_UNCHANGED), img)
+
+    # Nothing outside the returned rect was drawn on
+    x, y, w, h = rect
+    outside = img.copy()
+    outside[y:y + h, x:x + w] = 0
+    assert not outside.any()
+
+
+def test_roi_stroke_matches_whole_image_stroke():
+    rng = np.random.default_rng(3)
+    for size in (1, 4, 25):
+        points = rng.integers(-20, 220, (6, 2)).tolist()
+        img = np.zeros((200, 180, 4), np.uint8)
+        brush(img, "#123456", size, points)
+
+        expected = np.zeros((200, 180, 4), np.uint8)
+        for p1, p2 in zip(points, points[1:]):
+            cv2.line(expected, tuple(p1), tuple(p2), (0x56, 0x34, 0x12, 255), size, cv2.LINE_AA)
+        assert np.array_equal(img, expected)
+
+
+def test_bucket_returns_filled_rect():
+    img = np.zeros((50, 50, 4), np.uint8)
+    cv2.rectangle(img, (10, 10), (30, 20), (255, 255, 255, 255), -1)
+    assert bucket(img, "#0000ff", [15, 15]) == (10, 10, 21, 11)
+    assert tuple(img[15, 15]) == (255, 0, 0, 255)
+    assert bucket(img, "#0000ff", [15, 15]) is None
+
+
+def test_exporter_writes_changed_layers(tmp_path):
+    from app.models.LayerStack import LayerStack
+    stack = LayerStack(40, 40)
+    stack.add_base_layers()
+    folder = str(tmp_path / "layers")
+    exporter.export_layers(stack, folder)
+    exporter.wait(f"{folder}/Layer0.png")
+    assert cv2.imread(f"{folder}/Layer0.png", cv2.IMREAD_UNCHANGED)[0, 0].tolist() == [255] * 4
+
+    stack.at(1).get_image()[:] = (1, 2, 3, 255)
+    stack.at(1).mark_dirty()
+    exporter.export_layers(stack, folder)
+    # Queued, and only marked as exported once written
+    assert not stack.stale_layer_images(folder, queued=exporter._queued)
+    exporter.flush()
+    assert not stack.stale_layer_images(folder)
+    assert cv2.imread(f"{folder}/Layer1.png", cv2.IMREAD_UNCHANGED)[0, 0].tolist() == [1, 2, 3, 255]